@@ -0,0 +1,258 @@
+import asyncio
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import anyio
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import RELEASE_SCRIPT, RENEW_SCRIPT, redis_memory
+from app.metrics import (
+    admission_queue_length, admission_queue_wait_seconds, admission_rejected_total, metrics_registry,
+)
+
+logger = get_logger("admission")
+
+Release = Callable[[], Awaitable[None]]
+
+# 释放用户锁的最长时间(秒)，超时后锁在TTL后自动释放
+RELEASE_TIMEOUT = 5
+
+
+def user_lock_key(user_id: str) -> str:
+    return f"{user_id}:lock"
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝，由路由转换为带Retry-After的HTTP错误"""
+
+    def __init__(self, message: str, status_code: int, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+async def _noop():
+    pass
+
+
+class LocalUserLock:
+    """进程内的按用户互斥锁，只在单worker部署时能保证串行"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._holders: Dict[str, int] = {}
+
+    async def acquire(self, user_id: str, timeout: float) -> Release:
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._holders[user_id] = self._holders.get(user_id, 0) + 1
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout=timeout)
+        except BaseException:
+            self._forget(user_id)
+            raise
+
+        async def release():
+            lock.release()
+            self._forget(user_id)
+
+        return release
+
+    def _forget(self, user_id: str):
+        # 没有等待者时删除锁，避免字典随用户数增长
+        self._holders[user_id] -= 1
+        if not self._holders[user_id]:
+            del self._holders[user_id]
+            del self._locks[user_id]
+
+
+class RedisUserLock:
+    """
+    基于Redis的按用户互斥锁，多个worker之间也能保证串行:
+        - SET NX PX 加锁，锁值为随机token，轮询等待直到超时
+        - 持有期间每 ttl/3 续期一次，进程崩溃时锁在ttl后自动释放
+        - 通过Lua脚本比较token后释放，不会误删其他请求的锁
+        - Redis不可用时放行，不影响聊天
+    """
+
+    def __init__(self, ttl_ms: int = settings.USER_LOCK_TTL_MS):
+        self.ttl_ms = ttl_ms
+
+    async def acquire(self, user_id: str, timeout: float) -> Release:
+        key = user_lock_key(user_id)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        delay = 0.02
+        try:
+            while not await redis_memory.redis.set(key, token, nx=True, px=self.ttl_ms):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.sleep(min(remaining, random.uniform(delay / 2, delay)))
+                delay = min(delay * 2, 0.2)
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            logger.warning("获取用户锁失败，直接放行: {}", e)
+            return _noop
+
+        renew_task = asyncio.create_task(self._renew(key, token))
+
+        async def release():
+            renew_task.cancel()
+            try:
+                await redis_memory.redis.eval(RELEASE_SCRIPT, 1, key, token)
+            except Exception as e:
+                logger.warning("释放用户锁失败，将在TTL后自动释放: {}", e)
+
+        return release
+
+    async def _renew(self, key: str, token: str):
+        while True:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            try:
+                if not await redis_memory.redis.eval(RENEW_SCRIPT, 1, key, token, self.ttl_ms):
+                    logger.warning("用户锁已失效: {}", key)
+                    return
+            except Exception as e:
+                logger.warning("续期用户锁失败: {}", e)
+
+
+class NoUserLock:
+    async def acquire(self, user_id: str, timeout: float) -> Release:
+        return _noop
+
+
+USER_LOCKS = {"local": LocalUserLock, "redis": RedisUserLock, "none": NoUserLock}
+
+
+class Ticket:
+    """一次被接纳的请求，release可以重复调用"""
+
+    def __init__(self, semaphore: asyncio.Semaphore, release_user: Release):
+        self._semaphore = semaphore
+        self._release_user = release_user
+        self._slot_released = False
+        self._released = False
+
+    async def release(self):
+        if self._released:
+            return
+        if not self._slot_released:
+            self._slot_released = True
+            self._semaphore.release()
+        # 客户端断开时所在的scope已被取消，释放用户锁需要屏蔽取消，否则该用户的请求要等到锁过期
+        with anyio.move_on_after(RELEASE_TIMEOUT, shield=True) as scope:
+            await self._release_user()
+        if scope.cancelled_caught:
+            logger.warning("释放用户锁超时，将在TTL后自动释放")
+            return
+        self._released = True
+
+
+class AdmissionController:
+    """
+    请求准入控制:
+        - 同一用户的请求串行执行，等待超过 USER_LOCK_WAIT_TIMEOUT 返回429
+        - 全局最多 ADMISSION_MAX_IN_FLIGHT 个请求同时执行，排队的请求超过
+          ADMISSION_MAX_QUEUE 或等待超过 ADMISSION_QUEUE_TIMEOUT 时返回503，
+          过载时快速失败而不是让所有请求一起变慢
+        - 批量消息使用独立的低优先级并发池，所有批量请求合计最多 BATCH_MAX_IN_FLIGHT 条消息同时执行，
+          不占用在线请求的名额；同时执行的批量请求超过 BATCH_MAX_REQUESTS 时返回503
+    """
+
+    def __init__(
+            self,
+            max_in_flight: int = settings.ADMISSION_MAX_IN_FLIGHT,
+            max_queue: int = settings.ADMISSION_MAX_QUEUE,
+            queue_timeout: float = settings.ADMISSION_QUEUE_TIMEOUT,
+            user_lock_backend: str = settings.USER_LOCK_BACKEND,
+            batch_max_in_flight: int = settings.BATCH_MAX_IN_FLIGHT,
+            batch_max_requests: int = settings.BATCH_MAX_REQUESTS,
+    ):
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_lock = USER_LOCKS[user_lock_backend]()
+        self.waiting = 0
+        self.batch_semaphore = asyncio.Semaphore(batch_max_in_flight)
+        self.batch_max_requests = batch_max_requests
+        self.batch_requests = 0
+
+    def _reject(self, reason: str, message: str, status_code: int) -> AdmissionRejected:
+        admission_rejected_total.inc(reason=reason)
+        return AdmissionRejected(message, status_code=status_code, retry_after=settings.ADMISSION_RETRY_AFTER)
+
+    async def acquire(self, user_id: str) -> Ticket:
+        try:
+            release_user = await self.user_lock.acquire(user_id, settings.USER_LOCK_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise self._reject("user_busy", "上一条消息仍在处理中，请稍后重试", 429)
+
+        try:
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full", "服务繁忙，请稍后重试", 503)
+            start = time.perf_counter()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject("queue_timeout", "服务繁忙，请稍后重试", 503)
+            finally:
+                self.waiting -= 1
+            admission_queue_wait_seconds.observe(time.perf_counter() - start)
+        except BaseException:
+            await release_user()
+            raise
+
+        return Ticket(self.semaphore, release_user)
+
+    def acquire_batch_request(self) -> Release:
+        """批量请求开始前占用一个名额，返回的release可以重复调用"""
+        if self.batch_requests >= self.batch_max_requests:
+            raise self._reject("batch_busy", "批量任务过多，请稍后重试", 503)
+        self.batch_requests += 1
+        released = False
+
+        async def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.batch_requests -= 1
+
+        return release
+
+    async def acquire_batch_item(self, user_id: str) -> Ticket:
+        """
+        批量消息的准入: 先在低优先级并发池中排队（不超时，批量任务本来就是排队执行的），
+        拿到名额后再获取用户锁，排队期间不会阻塞该用户的在线请求
+        """
+        await self.batch_semaphore.acquire()
+        try:
+            release_user = await self.user_lock.acquire(user_id, settings.USER_LOCK_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.batch_semaphore.release()
+            raise self._reject("user_busy", "上一条消息仍在处理中，请稍后重试", 429)
+        except BaseException:
+            self.batch_semaphore.release()
+            raise
+        return Ticket(self.batch_semaphore, release_user)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str) -> AsyncIterator[Optional[Ticket]]:
+        if not settings.ADMISSION_ENABLED:
+            yield None
+            return
+        ticket = await self.acquire(user_id)
+        try:
+            yield ticket
+        finally:
+            await ticket.release()
+
+
+# 单例，全局共享
+admission_controller = AdmissionController()
+metrics_registry.add_collector(lambda: admission_queue_length.set(admission_controller.waiting))
@@ -0,0 +1,130 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from app.config import settings
+from app.logger import get_logger
+from app.admission import AdmissionRejected, admission_controller
+from app.agent.agent_chat import multi_agent_chat
+from app.agent.agent_memory import MemoryManager
+from app.agent.agent_session_store import SessionSnapshot, session_store
+from app.db.redis.session import PipelineBatcher
+from app.metrics import batch_items_total
+from app.tracing import current_request_id, start_trace
+
+logger = get_logger("agent_batch")
+
+# (user_id, query, user_language)
+BatchItem = Tuple[str, str, str]
+
+
+def _error(message: str, status: str = "error") -> Dict[str, Any]:
+    return {"response": message, "agent": "error_handler", "status": status}
+
+
+async def _run_item(
+        user_id: str, query: str, user_language: str, memory_manager: MemoryManager,
+        snapshot: Optional[SessionSnapshot],
+) -> Dict[str, Any]:
+    """
+    执行一条消息，占用批量并发池的名额并持有用户锁，与同一用户的单条请求互斥
+    预读的快照在拿到用户锁后重新校验版本，排队期间同一用户有其他请求提交时重新读取，
+    否则会用过期的state覆盖那次请求保存的state
+    """
+    ticket = None
+    if settings.ADMISSION_ENABLED:
+        try:
+            ticket = await admission_controller.acquire_batch_item(user_id)
+        except AdmissionRejected as e:
+            return _error(str(e), status="rejected")
+    try:
+        if snapshot is not None and not await session_store.is_current(user_id, snapshot):
+            logger.debug("预读的会话数据已过期，重新读取: user_id={}", user_id)
+            snapshot = None
+        return await multi_agent_chat(
+            user_id=user_id, query=query, memory_manager=memory_manager, user_language=user_language,
+            snapshot=snapshot,
+        )
+    except Exception as e:
+        logger.error("批量聊天处理失败: user_id={}, error={}", user_id, e)
+        return _error(f"抱歉，处理您的请求时出现了错误: {str(e)}")
+    finally:
+        if ticket is not None:
+            await ticket.release()
+
+
+def _item_trace(batch_id: Optional[str], index: int):
+    """每条消息开始独立的trace，通过batch.request_id关联到批量请求"""
+    if not settings.TRACING_ENABLED:
+        return nullcontext()
+    return start_trace("batch.item", **{"batch.request_id": batch_id or "", "batch.index": index})
+
+
+async def _prefetch(user_ids: List[str]) -> Dict[str, SessionSnapshot]:
+    """预读失败时退回到逐个加载"""
+    try:
+        return await session_store.bootstrap_many(user_ids)
+    except Exception as e:
+        logger.warning("批量预读会话数据失败: {}", e)
+        return {}
+
+
+async def multi_agent_chat_batch(
+        items: Sequence[BatchItem], concurrency: Optional[int] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    批量聊天函数，按完成顺序产出 {"index", "user_id", "response", "agent", "status"}:
+        - 同一用户的消息按提交顺序串行执行，不同用户最多 concurrency 个同时执行
+          （不超过 BATCH_MAX_CONCURRENCY），所有批量请求合计还受 BATCH_MAX_IN_FLIGHT 限制
+        - 每 BATCH_PREFETCH_SIZE 个用户的会话数据在一个pipeline中预读，
+          各条消息的提交（Memory追加、state、智能体）合并到共享的事务中写入
+        - 共享AgentWorkflow和Redis连接池，单条消息出错不影响其他消息
+    预读发生在获取用户锁之前，拿到用户锁后校验版本，期间有其他请求提交过时重新读取
+    每条消息使用独立的trace（batch.item），不会把上万条消息的span都累积在批量请求的trace中
+    调用方停止迭代时取消所有未完成的消息
+    """
+    concurrency = max(1, min(concurrency or settings.BATCH_CONCURRENCY, settings.BATCH_MAX_CONCURRENCY))
+    users: "OrderedDict[str, List[Tuple[int, str, str]]]" = OrderedDict()
+    for index, (user_id, query, user_language) in enumerate(items):
+        users.setdefault(user_id, []).append((index, query, user_language))
+    logger.info("开始批量对话: items={}, users={}, concurrency={}", len(items), len(users), concurrency)
+
+    batch_id = current_request_id()
+    batcher = PipelineBatcher(max_delay=settings.BATCH_WRITE_DELAY_MS / 1000)
+    # 预读最多领先执行一个窗口，避免历史在排队期间过期太久
+    pending: asyncio.Queue = asyncio.Queue(maxsize=settings.BATCH_PREFETCH_SIZE)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        user_ids = list(users)
+        for start in range(0, len(user_ids), settings.BATCH_PREFETCH_SIZE):
+            window = user_ids[start:start + settings.BATCH_PREFETCH_SIZE]
+            histories = await _prefetch(window)
+            for user_id in window:
+                await pending.put((user_id, histories.get(user_id)))
+        for _ in range(concurrency):
+            await pending.put(None)
+
+    async def work():
+        while (job := await pending.get()) is not None:
+            user_id, snapshot = job
+            for n, (index, query, user_language) in enumerate(users[user_id]):
+                # 预读的会话数据只对该用户的第一条消息有效
+                memory_manager = MemoryManager(user_id=user_id, batcher=batcher)
+                with _item_trace(batch_id, index):
+                    result = await _run_item(
+                        user_id, query, user_language, memory_manager, snapshot if n == 0 else None
+                    )
+                batch_items_total.inc(status=result["status"])
+                await results.put({"index": index, "user_id": user_id, **result})
+
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+        logger.info("批量对话完成: items={}, redis写入往返={}", len(items), batcher.round_trips)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,148 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, similarity
+
+from app.config import settings
+from app.logger import get_logger
+
+logger = get_logger("agent_cache")
+
+# 只缓存按模版回复、不调用工具、不依赖用户状态的智能体
+STATELESS_AGENTS = {"订阅与付费智能体", "故障排查智能体"}
+
+_PUNCTUATION_RE = re.compile(r"[\W_]+", re.UNICODE)
+# 中日韩文字（汉字、假名、谚文）一个字算一个词
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def normalize_query(query: str) -> str:
+    """统一全角半角、大小写，去掉标点和空白"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    return _PUNCTUATION_RE.sub("", query)
+
+
+def query_length(query: str) -> int:
+    """按词计算问题长度: 中日韩文字每个字算一个词，其他文字按空白和标点分词"""
+    query = unicodedata.normalize("NFKC", query)
+    return len(_CJK_RE.findall(query)) + len(_WORD_RE.findall(_CJK_RE.sub(" ", query)))
+
+
+@dataclass
+class CachedResponse:
+    response: str
+    agent: str
+    expires_at: float
+    embedding: Optional[List[float]] = field(default=None, repr=False)
+
+
+class ResponseCache:
+    """
+    按 (语言, 归一化问题) 缓存模版类智能体的回复，带TTL和LRU淘汰
+    配置embed_model后，精确匹配未命中时再按向量相似度查找
+    key中不包含上下文，调用方只能在没有任何上下文的首轮对话中读写缓存
+    """
+
+    def __init__(
+            self,
+            max_size: int = settings.RESPONSE_CACHE_MAX_SIZE,
+            ttl: int = settings.RESPONSE_CACHE_TTL,
+            embed_model: Optional[BaseEmbedding] = None,
+            similarity_threshold: float = settings.RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.embed_model = embed_model
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[str, str], CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(query: str) -> bool:
+        """过短的问题（如"是的"、"还是不行"）依赖上下文，不参与缓存"""
+        return query_length(query) >= settings.RESPONSE_CACHE_MIN_QUERY_LENGTH
+
+    async def get(self, user_language: str, query: str) -> Optional[CachedResponse]:
+        if not self.cacheable(query):
+            return None
+        key = (user_language, normalize_query(query))
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._lookup(key, now)
+        if entry is None and self.embed_model is not None:
+            embedding = await self.embed_model.aget_query_embedding(query)
+            with self._lock:
+                entry = self._lookup_similar(user_language, embedding, now)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    async def put(self, user_language: str, query: str, response: str, agent: str):
+        if agent not in STATELESS_AGENTS or not response or not self.cacheable(query):
+            return
+        embedding = None
+        if self.embed_model is not None:
+            embedding = await self.embed_model.aget_query_embedding(query)
+
+        key = (user_language, normalize_query(query))
+        with self._lock:
+            self._entries[key] = CachedResponse(
+                response=response, agent=agent, expires_at=time.monotonic() + self.ttl, embedding=embedding
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, key: Tuple[str, str], now: float) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _lookup_similar(self, user_language: str, embedding: List[float], now: float) -> Optional[CachedResponse]:
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if key[0] != user_language or entry.embedding is None or entry.expires_at < now:
+                continue
+            score = similarity(embedding, entry.embedding)
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# 单例，全局共享
+response_cache = ResponseCache()
@@ -1,63 +1,332 @@
-from typing import Dict, Any
+import asyncio
+import time
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 
+import anyio
+from llama_index.core.memory import Memory
 from llama_index.core.workflow import Context
-from llama_index.core.agent.workflow import AgentOutput, ToolCall, ToolCallResult
+from llama_index.core.workflow.handler import WorkflowHandler
+from llama_index.core.agent.workflow import AgentInput, AgentOutput, AgentStream, ToolCall, ToolCallResult
 from llama_index.core.llms import ChatMessage, MessageRole
 
+from app.config import settings
 from app.logger import get_logger
-from app.agent.agent_memory import MemoryManager
-from app.agent.agent_init import AgentInit
+from app.agent.agent_cache import response_cache
+from app.agent.agent_memory import MemoryManager, history_cache
+from app.agent.agent_init import workflow_registry
+from app.agent.agent_llm_pool import PROVIDER_KEY
+from app.agent.agent_prerouter import pre_router, ROUTER_AGENT
+from app.agent.agent_session_store import SessionSnapshot, session_store
+from app.agent.agent_state import ctx_state_store
+from app.db.redis.session import RoundTripCounter, track_round_trips
+from app.metrics import (
+    agent_responses_total, cache_bytes, cache_entries, cache_requests_total, llm_tokens_per_turn, llm_tokens_total,
+    metrics_registry, redis_round_trips_per_turn, tool_call_duration_seconds, tool_calls_total,
+    workflow_entries_total,
+)
+from app.tracing import Span, start_span
 
 logger = get_logger("agent_chat")
 
+# 客户端断开后停止工作流并保存本轮数据的最长时间(秒)
+STREAM_CLEANUP_TIMEOUT = 10
 
-async def multi_agent_chat(
-        user_id: str, query: str, memory_manager: MemoryManager, user_language: str
-) -> Dict[str, Any]:
+
+def _collect_cache_sizes():
+    cache_entries.set(response_cache.stats()["size"], cache="response")
+    cache_entries.set(len(workflow_registry), cache="workflow")
+    history_stats = history_cache.stats()
+    cache_entries.set(history_stats["size"], cache="history")
+    cache_bytes.set(history_stats["bytes"], cache="history")
+
+
+metrics_registry.add_collector(_collect_cache_sizes)
+
+
+def token_usage(raw: Any) -> Tuple[int, int]:
+    """从LLM原始响应中读取 (输入token数, 输出token数)，兼容Gemini和Ollama"""
+    if not isinstance(raw, dict):
+        return 0, 0
+    usage = raw.get("usage_metadata") or raw.get("usage") or {}
+    prompt_tokens = usage.get("prompt_token_count") or usage.get("prompt_tokens") or raw.get("prompt_eval_count")
+    completion_tokens = (
+            usage.get("candidates_token_count") or usage.get("completion_tokens") or raw.get("eval_count")
+    )
+    return prompt_tokens or 0, completion_tokens or 0
+
+
+def cached_tokens(raw: Any) -> int:
+    """输入token中命中上下文缓存的部分，目前只有Gemini返回"""
+    if not isinstance(raw, dict):
+        return 0
+    usage = raw.get("usage_metadata") or {}
+    return usage.get("cached_content_token_count") or 0
+
+
+class WorkflowObserver:
     """
-    非流式聊天函数，返回完整的聊天响应
+    把stream_events()中的事件转换为span和指标:
+        - llm.router / llm.specialist: 从AgentInput到AgentOutput，即一次智能体LLM调用，并统计token用量
+          （cached为输入token中命中上下文缓存的部分）
+        - handoff: 从调用handoff工具到下一个智能体开始
+        - tool: 从ToolCall到ToolCallResult，并统计工具调用次数和耗时
     """
-    logger.info(
-        f"开始非流式对话 user_id={user_id}, query={query}, user_language={user_language}"
-    )
 
-    # 初始化Memory并加载历史对话
-    memory = await memory_manager.init_memory()
-    logger.info(f"初始化Memory完成，用户ID: {user_id}")
+    def __init__(self):
+        self.llm_span: Optional[Span] = None
+        self.handoff_span: Optional[Span] = None
+        self.tool_spans: Dict[str, Span] = {}
+        self.tool_started: Dict[str, float] = {}
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._closed = False
+
+    def on_event(self, event):
+        if isinstance(event, AgentInput):
+            self._end_llm()
+            if self.handoff_span:
+                self.handoff_span.set(to_agent=event.current_agent_name)
+                self.handoff_span.end()
+                self.handoff_span = None
+            name = "llm.router" if event.current_agent_name == ROUTER_AGENT else "llm.specialist"
+            self.llm_span = start_span(name, agent=event.current_agent_name)
+
+        elif isinstance(event, AgentOutput):
+            prompt_tokens, completion_tokens = token_usage(event.raw)
+            cached = cached_tokens(event.raw)
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached
+            self.completion_tokens += completion_tokens
+            llm_tokens_total.inc(prompt_tokens, agent=event.current_agent_name, kind="prompt")
+            llm_tokens_total.inc(cached, agent=event.current_agent_name, kind="cached")
+            llm_tokens_total.inc(completion_tokens, agent=event.current_agent_name, kind="completion")
+            logger.debug("LLM调用: agent={}, prompt_tokens={}, cached_tokens={}, completion_tokens={}",
+                         event.current_agent_name, prompt_tokens, cached, completion_tokens)
+            if self.llm_span:
+                self.llm_span.set(tool_calls=len(event.tool_calls), prompt_tokens=prompt_tokens,
+                                  cached_tokens=cached, completion_tokens=completion_tokens)
+                if isinstance(event.raw, dict) and PROVIDER_KEY in event.raw:
+                    self.llm_span.set(provider=event.raw[PROVIDER_KEY])
+            self._end_llm()
+
+        elif isinstance(event, ToolCallResult):
+            started = self.tool_started.pop(event.tool_id, None)
+            if started is not None:
+                tool_call_duration_seconds.observe(time.perf_counter() - started, tool=event.tool_name)
+            tool_calls_total.inc(tool=event.tool_name, status="error" if event.tool_output.is_error else "ok")
+
+            tool_span = self.tool_spans.pop(event.tool_id, None)
+            if tool_span and tool_span.name == "handoff":
+                # handoff在下一个智能体开始时结束
+                self.handoff_span = tool_span
+            elif tool_span:
+                tool_span.end(error=event.tool_output.content if event.tool_output.is_error else None)
+
+        elif isinstance(event, ToolCall):
+            self.tool_started[event.tool_id] = time.perf_counter()
+            tool_span = start_span("handoff" if event.tool_name == "handoff" else "tool", tool=event.tool_name)
+            if tool_span:
+                self.tool_spans[event.tool_id] = tool_span
+
+    def _end_llm(self):
+        if self.llm_span:
+            self.llm_span.end()
+            self.llm_span = None
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._end_llm()
+        for tool_span in [self.handoff_span, *self.tool_spans.values()]:
+            if tool_span:
+                tool_span.end()
+        self.handoff_span = None
+        self.tool_spans.clear()
+        if self.prompt_tokens or self.completion_tokens:
+            llm_tokens_per_turn.observe(self.prompt_tokens, kind="prompt")
+            llm_tokens_per_turn.observe(self.cached_tokens, kind="cached")
+            llm_tokens_per_turn.observe(self.completion_tokens, kind="completion")
+            llm_tokens_per_turn.observe(self.prompt_tokens + self.completion_tokens, kind="total")
+
+
+def _select_root_agent(query: str, last_agent: Optional[str] = None, has_history: bool = False) -> str:
+    """
+    选择工作流的入口智能体:
+        1. 窗口内的追问由上一轮的专业智能体继续，用户明确表示换话题时交给路由智能体；
+           没有明确表示的其他分类问题由该智能体通过handoff转交回路由智能体
+        2. 否则预路由置信度足够高时直接进入对应的专业智能体（已有历史时不处理依赖上文的追问）
+        3. 否则由路由智能体处理
+    """
+    if last_agent:
+        if not pre_router.is_topic_change(query):
+            logger.info("继续上一轮的智能体: {}", last_agent)
+            workflow_entries_total.inc(source="session")
+            return last_agent
+        logger.info("用户换话题，交给路由智能体: last_agent={}", last_agent)
+    elif settings.PREROUTER_ENABLED:
+        decision = pre_router.route(query, has_history=has_history)
+        if decision.agent:
+            logger.info("预路由命中: {}, source={}, confidence={:.2f}", decision.agent, decision.source, decision.confidence)
+            workflow_entries_total.inc(source=decision.source)
+            return decision.agent
+    workflow_entries_total.inc(source="router")
+    return ROUTER_AGENT
+
+
+async def _record_routing(query: str, root_agent: str, current_agent: str):
+    """记录路由智能体的决策，用于训练预路由模型"""
+    if root_agent == ROUTER_AGENT and current_agent != ROUTER_AGENT:
+        await pre_router.record(query, current_agent)
+
+
+async def _read_state(handler: Optional[WorkflowHandler]) -> Optional[Dict[str, Any]]:
+    """读取本轮工具收集的state，出错时只记录日志"""
+    if not settings.CTX_STATE_ENABLED or handler is None:
+        return None
+    try:
+        return await handler.ctx.get("state")
+    except Exception as e:
+        logger.warning("读取工作流state失败: {}", e)
+        return None
+
+
+async def _commit(
+        memory_manager: MemoryManager, memory: Memory, handler: Optional[WorkflowHandler],
+        loaded_state: Dict[str, Any], agent: Optional[str] = None,
+):
+    """在一个事务中保存本轮新增的消息、state和回复的智能体（agent为None时不修改），出错时不能重试"""
+    messages, state = await _collect_turn(memory_manager, memory, handler)
+    await session_store.commit(memory_manager, messages, agent=agent, state=state, loaded_state=loaded_state)
+
+
+async def _collect_turn(
+        memory_manager: MemoryManager, memory: Memory, handler: Optional[WorkflowHandler]
+) -> Tuple[List[ChatMessage], Optional[Dict[str, Any]]]:
+    """读取本轮新增的消息和state"""
+    return await asyncio.gather(memory_manager.new_messages(memory), _read_state(handler))
+
+
+def _observe_round_trips(counter: RoundTripCounter, path: str):
+    redis_round_trips_per_turn.observe(counter.count, path=path)
+    logger.debug("本轮Redis往返次数: {}, path={}", counter.count, path)
+
+
+async def _start_workflow(
+        user_id: str, query: str, memory_manager: MemoryManager, user_language: str,
+        snapshot: Optional[SessionSnapshot] = None,
+) -> Tuple[WorkflowHandler, Memory, str, Dict[str, Any], bool]:
+    """
+    加载Memory、获取AgentWorkflow并启动运行，返回handler、memory、入口智能体、恢复的state
+    以及本轮开始时是否没有任何上下文（只有这样的回复可以放入回复缓存）
+    snapshot为批量处理时预先读取的会话数据，没有时在一次pipeline中读取
+    """
+    # 一次往返读取历史对话、摘要、上一轮的智能体和工作流state
+    snapshot = snapshot or await session_store.bootstrap(user_id)
+    memory = await memory_manager.init_memory(
+        history=snapshot.history, summary=snapshot.summary, version=snapshot.version, profile=snapshot.profile
+    )
+    state = snapshot.state
+    logger.debug("初始化Memory完成，用户ID: {}", user_id)
 
-    # 根据用户语言，初始化Agent
-    client = AgentInit(user_language=user_language)
-    agent_workflow = client.create_multi_agent_system()
+    # 根据用户语言、预路由结果和上一轮的智能体，获取共享的AgentWorkflow
+    root_agent = _select_root_agent(query, snapshot.last_agent, has_history=snapshot.history[0] > 0)
+    agent_workflow = workflow_registry.get(user_language, root_agent)
 
     # 初始化Context
     ctx = Context(agent_workflow)
     await ctx.set("user_id", user_id)
     await ctx.set("memory", memory)
+    # 每次请求使用独立的state，避免共享的AgentWorkflow的initial_state被修改
+    await ctx.set("state", ctx_state_store.snapshot(state))
+
+    handler = agent_workflow.run(user_msg=ChatMessage(content=query), ctx=ctx, verbose=settings.AGENT_WORKFLOW_VERBOSE, memory=memory)
+    return handler, memory, root_agent, state, snapshot.is_fresh()
+
+
+async def _reply_from_cache(
+        query: str, memory_manager: MemoryManager, user_language: str
+) -> Optional[Dict[str, Any]]:
+    """
+    命中回复缓存时直接返回，并把本轮对话追加到历史中，跳过Memory加载和所有LLM调用
+    缓存的回复不包含上下文，用户已有历史、摘要、state或档案时不使用
+    """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    cached = await response_cache.get(user_language, query)
+    if cached is not None and await session_store.has_context(memory_manager.user_id):
+        cache_requests_total.inc(cache="response", result="context")
+        return None
+    cache_requests_total.inc(cache="response", result="miss" if cached is None else "hit")
+    if cached is None:
+        return None
+
+    logger.info("命中回复缓存, agent={}", cached.agent)
+    await session_store.commit(memory_manager, [
+        ChatMessage(role=MessageRole.USER, content=query),
+        ChatMessage(role=MessageRole.ASSISTANT, content=cached.response),
+    ], agent=cached.agent)
+    agent_responses_total.inc(agent=cached.agent, source="cache")
+    return {"response": cached.response, "agent": cached.agent, "status": "success"}
+
+
+async def _update_cache(query: str, user_language: str, response: str, agent: str, used_tools: bool, fresh: bool):
+    """只缓存首轮对话中没有调用工具的模版类智能体回复"""
+    if settings.RESPONSE_CACHE_ENABLED and fresh and not used_tools:
+        await response_cache.put(user_language, query, response, agent)
+
+
+async def multi_agent_chat(
+        user_id: str, query: str, memory_manager: MemoryManager, user_language: str,
+        snapshot: Optional[SessionSnapshot] = None,
+) -> Dict[str, Any]:
+    """
+    非流式聊天函数，返回完整的聊天响应
+    """
+    logger.debug("开始非流式对话 user_id={}, query={}, user_language={}", user_id, query, user_language)
+    round_trips = track_round_trips()
+
+    cached_response = await _reply_from_cache(query=query, memory_manager=memory_manager, user_language=user_language)
+    if cached_response is not None:
+        _observe_round_trips(round_trips, "cache")
+        return cached_response
+
+    handler, memory, root_agent, loaded_state, fresh = await _start_workflow(
+        user_id=user_id, query=query, memory_manager=memory_manager, user_language=user_language, snapshot=snapshot
+    )
 
     # 运行Agent工作流 - 非流式处理
     response_content = ""
     current_agent = ""
+    used_tools = False
+    # 提交出错时结果未知，已经尝试过提交就不能再提交，否则会重复追加消息
+    commit_attempted = False
+    observer = WorkflowObserver()
     try:
-        # 添加助手响应到Memory
-        handler = agent_workflow.run(user_msg=ChatMessage(content=query), ctx=ctx, verbose=True, memory=memory)
         async for event in handler.stream_events():
+            observer.on_event(event)
             if isinstance(event, AgentOutput):
-                logger.debug(f"AgentOutput: {event.current_agent_name}")
-                logger.debug(f"AgentOutput: {event.response.content}")
+                logger.debug("AgentOutput: {}, {}", event.current_agent_name, event.response.content)
                 if event.response.role == "assistant":
                     response_content = event.response.content
                     current_agent = event.current_agent_name
 
             if isinstance(event, ToolCall):
-                logger.debug(f"ToolCall: {event.tool_name}")
-                logger.debug(f"ToolCall: {event.tool_kwargs}")
+                logger.debug("ToolCall: {}, {}", event.tool_name, event.tool_kwargs)
+                used_tools = used_tools or event.tool_name != "handoff"
             if isinstance(event, ToolCallResult):
-                logger.debug(f"ToolCallResult: {event.tool_name}")
-                logger.debug(f"ToolCallResult: {event.tool_output}")
+                logger.debug("ToolCallResult: {}, {}", event.tool_name, event.tool_output)
+        observer.close()
 
-        await memory_manager.save_memory_to_redis(memory)
+        commit_attempted = True
+        await _commit(memory_manager, memory, handler, loaded_state, agent=current_agent)
+        await _update_cache(query, user_language, response_content, current_agent, used_tools, fresh)
+        _observe_round_trips(round_trips, "workflow")
+        await _record_routing(query, root_agent, current_agent)
 
-        logger.info(f"Response content: {response_content}")
+        logger.debug("Response content: {}", response_content)
+        agent_responses_total.inc(agent=current_agent, source="workflow")
         return {
             "response": response_content,
             "agent": current_agent,
@@ -65,16 +334,135 @@ async def multi_agent_chat(
         }
 
     except Exception as e:
-        logger.error(f"Agent执行出错: {str(e)}")
+        logger.error("Agent执行出错: {}", e)
+        observer.close()
+        agent_responses_total.inc(agent="error_handler", source="workflow")
 
-        # 即使出错也要保存Memory
-        try:
-            await memory_manager.save_memory_to_redis(memory)
-        except Exception as save_error:
-            logger.error(f"保存Memory失败: {str(save_error)}")
+        # 工作流出错时也要保存Memory和已收集的state
+        if not commit_attempted:
+            try:
+                await _commit(memory_manager, memory, handler, loaded_state)
+            except Exception as save_error:
+                logger.error("保存Memory失败: {}", save_error)
+        _observe_round_trips(round_trips, "workflow")
 
         return {
             "response": f"抱歉，处理您的请求时出现了错误: {str(e)}",
             "agent": "error_handler",
             "status": "error"
         }
+
+
+async def multi_agent_chat_stream(
+        user_id: str, query: str, memory_manager: MemoryManager, user_language: str
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    流式聊天函数，按到达顺序产出事件:
+        - delta: LLM输出的token增量
+        - handoff: 当前处理的智能体发生切换
+        - tool_call / tool_result: 工具调用及其结果
+        - done: 最终响应
+        - error: 处理出错
+    Memory、state和回复的智能体在结束时（包括出错和客户端断开）在一个事务中统一保存，只提交一次
+    """
+    logger.debug("开始流式对话 user_id={}, query={}, user_language={}", user_id, query, user_language)
+    round_trips = track_round_trips()
+
+    memory = None
+    handler = None
+    loaded_state = None
+    # 正常完成时才记录回复的智能体
+    completed_agent = None
+    response_content = ""
+    current_agent = ""
+    used_tools = False
+    observer = WorkflowObserver()
+    try:
+        cached_response = await _reply_from_cache(
+            query=query, memory_manager=memory_manager, user_language=user_language
+        )
+        if cached_response is not None:
+            _observe_round_trips(round_trips, "cache")
+            yield {"event": "delta", "data": {"agent": cached_response["agent"], "delta": cached_response["response"]}}
+            yield {"event": "done", "data": cached_response}
+            return
+
+        handler, memory, root_agent, loaded_state, fresh = await _start_workflow(
+            user_id=user_id, query=query, memory_manager=memory_manager, user_language=user_language
+        )
+        async for event in handler.stream_events():
+            observer.on_event(event)
+            if isinstance(event, AgentInput):
+                if event.current_agent_name != current_agent:
+                    if current_agent:
+                        yield {"event": "handoff", "data": {"from": current_agent, "to": event.current_agent_name}}
+                    current_agent = event.current_agent_name
+
+            elif isinstance(event, AgentStream):
+                if event.delta:
+                    yield {"event": "delta", "data": {"agent": event.current_agent_name, "delta": event.delta}}
+
+            elif isinstance(event, AgentOutput):
+                if event.response.role == MessageRole.ASSISTANT:
+                    response_content = event.response.content
+                    current_agent = event.current_agent_name
+
+            elif isinstance(event, ToolCallResult):
+                yield {
+                    "event": "tool_result",
+                    "data": {"tool_name": event.tool_name, "tool_output": event.tool_output.content},
+                }
+
+            elif isinstance(event, ToolCall):
+                used_tools = used_tools or event.tool_name != "handoff"
+                yield {"event": "tool_call", "data": {"tool_name": event.tool_name, "tool_kwargs": event.tool_kwargs}}
+
+        completed_agent = current_agent
+        await _update_cache(query, user_language, response_content, current_agent, used_tools, fresh)
+        await _record_routing(query, root_agent, current_agent)
+        logger.debug("Response content: {}", response_content)
+        agent_responses_total.inc(agent=current_agent, source="workflow")
+        yield {"event": "done", "data": {"response": response_content, "agent": current_agent, "status": "success"}}
+
+    except Exception as e:
+        logger.error("Agent流式执行出错: {}", e)
+        agent_responses_total.inc(agent="error_handler", source="workflow")
+        yield {
+            "event": "error",
+            "data": {
+                "response": f"抱歉，处理您的请求时出现了错误: {str(e)}",
+                "agent": "error_handler",
+                "status": "error",
+            },
+        }
+
+    finally:
+        observer.close()
+        # 客户端断开时Starlette会取消生成器所在的scope，清理需要屏蔽取消，否则停止工作流和保存都会被取消
+        with anyio.move_on_after(STREAM_CLEANUP_TIMEOUT, shield=True) as cleanup:
+            # 先读取本轮的消息和state: 取消工作流可能打断Memory正在执行的数据库操作，之后Memory不再可读
+            turn = None
+            if memory is not None:
+                try:
+                    turn = await _collect_turn(memory_manager, memory, handler)
+                except Exception as read_error:
+                    logger.error("读取本轮消息失败: {}", read_error)
+
+            # 客户端提前断开时，停止仍在运行的工作流
+            if handler is not None and not handler.is_done():
+                try:
+                    await handler.cancel_run()
+                except Exception as cancel_error:
+                    logger.error("取消工作流失败: {}", cancel_error)
+
+            if turn is not None:
+                messages, state = turn
+                try:
+                    await session_store.commit(
+                        memory_manager, messages, agent=completed_agent, state=state, loaded_state=loaded_state
+                    )
+                except Exception as save_error:
+                    logger.error("保存Memory失败: {}", save_error)
+                _observe_round_trips(round_trips, "workflow")
+        if cleanup.cancelled_caught:
+            logger.error("流式对话结束后的清理超时: user_id={}", user_id)
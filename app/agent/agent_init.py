@@ -1,31 +1,34 @@
+import threading
+from collections import OrderedDict
+from typing import Dict
+
 from llama_index.core.agent.workflow import FunctionAgent, AgentWorkflow
 
+from app.config import settings
 from app.logger import get_logger
 from app.agent import agent_llms
+from app.agent.agent_prerouter import ROUTER_AGENT
 from app.agent.agent_tools import adjust_plan_tool, update_basic_information_tool
+from app.metrics import cache_requests_total
 
 logger = get_logger("agents")
 
-llm = agent_llms.gemini_llm()
-
-
-class AgentInit:
-    def __init__(self, user_language: str = "zh"):
-        self.user_language = user_language
+llm = agent_llms.get_llm()
 
-        self.end_shared_prompt = f"""
-2. 你必须使用 *{self.user_language}* 进行输出（这很重要！！！）
-3. 如果回复模版中的文本内容与 *{self.user_language}* 不同，先翻译为 *{self.user_language}* ，再回复用户
 
+# 系统提示词 = 静态前缀 + 语言尾部
+# 静态前缀与用户、语言无关，所有请求逐字节相同，可以命中Gemini的隐式上下文缓存；
+# 随语言变化的内容只放在最后，不破坏前缀
+FORBIDDEN_PROMPT = """
 禁止行为，必须严格遵守: 
 1. 禁止告知用户你是一个智能体
 2. 禁止告知用户你的执行逻辑，包括但不限于Agent的调用逻辑
 3. 禁止告知用户你的名字，除非用户询问
 4. 禁止以 `Sarah: xxx`、`Assistant: xxx`、`AI: xxx` 或者任何类似的格式进行输出(这很重要)
 5. 直接回复用户内容，不要添加任何角色标识前缀
-        """
+"""
 
-        self.router_agent_prompt = f"""
+ROUTER_AGENT_PROMPT = """
 你是名为Sarah的AI Coach系统的主协调智能体。
 你的职责是分析用户的问题，并将其路由到合适的专业智能体处理。
 
@@ -78,10 +81,10 @@ class AgentInit:
     目标智能体: [目标智能体名称]
     handoff原因: [为什么需要路由到该智能体]
     ```
-{self.end_shared_prompt}
-        """
+""" + FORBIDDEN_PROMPT
 
-        self.health_advice_prompt = f"""
+
+HEALTH_ADVICE_PROMPT = """
 你是名为Sarah的AI Coach系统中的*健康与康复建议智能体*。
 你是一位专业的健康顾问和老年健身教练，负责回答用户任何有关身体健康、运动健身、睡眠、营养、心理健康等全方位健康问题。
 
@@ -133,10 +136,10 @@ class AgentInit:
     
 注意: 
 1. 保持友善、耐心和专业的态度。确保所有建议都适合老年人，并优先考虑用户的安全和健康，对于健康问题，始终强调预防胜于治疗，鼓励用户养成良好的生活习惯。
-{self.end_shared_prompt}
-        """
+""" + FORBIDDEN_PROMPT
 
-        self.subscription_prompt = f"""
+
+SUBSCRIPTION_PROMPT = """
 你是名为Sarah的AI Coach系统中的*订阅支持智能体*。你负责处理用户的所有订阅相关问题和咨询。
 
 请按照以下步骤操作: 
@@ -162,10 +165,10 @@ class AgentInit:
 
 注意: 
 1. 保持友善、耐心和专业的态度。避免使用技术术语，确保用户能够理解你的指导。 
-{self.end_shared_prompt}
-        """
+""" + FORBIDDEN_PROMPT
+
 
-        self.troubleshooting_prompt = f"""
+TROUBLESHOOTING_PROMPT = """
 你是名为Sarah的AI Coach系统中的*技术支持智能体*。你负责解决用户在使用App过程中遇到的各种技术问题和故障。
 
 请按照以下步骤操作: 
@@ -187,10 +190,10 @@ class AgentInit:
 
 注意: 
 1. 保持友善、耐心和专业的态度。使用通俗易懂的语言解释技术问题，避免使用过多的技术术语。确保用户能够理解并执行每个排查步骤。 
-{self.end_shared_prompt}
-        """
+""" + FORBIDDEN_PROMPT
+
 
-        self.refit_prompt = f"""
+REFIT_PROMPT = """
 你是名为Sarah的AI Coach系统中的*个人定制智能体*。
 你是一位专业的老年健身教练，负责帮助用户修改 workout plan、basic information。
 
@@ -270,8 +273,35 @@ class AgentInit:
 
 注意: 
 1. 保持友善、耐心和专业的态度。确保完整收集了用户需要修改的参数
-{self.end_shared_prompt}
-        """
+""" + FORBIDDEN_PROMPT
+
+
+def handoff_back_prompt(agent: str) -> str:
+    return f"""
+转交规则: 
+1. 你是*{agent}*，本轮对话由你直接继续处理用户上一轮的问题
+2. 如果用户的新问题不属于你的职责范围（例如从退款问题换成了身体疼痛问题），不要告知用户超出了你的专业范围，必须使用handoff工具把问题转交给"{ROUTER_AGENT}"重新分类
+"""
+
+
+def language_prompt(user_language: str) -> str:
+    return f"""
+输出语言: 
+1. 你必须使用 *{user_language}* 进行输出（这很重要！！！）
+2. 如果回复模版中的文本内容与 *{user_language}* 不同，先翻译为 *{user_language}* ，再回复用户
+"""
+
+
+class AgentInit:
+    def __init__(self, user_language: str = "zh"):
+        self.user_language = user_language
+
+        self.language_prompt = language_prompt(self.user_language)
+        self.router_agent_prompt = ROUTER_AGENT_PROMPT + self.language_prompt
+        self.health_advice_prompt = HEALTH_ADVICE_PROMPT + self.language_prompt
+        self.subscription_prompt = SUBSCRIPTION_PROMPT + self.language_prompt
+        self.troubleshooting_prompt = TROUBLESHOOTING_PROMPT + self.language_prompt
+        self.refit_prompt = REFIT_PROMPT + self.language_prompt
 
     def init_router_agent(self) -> FunctionAgent:
         agent = FunctionAgent(
@@ -325,21 +355,85 @@ class AgentInit:
         )
         return agent
 
-    def create_multi_agent_system(self) -> AgentWorkflow:
+    def enable_handoff_back(self, agent: FunctionAgent):
+        """
+        入口为专业智能体（继续上一轮或预路由命中）时，允许它把不属于自己的问题转交回路由智能体，
+        否则用户在窗口内换了话题会一直被拒绝；转交规则放在静态前缀之后、语言尾部之前
+        """
+        agent.can_handoff_to = [ROUTER_AGENT]
+        agent.system_prompt = (
+                agent.system_prompt.removesuffix(self.language_prompt) + handoff_back_prompt(agent.name) + self.language_prompt
+        )
+
+    def create_multi_agent_system(self, root_agent: str = "路由智能体") -> AgentWorkflow:
         router_agent = self.init_router_agent()
         health_advice_agent = self.init_health_advice_agent()
         subscription_agent = self.init_subscription_agent()
         troubleshooting_agent = self.init_troubleshooting_agent()
         refit_agent = self.init_refit_agent()
 
+        agents = [router_agent, health_advice_agent, subscription_agent, troubleshooting_agent, refit_agent]
+        if root_agent != ROUTER_AGENT:
+            self.enable_handoff_back(next(agent for agent in agents if agent.name == root_agent))
+
         # 添加debug日志
-        logger.info(f"初始化多智能体系统, 路由智能体可以转发到: {router_agent.can_handoff_to}")
+        logger.info("初始化多智能体系统, 路由智能体可以转发到: {}", router_agent.can_handoff_to)
 
         multi_agent_system = AgentWorkflow(
-            agents=[router_agent, health_advice_agent, subscription_agent, troubleshooting_agent, refit_agent],
-            root_agent="路由智能体",
+            agents=agents,
+            root_agent=root_agent,
             initial_state={},
-            verbose=True  # 启用详细日志
+            verbose=settings.AGENT_WORKFLOW_VERBOSE  # 启用详细日志
         )
 
         return multi_agent_system
+
+
+class AgentWorkflowRegistry:
+    """
+    按语言缓存AgentWorkflow，每种语言下再按入口智能体缓存，避免每次请求重新渲染Prompt、构建Agent
+    容量按语言计算并按LRU淘汰，同一语言的各个入口智能体一起淘汰，不会因为入口组合过多而互相挤出
+    AgentWorkflow本身不保存单次运行的状态（状态都在Context中），因此可以在并发请求间共享
+    """
+
+    def __init__(self, max_size: int = settings.AGENT_WORKFLOW_CACHE_SIZE):
+        self.max_size = max_size
+        self._workflows: "OrderedDict[str, Dict[str, AgentWorkflow]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_language: str, root_agent: str = "路由智能体") -> AgentWorkflow:
+        """
+        获取指定语言的AgentWorkflow，不存在时创建，超过容量时淘汰最久未使用的语言
+        root_agent为预路由选中的专业智能体时，工作流直接从该智能体开始，跳过路由智能体
+        """
+        with self._lock:
+            workflows = self._workflows.get(user_language)
+            if workflows is None:
+                workflows = self._workflows[user_language] = {}
+                if len(self._workflows) > self.max_size:
+                    evicted, _ = self._workflows.popitem(last=False)
+                    logger.info("AgentWorkflow缓存已满，淘汰语言: {}", evicted)
+            else:
+                self._workflows.move_to_end(user_language)
+
+            workflow = workflows.get(root_agent)
+            if workflow is not None:
+                cache_requests_total.inc(cache="workflow", result="hit")
+                return workflow
+
+            cache_requests_total.inc(cache="workflow", result="miss")
+            workflow = AgentInit(user_language=user_language).create_multi_agent_system(root_agent=root_agent)
+            workflows[root_agent] = workflow
+            return workflow
+
+    def clear(self):
+        with self._lock:
+            self._workflows.clear()
+
+    def __len__(self) -> int:
+        """缓存的AgentWorkflow总数"""
+        return sum(len(workflows) for workflows in self._workflows.values())
+
+
+# 单例，全局共享
+workflow_registry = AgentWorkflowRegistry()
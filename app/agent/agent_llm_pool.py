@@ -0,0 +1,333 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.base.llms.types import (
+    ChatMessage, ChatResponse, ChatResponseAsyncGen, ChatResponseGen, CompletionResponse, CompletionResponseAsyncGen,
+    CompletionResponseGen, LLMMetadata,
+)
+from llama_index.core.llms.function_calling import FunctionCallingLLM
+from llama_index.core.llms.llm import ToolSelection
+from llama_index.core.tools import BaseTool
+from pydantic import Field, PrivateAttr
+
+from app.config import settings
+from app.logger import get_logger
+from app.metrics import (
+    llm_first_chunk_seconds, llm_hedges_total, llm_provider_calls_total, llm_provider_up, metrics_registry,
+)
+from app.resilience import CircuitBreaker
+
+logger = get_logger("agent_llm_pool")
+
+# 响应的 additional_kwargs / raw 中记录实际使用的provider
+PROVIDER_KEY = "llm_provider"
+
+
+class LLMUnavailable(Exception):
+    """所有provider都失败或超时"""
+
+
+@dataclass
+class LLMProvider:
+    name: str
+    llm: FunctionCallingLLM
+    max_concurrency: int
+    semaphore: asyncio.Semaphore = field(init=False)
+    breaker: CircuitBreaker = field(init=False)
+
+    def __post_init__(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.breaker = CircuitBreaker(settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RECOVERY_TIMEOUT)
+
+
+def _tag(response: Any, provider: str) -> Any:
+    if isinstance(getattr(response, "additional_kwargs", None), dict):
+        response.additional_kwargs[PROVIDER_KEY] = provider
+    if isinstance(getattr(response, "raw", None), dict):
+        response.raw[PROVIDER_KEY] = provider
+    return response
+
+
+class PooledLLM(FunctionCallingLLM):
+    """
+    按顺序包含多个provider的LLM（例如 gemini -> ollama），对智能体来说和单个LLM一样:
+        - 熔断中的provider被跳过；所有provider都熔断时仍按顺序尝试，避免直接失败
+        - 每个provider有独立的并发上限，排队时间计入首个chunk的等待时间
+        - 流式请求在 hedge_after 秒内没有收到首个chunk时，同时向下一个provider发起请求，
+          先返回首个chunk的一方胜出，另一方被取消；开始输出后不再切换
+        - 某个provider在输出首个chunk前出错时立即改用下一个provider
+        - 所有provider在 first_chunk_timeout 秒内都没有输出时抛出 LLMUnavailable
+    工具调用的解析交给实际生成该响应的provider。
+    """
+
+    hedge_after: float = Field(default=settings.LLM_HEDGE_AFTER_MS / 1000, description="多久没有首个chunk时对冲请求")
+    first_chunk_timeout: float = Field(default=settings.LLM_FIRST_CHUNK_TIMEOUT, description="等待首个chunk的最长时间")
+
+    _providers: List[LLMProvider] = PrivateAttr(default_factory=list)
+
+    def __init__(self, providers: Sequence[LLMProvider], **kwargs: Any):
+        if not providers:
+            raise ValueError("PooledLLM至少需要一个provider")
+        super().__init__(**kwargs)
+        self._providers = list(providers)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledLLM"
+
+    @property
+    def providers(self) -> List[LLMProvider]:
+        return self._providers
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._providers[0].llm.metadata
+
+    def _provider(self, name: Optional[str]) -> LLMProvider:
+        for provider in self._providers:
+            if provider.name == name:
+                return provider
+        return self._providers[0]
+
+    def _candidates(self) -> List[LLMProvider]:
+        # 只检查不占用探测名额，实际发起请求时才调用allow()，避免没有用到的备用provider停在半开
+        healthy = [provider for provider in self._providers if provider.breaker.available()]
+        return healthy or list(self._providers)
+
+    # ---- 异步: 对冲 + 故障转移 ----
+
+    async def _open(self, provider: LLMProvider, start: Callable[[FunctionCallingLLM], Awaitable[Any]]) -> Tuple[
+        Any, Any]:
+        """获取并发名额并等待首个结果，返回 (剩余的异步生成器或None, 首个结果)；出错时释放名额"""
+        started = time.perf_counter()
+        await provider.semaphore.acquire()
+        try:
+            result = await start(provider.llm)
+            if not hasattr(result, "__anext__"):
+                provider.semaphore.release()
+                llm_first_chunk_seconds.observe(time.perf_counter() - started, provider=provider.name)
+                return None, result
+            try:
+                first = await result.__anext__()
+            except StopAsyncIteration:
+                first = None
+            llm_first_chunk_seconds.observe(time.perf_counter() - started, provider=provider.name)
+            return result, first
+        except BaseException:
+            provider.semaphore.release()
+            raise
+
+    async def _first(self, start: Callable[[FunctionCallingLLM], Awaitable[Any]]) -> Tuple[LLMProvider, Any, Any]:
+        candidates = self._candidates()
+        pending: Dict[asyncio.Task, LLMProvider] = {}
+        errors: List[str] = []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.first_chunk_timeout
+        hedge_at = loop.time() + self.hedge_after if self.hedge_after > 0 else None
+
+        def launch():
+            provider = candidates.pop(0)
+            # 熔断中的provider成为探测请求；所有provider都熔断时allow()返回False，仍然发起请求
+            provider.breaker.allow()
+            pending[asyncio.create_task(self._open(provider, start))] = provider
+
+        launch()
+        timed_out: List[LLMProvider] = []
+        try:
+            while pending:
+                now = loop.time()
+                if now >= deadline:
+                    timed_out = list(pending.values())
+                    break
+                wait_until = deadline
+                if hedge_at is not None and candidates:
+                    wait_until = min(wait_until, hedge_at)
+                done, _ = await asyncio.wait(pending, timeout=max(wait_until - now, 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at is not None and candidates and loop.time() >= hedge_at:
+                        # 只对冲一次，之后仅在出错时故障转移
+                        hedge_at = None
+                        llm_hedges_total.inc(provider=candidates[0].name)
+                        logger.info("首个chunk超过{:.1f}s未返回，对冲请求: {}", self.hedge_after, candidates[0].name)
+                        launch()
+                    continue
+
+                winner = None
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        provider.breaker.record_failure()
+                        llm_provider_calls_total.inc(provider=provider.name, result="error")
+                        errors.append(f"{provider.name}: {type(error).__name__}: {error}")
+                        logger.warning("LLM provider {} 失败: {}", provider.name, error)
+                    elif winner is None:
+                        winner = (provider, *task.result())
+                    else:
+                        await self._discard(provider, *task.result())
+                if winner is not None:
+                    winner[0].breaker.record_success()
+                    llm_provider_calls_total.inc(provider=winner[0].name, result="ok")
+                    return winner
+                if not pending and candidates:
+                    launch()
+        finally:
+            for task, provider in pending.items():
+                task.cancel()
+            if pending:
+                results = await asyncio.gather(*pending, return_exceptions=True)
+                for (task, provider), result in zip(pending.items(), results):
+                    if isinstance(result, tuple):
+                        await self._discard(provider, *result)
+                    elif provider not in timed_out:
+                        # 被取消的探测请求没有结果，交还探测名额
+                        provider.breaker.release_probe()
+                        llm_provider_calls_total.inc(provider=provider.name, result="cancelled")
+
+        for provider in timed_out:
+            provider.breaker.record_failure()
+            llm_provider_calls_total.inc(provider=provider.name, result="timeout")
+            errors.append(f"{provider.name}: 首个chunk超时")
+        raise LLMUnavailable("所有LLM provider都不可用: " + "; ".join(errors))
+
+    @staticmethod
+    async def _discard(provider: LLMProvider, stream: Any, first: Any):
+        """关闭对冲中落败的一方"""
+        provider.breaker.release_probe()
+        llm_provider_calls_total.inc(provider=provider.name, result="cancelled")
+        if stream is not None:
+            try:
+                await stream.aclose()
+            except Exception:
+                pass
+            provider.semaphore.release()
+
+    @staticmethod
+    async def _relay(provider: LLMProvider, stream: Any, first: Any) -> AsyncGenerator[Any, None]:
+        try:
+            if first is not None:
+                yield _tag(first, provider.name)
+            async for response in stream:
+                yield _tag(response, provider.name)
+        finally:
+            provider.semaphore.release()
+
+    async def _astream(self, start: Callable[[FunctionCallingLLM], Awaitable[Any]]) -> AsyncGenerator[Any, None]:
+        provider, stream, first = await self._first(start)
+        return self._relay(provider, stream, first)
+
+    async def _acall(self, start: Callable[[FunctionCallingLLM], Awaitable[Any]]) -> Any:
+        provider, _, response = await self._first(start)
+        return _tag(response, provider.name)
+
+    async def astream_chat_with_tools(self, tools: Sequence[BaseTool], *args: Any, **kwargs: Any) -> ChatResponseAsyncGen:
+        return await self._astream(lambda llm: llm.astream_chat_with_tools(tools, *args, **kwargs))
+
+    async def achat_with_tools(self, tools: Sequence[BaseTool], *args: Any, **kwargs: Any) -> ChatResponse:
+        return await self._acall(lambda llm: llm.achat_with_tools(tools, *args, **kwargs))
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return await self._astream(lambda llm: llm.astream_chat(messages, **kwargs))
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return await self._acall(lambda llm: llm.achat(messages, **kwargs))
+
+    async def astream_complete(self, prompt: str, formatted: bool = False,
+                               **kwargs: Any) -> CompletionResponseAsyncGen:
+        return await self._astream(lambda llm: llm.astream_complete(prompt, formatted=formatted, **kwargs))
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return await self._acall(lambda llm: llm.acomplete(prompt, formatted=formatted, **kwargs))
+
+    # ---- 同步: 只做顺序故障转移 ----
+
+    def _call(self, start: Callable[[FunctionCallingLLM], Any]) -> Any:
+        errors = []
+        for provider in self._candidates():
+            provider.breaker.allow()
+            try:
+                response = start(provider.llm)
+            except Exception as e:
+                provider.breaker.record_failure()
+                llm_provider_calls_total.inc(provider=provider.name, result="error")
+                errors.append(f"{provider.name}: {type(e).__name__}: {e}")
+                logger.warning("LLM provider {} 失败: {}", provider.name, e)
+                continue
+            provider.breaker.record_success()
+            llm_provider_calls_total.inc(provider=provider.name, result="ok")
+            if hasattr(response, "__next__"):
+                return (_tag(chunk, provider.name) for chunk in response)
+            return _tag(response, provider.name)
+        raise LLMUnavailable("所有LLM provider都不可用: " + "; ".join(errors))
+
+    def chat_with_tools(self, tools: Sequence[BaseTool], *args: Any, **kwargs: Any) -> ChatResponse:
+        return self._call(lambda llm: llm.chat_with_tools(tools, *args, **kwargs))
+
+    def stream_chat_with_tools(self, tools: Sequence[BaseTool], *args: Any, **kwargs: Any) -> ChatResponseGen:
+        return self._call(lambda llm: llm.stream_chat_with_tools(tools, *args, **kwargs))
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self._call(lambda llm: llm.chat(messages, **kwargs))
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return self._call(lambda llm: llm.stream_chat(messages, **kwargs))
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self._call(lambda llm: llm.complete(prompt, formatted=formatted, **kwargs))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        return self._call(lambda llm: llm.stream_complete(prompt, formatted=formatted, **kwargs))
+
+    # ---- 工具调用 ----
+
+    def _prepare_chat_with_tools(self, tools: Sequence[BaseTool], *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        # 各provider的工具格式不同，由实际调用的provider自己准备
+        return self._providers[0].llm._prepare_chat_with_tools(tools, *args, **kwargs)
+
+    def get_tool_calls_from_response(
+            self, response: ChatResponse, error_on_no_tool_call: bool = True, **kwargs: Any
+    ) -> List[ToolSelection]:
+        provider = self._provider(response.additional_kwargs.get(PROVIDER_KEY))
+        return provider.llm.get_tool_calls_from_response(response, error_on_no_tool_call=error_on_no_tool_call,
+                                                         **kwargs)
+
+    def collect_health(self):
+        for provider in self._providers:
+            llm_provider_up.set(0 if provider.breaker.state == CircuitBreaker.OPEN else 1, provider=provider.name)
+
+
+def parse_concurrency(value: str) -> Dict[str, int]:
+    """LLM_PROVIDER_CONCURRENCY格式: gemini=64,ollama=4"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def build_pool(factories: Dict[str, Callable[[], FunctionCallingLLM]]) -> PooledLLM:
+    """按 LLM_PROVIDER 和 LLM_FALLBACK_PROVIDERS 的顺序创建provider，无法创建的fallback会被跳过"""
+    names = [settings.LLM_PROVIDER] + [
+        name.strip() for name in settings.LLM_FALLBACK_PROVIDERS.split(",")
+        if name.strip() and name.strip() != settings.LLM_PROVIDER
+    ]
+    limits = parse_concurrency(settings.LLM_PROVIDER_CONCURRENCY)
+    providers = []
+    for i, name in enumerate(names):
+        if name not in factories:
+            raise ValueError(f"未知的LLM provider: {name}")
+        try:
+            llm = factories[name]()
+        except Exception as e:
+            if i == 0:
+                raise
+            logger.error("创建备用LLM provider {} 失败，已跳过: {}", name, e)
+            continue
+        providers.append(LLMProvider(name, llm, limits.get(name, settings.LLM_DEFAULT_CONCURRENCY)))
+    pool = PooledLLM(providers)
+    metrics_registry.add_collector(pool.collect_health)
+    logger.info("LLM providers: {}", [provider.name for provider in providers])
+    return pool
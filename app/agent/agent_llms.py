@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+from llama_index.core.llms import LLM
 from llama_index.llms.google_genai import GoogleGenAI
 
 from app.config import settings
@@ -6,3 +9,30 @@ from app.config import settings
 def gemini_llm() -> GoogleGenAI:
     llm = GoogleGenAI(api_key=settings.GOOGLE_API_KEY, model=settings.GOOGLE_MODEL)
     return llm
+
+
+def ollama_llm() -> LLM:
+    try:
+        from llama_index.llms.ollama import Ollama
+    except ImportError as e:
+        raise ImportError("使用ollama需要安装: pip install llama-index-llms-ollama") from e
+    return Ollama(model=settings.OLLAMA_MODEL, base_url=settings.OLLAMA_BASE_URL,
+                  request_timeout=settings.OLLAMA_REQUEST_TIMEOUT)
+
+
+def stub_llm() -> LLM:
+    from app.agent.agent_stub_llm import StubLLM
+    return StubLLM()
+
+
+LLM_FACTORIES = {"gemini": gemini_llm, "ollama": ollama_llm, "stub": stub_llm}
+
+
+@lru_cache(maxsize=1)
+def get_llm() -> LLM:
+    """
+    按 LLM_PROVIDER 和 LLM_FALLBACK_PROVIDERS 创建带故障转移和对冲的LLM，stub用于离线压测；
+    所有智能体共享同一个实例，并发上限和熔断状态才是全局的
+    """
+    from app.agent.agent_llm_pool import build_pool
+    return build_pool(LLM_FACTORIES)
@@ -1,50 +1,355 @@
-import asyncio
-from typing import Dict, List
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
 
 from llama_index.core.memory import Memory
-from llama_index.core.llms import ChatMessage
-from llama_index.storage.chat_store.redis import RedisChatStore
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.utils import get_tokenizer
 
 from app.logger import get_logger
 from app.config import settings
+from app.db.redis.codec import decode_message, encode_messages
+from app.db.redis.session import PipelineBatcher, redis_memory, summary_key, version_key
+from app.agent.agent_profile import profile_store
+from app.agent.agent_summary import conversation_summarizer
+from app.tracing import span
 
 logger = get_logger("memory_manager")
 
 
+class TokenCountCache:
+    """按消息原始内容缓存token数，同一条历史消息在后续轮次中不再重复分词"""
+
+    def __init__(self, max_size: int = settings.MEMORY_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._counts: "OrderedDict[int, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tokenizer = None
+
+    def count(self, raw: bytes, message: ChatMessage) -> int:
+        key = hash(raw)
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                return tokens
+
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        tokens = len(self._tokenizer(message.content or ""))
+
+        with self._lock:
+            self._counts[key] = tokens
+            if len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+
+# 单例，全局共享
+token_count_cache = TokenCountCache()
+
+
+# 原始消息和解码后的消息
+HistoryEntry = Tuple[bytes, ChatMessage]
+# (列表长度, 列表末尾连续的若干条消息)，消息为原始bytes或已经解码的HistoryEntry
+PrefetchedHistory = Tuple[int, List[Union[bytes, HistoryEntry]]]
+
+# 列表为空（新用户）时的版本，首轮写入后即可从缓存衔接
+EMPTY_VERSION = b""
+# 解码后的消息对象（pydantic模型、文本）相对原始bytes的额外内存，按实测取整
+MESSAGE_OVERHEAD_BYTES = 1024
+
+
+@dataclass
+class CachedHistory:
+    version: bytes
+    length: int
+    entries: List[HistoryEntry]
+    size: int
+
+
+def _entries_size(entries: List[HistoryEntry]) -> int:
+    return sum(2 * len(raw) + MESSAGE_OVERHEAD_BYTES for raw, _ in entries)
+
+
+class HistoryCache:
+    """
+    进程内的最近对话缓存，保存每个用户上一轮加载的消息窗口（含解码结果），按估算的字节数做LRU淘汰
+    与Redis的一致性由 `{user_id}:ver` 和列表长度保证: 每次写入消息列表时同时写入新的随机版本，
+    加载时版本和长度都一致才使用缓存，其他worker（包括不写版本的旧版本）写入后缓存自动失效
+    """
+
+    def __init__(self, max_bytes: int = settings.HISTORY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CachedHistory]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[CachedHistory]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, user_id: str, version: bytes, length: int, entries: List[HistoryEntry]):
+        entry = CachedHistory(version=version, length=length, entries=entries, size=_entries_size(entries))
+        with self._lock:
+            self._remove(user_id)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[user_id] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def extend(self, user_id: str, base_version: Optional[bytes], version: bytes, entries: List[HistoryEntry],
+               length: Optional[int]):
+        """
+        本进程追加消息后同步更新缓存，length为追加后的列表长度
+        缓存不是基于base_version，或者期间有其他写入（长度对不上）时无法衔接，直接删除
+        """
+        entry = self.get(user_id)
+        if (entry is None or base_version is None or entry.version != base_version
+                or length != entry.length + len(entries)):
+            self.invalidate(user_id)
+            return
+        self.put(user_id, version, length, entry.entries + entries)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+# 单例，全局共享
+history_cache = HistoryCache()
+
+
 class MemoryManager:
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, batcher: Optional[PipelineBatcher] = None):
         self.user_id = user_id
-        self.chat_store = RedisChatStore(
-            ttl=settings.REDIS_MEMORY_TTL,
-            redis_url=settings.REDIS_DATABASE_URL,
-        )
+        # 批量处理时与其他用户的写命令合并到同一个pipeline
+        self.batcher = batcher
+        # 已经保存在Redis中的消息数量，保存时只追加之后的新消息
+        self.persisted_count = 0
+        # 尚未折叠进摘要的消息token数，用于判断是否需要生成摘要
+        self.unsummarized_tokens = 0
+        # 加载的历史对应的列表版本，用于更新进程内缓存
+        self.version: Optional[bytes] = None
+        self._pending_version: Optional[bytes] = None
+        # RPUSH在事务结果中的位置，其返回值为追加后的列表长度
+        self._push_index: Optional[int] = None
+
+    @staticmethod
+    def queue_prefetch(pipe, user_id: str):
+        """在pipeline中读取历史长度和最后一页消息，结果为 (llen, lrange) 两项"""
+        pipe.llen(user_id)
+        pipe.lrange(user_id, -settings.MEMORY_LOAD_PAGE_SIZE, -1)
+
+    async def init_memory(
+            self,
+            history: Optional[PrefetchedHistory] = None,
+            summary: Optional[Tuple[str, int]] = None,
+            version: Optional[bytes] = None,
+            profile: Optional[Dict[str, str]] = None,
+    ) -> Memory:
+        """
+        初始化Memory实例并从Redis加载历史对话
+        history/summary 为会话启动时已经批量读取（或来自进程内缓存）的数据，传入时不再单独请求Redis，
+        version 为history对应的列表版本，传入时把加载的消息窗口放入进程内缓存
+        profile 为长期用户档案，开启 PROFILE_PROMPT_ENABLED 时作为系统消息放在最前面
+        """
+        self.version = version
+        with span("memory.load") as current:
+            memory = await self._init_memory(history, summary, profile)
+            if current:
+                current.set(messages=self.persisted_count)
+            return memory
 
-    async def init_memory(self) -> Memory:
-        """初始化Memory实例并从Redis加载历史对话"""
+    async def _init_memory(
+            self, history: Optional[PrefetchedHistory], summary: Optional[Tuple[str, int]],
+            profile: Optional[Dict[str, str]],
+    ) -> Memory:
         # 创建Memory实例
         memory = Memory.from_defaults(
-            token_limit=40000,
+            token_limit=settings.MEMORY_TOKEN_LIMIT,
             session_id=self.user_id,
         )
 
-        # 从Redis加载历史对话
-        chat_history = await self.chat_store.aget_messages(self.user_id)
+        if settings.MEMORY_SUMMARY_ENABLED:
+            # 摘要模式: 加载摘要和摘要之后的最近对话
+            summary, upto = summary or await conversation_summarizer.load(self.user_id)
+            chat_history = await self.load_recent_history(
+                token_budget=settings.MEMORY_SUMMARY_WINDOW_TOKENS, min_index=upto, prefetched=history
+            )
+            if summary:
+                chat_history.insert(0, conversation_summarizer.to_message(summary))
+        else:
+            # 从Redis加载最近的历史对话
+            chat_history = await self.load_recent_history(prefetched=history)
+
+        profile_message = profile_store.to_message(profile) if profile and settings.PROFILE_PROMPT_ENABLED else None
+        if profile_message is not None:
+            chat_history.insert(0, profile_message)
+
         if chat_history:
             # 将历史消息添加到Memory中
-            memory.put_messages(chat_history)
-            logger.info(f"从Redis加载了 {len(chat_history)} 条历史消息")
+            await memory.aput_messages(chat_history)
+            logger.debug("从Redis加载了 {} 条历史消息", len(chat_history))
+        # 摘要和档案消息不在Redis的消息列表中，同样不需要再次保存
+        self.persisted_count = len(chat_history)
 
         return memory
 
+    async def load_recent_history(
+            self, token_budget: Optional[int] = None, min_index: int = 0, prefetched: Optional[PrefetchedHistory] = None
+    ) -> List[ChatMessage]:
+        """
+        从列表尾部按页读取历史消息，累计token数达到预算后停止，
+        只反序列化和分词最终需要的消息，耗时与历史总长度无关
+        min_index之前的消息（已折叠进摘要）不会被读取，prefetched为已经读取的最后一页
+        """
+        token_budget = token_budget or settings.MEMORY_LOAD_TOKEN_BUDGET
+        page_size = settings.MEMORY_LOAD_PAGE_SIZE
+
+        length = prefetched[0] if prefetched else await redis_memory.redis.llen(self.user_id)
+        # 预读的是 [length - len(tail), length) 范围内的消息
+        tail = prefetched[1] if prefetched else None
+        end = length
+        entries: List[HistoryEntry] = []
+        tokens = 0
+        budget_reached = False
+        while end > min_index and not budget_reached:
+            if tail:
+                start = max(min_index, end - len(tail))
+                items = tail[len(tail) - (end - start):]
+                tail = None
+            else:
+                start = max(min_index, end - page_size)
+                items = await redis_memory.redis.lrange(self.user_id, start, end - 1)
+            for item in reversed(items):
+                raw, message = item if isinstance(item, tuple) else (item, decode_message(item))
+                message_tokens = token_count_cache.count(raw, message)
+                if entries and tokens + message_tokens > token_budget:
+                    budget_reached = True
+                    break
+                entries.append((raw, message))
+                tokens += message_tokens
+            end = start
+
+        entries.reverse()
+        # 窗口截断后保证从用户消息开始，避免以孤立的工具调用结果开头
+        while entries and entries[0][1].role != MessageRole.USER:
+            entries.pop(0)
+        self.unsummarized_tokens = tokens
+        if self.version is None and length == 0:
+            self.version = EMPTY_VERSION
+        if self.version is not None and settings.HISTORY_CACHE_ENABLED:
+            history_cache.put(self.user_id, self.version, length, entries)
+        return [message for _, message in entries]
+
     async def save_memory_to_redis(self, memory: Memory):
-        """将Memory中的消息保存到Redis，避免重复保存"""
-        # 获取当前Memory中的所有消息
+        """将Memory中新增的消息追加保存到Redis，避免重写整个历史列表"""
+        # 获取当前Memory中的所有消息，加载的历史消息在前，本轮新增的消息在后
+        with span("memory.save") as current:
+            messages = await self.new_messages(memory)
+            await self.append_messages(messages)
+            if current:
+                current.set(messages=len(messages))
+
+    async def new_messages(self, memory: Memory) -> List[ChatMessage]:
+        """Memory中加载的历史消息在前，本轮新增的消息在后"""
         current_messages = await memory.aget_all()
-        if not current_messages:
-            logger.info("Memory中没有消息，无需保存")
-            return
-        self.chat_store.set_messages(key=self.user_id, messages=current_messages)
+        return current_messages[self.persisted_count:]
+
+    async def append_messages(self, messages: List[ChatMessage]):
+        """追加消息并刷新TTL，在一次pipeline中完成"""
+        encoded_messages = self.encode(messages)
+        try:
+            if self.batcher is not None:
+                results = await self.batcher.execute(lambda pipe: self.queue_append(pipe, encoded_messages))
+            else:
+                async with redis_memory.redis.pipeline(transaction=True) as pipe:
+                    self.queue_append(pipe, encoded_messages)
+                    results = await pipe.execute()
+        except BaseException:
+            self.write_failed()
+            raise
+        self.appended(messages, encoded_messages, results)
+
+    def write_failed(self):
+        """写入结果未知时（例如超时）删除进程内缓存，下一轮从Redis重新加载"""
+        history_cache.invalidate(self.user_id)
+
+    @staticmethod
+    def encode(messages: List[ChatMessage]) -> List[bytes]:
+        return encode_messages(messages)
+
+    def queue_append(self, pipe, encoded_messages: List[bytes]):
+        """在pipeline中追加消息、更新列表版本并刷新TTL"""
+        if encoded_messages:
+            self._push_index = len(pipe)
+            pipe.rpush(self.user_id, *encoded_messages)
+            self._pending_version = uuid.uuid4().hex.encode()
+            pipe.set(version_key(self.user_id), self._pending_version, ex=redis_memory.ttl or None)
+        else:
+            logger.debug("Memory中没有新消息，只刷新TTL")
+            self._pending_version = self._push_index = None
+            if redis_memory.ttl:
+                pipe.expire(version_key(self.user_id), redis_memory.ttl)
+        if redis_memory.ttl:
+            pipe.expire(self.user_id, redis_memory.ttl)
+            if settings.MEMORY_SUMMARY_ENABLED:
+                pipe.expire(summary_key(self.user_id), redis_memory.ttl)
+
+    def appended(self, messages: List[ChatMessage], encoded_messages: List[bytes], results: List):
+        """
+        追加写入成功后更新计数和进程内缓存，未摘要的消息过多时在后台生成摘要
+        results 为写入所在事务的结果列表
+        """
+        logger.debug("追加保存了 {} 条消息到Redis", len(messages))
+        self.persisted_count += len(messages)
+        if self._pending_version is not None and settings.HISTORY_CACHE_ENABLED:
+            history_cache.extend(
+                self.user_id, self.version, self._pending_version, list(zip(encoded_messages, messages)),
+                length=results[self._push_index],
+            )
+            self.version = self._pending_version
+        if settings.MEMORY_SUMMARY_ENABLED:
+            self.unsummarized_tokens += sum(
+                token_count_cache.count(raw, message) for raw, message in zip(encoded_messages, messages)
+            )
+            if self.unsummarized_tokens > settings.MEMORY_SUMMARY_TRIGGER_TOKENS:
+                conversation_summarizer.schedule(self.user_id)
 
     async def get_chat_history(self) -> List[ChatMessage]:
-        """直接从Redis获取聊天历史"""
-        return await self.chat_store.aget_messages(self.user_id)
+        """直接从Redis获取完整聊天历史"""
+        raw_messages = await redis_memory.redis.lrange(self.user_id, 0, -1)
+        return [decode_message(raw) for raw in raw_messages]
@@ -0,0 +1,233 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+from app.config import settings
+from app.logger import get_logger
+
+logger = get_logger("agent_prerouter")
+
+ROUTER_AGENT = "路由智能体"
+HEALTH_AGENT = "健康/康复建议智能体"
+SUBSCRIPTION_AGENT = "订阅与付费智能体"
+TROUBLESHOOTING_AGENT = "故障排查智能体"
+REFIT_AGENT = "个人定制智能体"
+SPECIALIST_AGENTS = [HEALTH_AGENT, SUBSCRIPTION_AGENT, TROUBLESHOOTING_AGENT, REFIT_AGENT]
+
+# 与路由智能体Prompt中的分类标准保持一致，只收录含义明确的关键词
+KEYWORD_RULES: Dict[str, List[str]] = {
+    SUBSCRIPTION_AGENT: [
+        r"订阅", r"退款", r"退钱", r"付款", r"支付", r"扣费", r"扣款", r"账单", r"发票", r"会员", r"续费",
+        r"subscri", r"refund", r"billing", r"\bbill\b", r"invoice", r"payment", r"\bcharged?\b", r"membership",
+    ],
+    TROUBLESHOOTING_AGENT: [
+        r"崩溃", r"闪退", r"打不开", r"报错", r"卡顿", r"白屏", r"黑屏", r"加载不出", r"无法播放", r"没有声音",
+        r"crash", r"\bbug\b", r"\berror\b", r"not working", r"won'?t (open|load|play)", r"freez", r"black screen",
+    ],
+    REFIT_AGENT: [
+        r"(修改|更改|调整|换成|改成|改为).{0,8}(计划|时长|姿势|器械|教练|昵称|年龄|身高|体重|运动类型)",
+        r"(计划|时长|姿势|器械|教练|昵称|年龄|身高|体重).{0,6}(修改|更改|调整|换成|改成|改为)",
+        r"(change|update|modify|adjust|switch).{0,20}(plan|duration|position|equipment|coach|nickname|age|height|weight)",
+        r"取消.{0,6}(太极|瑜伽|有氧|步行|舞蹈)",
+    ],
+    HEALTH_AGENT: [
+        r"疼", r"痛", r"酸", r"拉伤", r"扭伤", r"疲惫", r"失眠", r"睡眠", r"饮食", r"营养", r"减肥", r"血压",
+        r"\bpain\b", r"\bsore\b", r"\bache", r"injur", r"\bsleep", r"\bdiet\b", r"nutrition", r"lose weight",
+    ],
+}
+
+
+# 用户明确表示要换一个话题时，不再由上一轮的专业智能体继续
+TOPIC_SHIFT_PATTERNS = [
+    r"另外", r"换个(问题|话题)", r"别的问题", r"其他问题", r"还有一个问题", r"顺便问", r"不说这个",
+    r"another question", r"something else", r"different question", r"by the way", r"\bbtw\b",
+]
+
+
+# 以确认、否定或指代开头，或者只说"改一下"而没有说明改什么的问题依赖上文，
+# 即使命中了关键词也不能脱离历史直接分类（例如"是的，膝盖痛，帮我改一下"是在回答个人定制智能体的追问）
+FOLLOW_UP_PATTERNS = [
+    r"^(是的|是啊|对的|对|好的|好|嗯|行|可以|不是|不对|没有|不用|还是|那|这个|那个|它|刚才|上面)",
+    r"(改|调|换)一下$",
+    r"^(yes|yeah|yep|no|nope|ok|okay|sure|right|that|it|this)\b", r"\b(as i said|like i said)\b",
+]
+
+
+@dataclass
+class RoutingDecision:
+    agent: Optional[str]
+    confidence: float
+    source: str
+
+
+def _normalize(query: str) -> str:
+    return unicodedata.normalize("NFKC", query).lower()
+
+
+def _features(query: str) -> List[str]:
+    """英文按单词，中文等按字符二元组切分"""
+    text = _normalize(query)
+    features = re.findall(r"[a-z0-9']+", text)
+    cjk = re.sub(r"[a-z0-9'\W_]+", "", text)
+    features.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return features
+
+
+class KeywordRouter:
+    """关键词/正则规则，只有一个分类命中时才认为可信"""
+
+    def __init__(self, rules: Dict[str, List[str]] = KEYWORD_RULES):
+        self.rules = {agent: re.compile("|".join(patterns)) for agent, patterns in rules.items()}
+
+    def matches(self, query: str) -> List[str]:
+        text = _normalize(query)
+        return [agent for agent, pattern in self.rules.items() if pattern.search(text)]
+
+    def route(self, query: str) -> RoutingDecision:
+        matched = self.matches(query)
+        if len(matched) == 1:
+            return RoutingDecision(agent=matched[0], confidence=settings.PREROUTER_KEYWORD_CONFIDENCE, source="keyword")
+        return RoutingDecision(agent=None, confidence=0.0, source="keyword")
+
+
+class NaiveBayesRouter:
+    """基于路由智能体历史决策训练的多项式朴素贝叶斯分类器"""
+
+    def __init__(self):
+        self.class_counts: Counter = Counter()
+        self.feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        self.feature_totals: Counter = Counter()
+        self.vocabulary: set = set()
+
+    def fit(self, samples: Iterable[Tuple[str, str]]) -> "NaiveBayesRouter":
+        for query, agent in samples:
+            if agent not in SPECIALIST_AGENTS:
+                continue
+            features = _features(query)
+            self.class_counts[agent] += 1
+            self.feature_counts[agent].update(features)
+            self.feature_totals[agent] += len(features)
+            self.vocabulary.update(features)
+        return self
+
+    def route(self, query: str) -> RoutingDecision:
+        total = sum(self.class_counts.values())
+        if total < settings.PREROUTER_MIN_TRAINING_SAMPLES:
+            return RoutingDecision(agent=None, confidence=0.0, source="model")
+
+        features = _features(query)
+        vocabulary_size = len(self.vocabulary) + 1
+        log_probs = {}
+        for agent, count in self.class_counts.items():
+            log_prob = math.log(count / total)
+            agent_features = self.feature_counts[agent]
+            denominator = self.feature_totals[agent] + vocabulary_size
+            for feature in features:
+                log_prob += math.log((agent_features[feature] + 1) / denominator)
+            log_probs[agent] = log_prob
+
+        # 归一化为后验概率
+        max_log_prob = max(log_probs.values())
+        weights = {agent: math.exp(value - max_log_prob) for agent, value in log_probs.items()}
+        agent = max(weights, key=weights.get)
+        return RoutingDecision(agent=agent, confidence=weights[agent] / sum(weights.values()), source="model")
+
+
+class PreRouter:
+    """
+    在路由智能体之前运行的本地分类器: 先匹配关键词规则，再使用本地模型，
+    置信度达到阈值时直接进入专业智能体，省去一次路由LLM调用，否则回退到路由智能体
+    """
+
+    def __init__(self, threshold: float = settings.PREROUTER_CONFIDENCE_THRESHOLD):
+        self.threshold = threshold
+        self.keyword_router = KeywordRouter()
+        self.model_router = NaiveBayesRouter()
+        self.topic_shift = re.compile("|".join(TOPIC_SHIFT_PATTERNS))
+        self.follow_up = re.compile("|".join(FOLLOW_UP_PATTERNS))
+        self._log_lock = threading.Lock()
+
+    def is_follow_up(self, query: str) -> bool:
+        return bool(self.follow_up.search(_normalize(query).strip()))
+
+    def route(self, query: str, has_history: bool = False) -> RoutingDecision:
+        """has_history为用户是否已有历史对话，此时依赖上文的问题交给路由智能体结合历史判断"""
+        if has_history and self.is_follow_up(query):
+            return RoutingDecision(agent=None, confidence=0.0, source="follow_up")
+        for router in (self.keyword_router, self.model_router):
+            decision = router.route(query)
+            if decision.agent and decision.confidence >= self.threshold:
+                return decision
+        return RoutingDecision(agent=None, confidence=0.0, source="fallback")
+
+    def is_topic_change(self, query: str) -> bool:
+        """
+        用户明确表示换话题时，不能由上一轮的智能体继续
+        不根据关键词判断: 追问中经常带有其他分类的关键词（例如"改成瑜伽吧，我腰疼"仍是在修改计划）
+        """
+        return bool(self.topic_shift.search(_normalize(query)))
+
+    def load_training_data(self, path: Optional[str] = settings.PREROUTER_LOG_PATH):
+        """从路由决策日志（包括轮转出的 .1 文件）训练本地模型"""
+        if not path:
+            return
+        paths = [file for file in (Path(f"{path}.1"), Path(path)) if file.exists()]
+        if not paths:
+            return
+        model_router = NaiveBayesRouter()
+        for file in paths:
+            model_router.fit(load_routing_samples(str(file)))
+        self.model_router = model_router
+        logger.info("已从 {} 训练预路由模型, 样本数: {}", path, sum(self.model_router.class_counts.values()))
+
+    async def record(self, query: str, agent: str, path: Optional[str] = settings.PREROUTER_LOG_PATH):
+        """
+        记录路由智能体的决策，作为本地模型的训练数据，在线程中写文件，不阻塞事件循环
+        日志中保存的是用户的原始问题，文件超过 PREROUTER_LOG_MAX_BYTES 后轮转，最多保留两个文件
+        """
+        if not path or agent not in SPECIALIST_AGENTS:
+            return
+        line = orjson.dumps({"query": query, "agent": agent}) + b"\n"
+        try:
+            await asyncio.to_thread(self._append, path, line)
+        except Exception as e:
+            logger.warning("记录路由决策失败: {}", e)
+
+    def _append(self, path: str, line: bytes, max_bytes: int = settings.PREROUTER_LOG_MAX_BYTES):
+        with self._log_lock:
+            # 多个worker写同一个文件时可能同时轮转，最多丢失一个历史文件，不影响训练
+            size = self._size(path)
+            if size and 0 < max_bytes < size + len(line):
+                os.replace(path, f"{path}.1")
+            with open(path, "ab") as f:
+                f.write(line)
+
+    @staticmethod
+    def _size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+
+def load_routing_samples(path: str) -> List[Tuple[str, str]]:
+    samples = []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                item = orjson.loads(line)
+                samples.append((item["query"], item["agent"]))
+    return samples
+
+
+# 单例，全局共享
+pre_router = PreRouter()
@@ -0,0 +1,227 @@
+import random
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from redis.exceptions import WatchError
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import profile_index_key, profile_key, redis_memory
+from app.tracing import span
+
+logger = get_logger("agent_profile")
+
+# 计划参数为固定的可选值（与 adjust_workout_plan_tool 的参数一致），建立二级索引；基础信息（昵称、年龄等）只保存不索引
+FIELD_OPTIONS: Dict[str, Tuple[str, ...]] = {
+    "workout_type": ("chair_yoga", "chair_cardio", "tai_chi", "gentle_cardio", "indoor_walking", "dancing", "i_want_all"),
+    "workout_duration": ("5-10", "10-15", "15-20", "20-30"),
+    "physical_limitation": ("knee", "back", "shoulder", "wrist", "hip", "ankle", "i'm_all_good"),
+    # 工具的参数说明为resistance band，工具的docstring中为elastic_bands，两者都接受
+    "equipment": ("dumbbell", "resistance band", "elastic_bands", "no_equipment"),
+    "coach": ("male", "female", "mixed_coaches"),
+    "preferred_position": ("standing", "seated_on_chair", "i_want_both"),
+}
+# 可以同时有多个值的字段，以逗号分隔保存，每个值单独索引；对应的值表示全部/没有，与其他值互斥
+MULTI_VALUED_FIELDS: Dict[str, str] = {"workout_type": "i_want_all", "physical_limitation": "i'm_all_good"}
+INDEXED_FIELDS = tuple(FIELD_OPTIONS)
+BASIC_FIELDS = ("nickname", "age", "height", "weight")
+PROFILE_FIELDS = INDEXED_FIELDS + BASIC_FIELDS
+# 并发修改同一用户的档案时重试的次数
+UPDATE_RETRIES = 3
+
+
+def split_values(field: str, value: Optional[str]) -> Set[str]:
+    """字段值拆分为集合，多值字段按逗号拆分"""
+    if not value:
+        return set()
+    if field not in MULTI_VALUED_FIELDS:
+        return {value}
+    return {item.strip() for item in value.split(",") if item.strip()}
+
+
+def join_values(values: Set[str]) -> str:
+    return ",".join(sorted(values))
+
+
+class ProfileStore:
+    """
+    长期用户档案，保存在哈希 `{user_id}:profile` 中，不随短期记忆过期:
+        - 工具修改计划/基础信息推送成功后（开启outbox时为投递成功后）按字段更新，未提到的字段保持不变；
+          多值字段（运动类型、避免锻炼部位）新的值加入已有的值中，取消时只删除对应的值
+        - INDEXED_FIELDS 只接受 FIELD_OPTIONS 中的值，同时维护集合 `profile:idx:{field}:{value}`，
+          按条件查询用户（例如所有避免锻炼膝盖的用户）时直接读取集合，不需要扫描全部档案
+        - 每轮对话开始时随会话数据一起读取，压缩为一条系统消息放在历史之前
+    """
+
+    async def load(self, user_id: str) -> Dict[str, str]:
+        """不存在或读取失败时返回空档案"""
+        try:
+            return self.parse(await redis_memory.redis.hgetall(profile_key(user_id)))
+        except Exception as e:
+            logger.warning("读取用户档案失败: {}", e)
+            return {}
+
+    @staticmethod
+    def parse(data: Optional[Dict[bytes, bytes]]) -> Dict[str, str]:
+        """解析 `{user_id}:profile` 的HGETALL结果，只保留档案字段"""
+        profile = {}
+        for field, value in (data or {}).items():
+            field = field.decode("utf-8")
+            if field in PROFILE_FIELDS:
+                profile[field] = value.decode("utf-8")
+        return profile
+
+    @staticmethod
+    def _valid(field: str, values: Set[str]) -> Set[str]:
+        """计划参数只保留可选值，不在可选值中的值（例如LLM编造的值）不保存也不索引"""
+        if field not in FIELD_OPTIONS:
+            return values
+        invalid = values.difference(FIELD_OPTIONS[field])
+        if invalid:
+            logger.warning("忽略用户档案中无效的值: {}={}", field, ', '.join(sorted(invalid)))
+        return values - invalid
+
+    async def update(
+            self, user_id: str, values: Dict[str, str], remove: Optional[Dict[str, Optional[str]]] = None
+    ) -> bool:
+        """
+        按字段更新档案并同步索引，失败时只记录日志，返回是否写入成功
+            - values: 需要设置的字段，空值和无效的值忽略；多值字段加入已有的值中
+            - remove: 需要删除的字段，值为None时删除整个字段，否则只删除该值
+              （单值字段在当前值与其相同时删除，例如取消某个运动类型）
+        用WATCH保证读取旧值和修改索引之间没有其他写入
+        """
+        values = {
+            field: self._valid(field, split_values(field, str(value)))
+            for field, value in values.items() if field in PROFILE_FIELDS and value
+        }
+        values = {field: value for field, value in values.items() if value}
+        remove = {
+            field: None if value is None else split_values(field, value)
+            for field, value in (remove or {}).items() if field in PROFILE_FIELDS
+        }
+        if not values and not remove:
+            return True
+        key = profile_key(user_id)
+        fields = list(dict.fromkeys([*values, *remove]))
+        try:
+            with span("profile.update", fields=len(fields)):
+                async with redis_memory.redis.pipeline(transaction=True) as pipe:
+                    for _ in range(UPDATE_RETRIES):
+                        try:
+                            await pipe.watch(key)
+                            current = {
+                                field: split_values(field, value.decode("utf-8") if value is not None else None)
+                                for field, value in zip(fields, await pipe.hmget(key, fields))
+                            }
+                            pipe.multi()
+                            self._queue_update(pipe, user_id, current, self._merge(current, values, remove))
+                            await pipe.execute()
+                            return True
+                        except WatchError:
+                            continue
+            logger.warning("用户档案被并发修改，放弃本次更新: user_id={}", user_id)
+        except Exception as e:
+            logger.warning("保存用户档案失败: {}", e)
+        return False
+
+    async def apply(self, user_id: str, change: Optional[Dict[str, Any]]) -> bool:
+        """
+        写入工具修改推送成功后的档案修改 {"values", "remove"}（参数同update），未开启档案时不处理
+        开启outbox时由outbox worker在投递成功后调用，否则由工具在推送成功后直接调用
+        """
+        if not change or not settings.PROFILE_ENABLED:
+            return True
+        return await self.update(user_id, change.get("values") or {}, change.get("remove"))
+
+    @staticmethod
+    def _merge(
+            current: Dict[str, Set[str]], values: Dict[str, Set[str]], remove: Dict[str, Optional[Set[str]]],
+    ) -> Dict[str, Set[str]]:
+        """计算修改后各字段的值，空集合表示删除该字段"""
+        updated = {}
+        for field, old in current.items():
+            new = set(old)
+            exclusive = MULTI_VALUED_FIELDS.get(field)
+            if field in remove:
+                removed = remove[field]
+                if removed is None or exclusive in removed:
+                    new = set()
+                elif exclusive is not None:
+                    new -= removed
+                elif new == removed:
+                    # 单值字段只有当前值与要删除的值相同时才删除
+                    new = set()
+            if field in values:
+                if field not in MULTI_VALUED_FIELDS:
+                    new = values[field]
+                elif exclusive in values[field]:
+                    new = {exclusive}
+                else:
+                    new = (new - {exclusive}) | values[field]
+            updated[field] = new
+        return updated
+
+    @staticmethod
+    def _queue_update(pipe, user_id: str, current: Dict[str, Set[str]], updated: Dict[str, Set[str]]):
+        key = profile_key(user_id)
+        removed = [field for field, new in updated.items() if not new and current[field]]
+        changed = {field: join_values(new) for field, new in updated.items() if new and new != current[field]}
+        if removed:
+            pipe.hdel(key, *removed)
+        if changed:
+            pipe.hset(key, mapping={**changed, "updated_at": int(time.time())})
+
+        for field, new in updated.items():
+            if field not in INDEXED_FIELDS:
+                continue
+            for value in current[field] - new:
+                pipe.srem(profile_index_key(field, value), user_id)
+            for value in new - current[field]:
+                pipe.sadd(profile_index_key(field, value), user_id)
+
+    @staticmethod
+    def validate_criteria(criteria: Dict[str, str]):
+        unknown = [field for field in criteria if field not in INDEXED_FIELDS]
+        if unknown:
+            raise ValueError(f"只能按以下字段查询: {', '.join(INDEXED_FIELDS)}，不支持: {', '.join(unknown)}")
+        if not criteria:
+            raise ValueError("至少需要一个查询条件")
+        for field, value in criteria.items():
+            if value not in FIELD_OPTIONS[field]:
+                raise ValueError(f"{field} 的可选值为: {', '.join(FIELD_OPTIONS[field])}，不支持: {value}")
+
+    async def cohort(self, criteria: Dict[str, str], limit: int = settings.PROFILE_COHORT_LIMIT) -> Tuple[int, List[str]]:
+        """
+        查询同时满足所有条件（字段=值）的用户，返回 (总数, 最多limit个user_id)
+        只支持 INDEXED_FIELDS，多值字段匹配包含该值的用户，多个条件时对索引集合求交集
+        总数超过limit时，无论几个条件都返回随机抽取的limit个用户（按user_id排序），不支持分页
+        """
+        self.validate_criteria(criteria)
+        keys = [profile_index_key(field, value) for field, value in criteria.items()]
+        with span("profile.cohort", criteria=len(keys)):
+            if len(keys) == 1:
+                # 单个条件不读取整个集合，由Redis随机抽样
+                async with redis_memory.redis.pipeline(transaction=False) as pipe:
+                    pipe.scard(keys[0])
+                    pipe.srandmember(keys[0], limit)
+                    total, members = await pipe.execute()
+            else:
+                members = list(await redis_memory.redis.sinter(keys))
+                total = len(members)
+                if total > limit:
+                    members = random.sample(members, limit)
+        return total, sorted(member.decode("utf-8") for member in members)
+
+    @staticmethod
+    def to_message(profile: Dict[str, str]) -> Optional[ChatMessage]:
+        """压缩为一行 `字段=值`，字段名与工具参数一致，空档案返回None"""
+        items = [f"{field}={profile[field]}" for field in PROFILE_FIELDS if profile.get(field)]
+        if not items:
+            return None
+        return ChatMessage(role=MessageRole.SYSTEM, content=f"用户档案(长期保存): {'; '.join(items)}")
+
+
+# 单例，全局共享
+profile_store = ProfileStore()
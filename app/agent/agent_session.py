@@ -0,0 +1,40 @@
+import time
+from typing import Optional
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import session_key
+from app.agent.agent_prerouter import SPECIALIST_AGENTS
+
+logger = get_logger("agent_session")
+
+
+class AgentSessionStore:
+    """
+    在 `{user_id}:session` 中记录上一轮回复用户的专业智能体，
+    key在 SESSION_RESUME_WINDOW 秒后过期，窗口内的追问可以直接从该智能体继续
+    """
+
+    def __init__(self, window: int = settings.SESSION_RESUME_WINDOW):
+        self.window = window
+
+    @staticmethod
+    def parse(agent: Optional[bytes]) -> Optional[str]:
+        """解析 HGET agent 的结果，只接受专业智能体"""
+        if agent is None:
+            return None
+        agent = agent.decode("utf-8")
+        return agent if agent in SPECIALIST_AGENTS else None
+
+    def queue_save(self, pipe, user_id: str, agent: str):
+        """专业智能体回复后记录；路由智能体自己回复（例如追问分类信息）时清除，下一轮重新路由"""
+        key = session_key(user_id)
+        if agent not in SPECIALIST_AGENTS:
+            pipe.hdel(key, "agent", "updated_at")
+            return
+        pipe.hset(key, mapping={"agent": agent, "updated_at": int(time.time())})
+        pipe.expire(key, self.window)
+
+
+# 单例，全局共享
+agent_session_store = AgentSessionStore()
@@ -0,0 +1,180 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from llama_index.core.llms import ChatMessage
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import ctx_key, profile_key, redis_memory, session_key, summary_key, version_key
+from app.agent.agent_memory import CachedHistory, MemoryManager, PrefetchedHistory, history_cache
+from app.agent.agent_profile import profile_store
+from app.agent.agent_session import agent_session_store
+from app.agent.agent_state import ctx_state_store, default_state
+from app.agent.agent_summary import conversation_summarizer
+from app.metrics import cache_requests_total
+from app.tracing import span
+
+logger = get_logger("session_store")
+
+
+@dataclass
+class SessionSnapshot:
+    """一轮对话开始时需要的会话数据"""
+    history: PrefetchedHistory
+    summary: Tuple[str, int]
+    last_agent: Optional[str]
+    state: Dict[str, Any]
+    # 历史消息列表的版本，None表示列表还没有版本（新用户或旧数据）
+    version: Optional[bytes] = None
+    # 长期用户档案
+    profile: Dict[str, str] = field(default_factory=dict)
+
+    def is_fresh(self) -> bool:
+        """没有历史、摘要、工作流state和档案，即智能体的回复只取决于本轮的问题"""
+        return (
+                not self.history[0] and not self.summary[0] and not self.profile
+                and not any(self.state.values())
+        )
+
+
+class SessionStore:
+    """
+    一轮对话的Redis读写入口，把各个key的访问合并为两次往返:
+        - bootstrap: 一个pipeline读取历史长度和最后一页、摘要、上一轮的智能体、工作流state和用户档案，
+          可以一次读取多个用户（批量处理）；进程内缓存了该用户的历史时只读取列表版本和长度，
+          都一致时直接使用缓存，不一致时再读取一次历史
+        - commit: 一个MULTI/EXEC事务追加新消息并刷新TTL、记录智能体、保存state。
+          MULTI/EXEC不会回滚，某条命令出错时其他命令仍然生效；提交出错时结果未知，调用方不能重试，否则可能重复追加消息
+    各个key的格式和解析仍由 MemoryManager、AgentSessionStore、CtxStateStore 负责
+    """
+
+    @staticmethod
+    def _queue_bootstrap(pipe, user_id: str, cached: Optional[CachedHistory]):
+        # 先读版本再读列表: 两者之间有写入时缓存的是旧版本+新数据，下一轮会被判定为过期，不会出错
+        pipe.get(version_key(user_id))
+        if cached is None:
+            MemoryManager.queue_prefetch(pipe, user_id)
+        else:
+            pipe.llen(user_id)
+        if settings.MEMORY_SUMMARY_ENABLED:
+            pipe.hgetall(summary_key(user_id))
+        if settings.SESSION_RESUME_ENABLED:
+            pipe.hget(session_key(user_id), "agent")
+        if settings.CTX_STATE_ENABLED:
+            pipe.get(ctx_key(user_id))
+        if settings.PROFILE_ENABLED:
+            pipe.hgetall(profile_key(user_id))
+
+    @staticmethod
+    def _parse_bootstrap(results, cached: Optional[CachedHistory]) -> SessionSnapshot:
+        version = next(results)
+        if cached is None:
+            history = (next(results), next(results))
+        else:
+            # 版本或长度不一致时为None，之后重新读取
+            length = next(results)
+            valid = version == (cached.version or None) and length == cached.length
+            history = (cached.length, cached.entries) if valid else None
+        summary = conversation_summarizer.parse(next(results)) if settings.MEMORY_SUMMARY_ENABLED else ("", 0)
+        last_agent = agent_session_store.parse(next(results)) if settings.SESSION_RESUME_ENABLED else None
+        state = ctx_state_store.parse(next(results)) if settings.CTX_STATE_ENABLED else default_state()
+        profile = profile_store.parse(next(results)) if settings.PROFILE_ENABLED else {}
+        return SessionSnapshot(
+            history=history, summary=summary, last_agent=last_agent, state=state, version=version, profile=profile
+        )
+
+    @staticmethod
+    async def has_context(user_id: str) -> bool:
+        """一次EXISTS检查用户是否有历史、摘要、工作流state或档案，用于判断能否使用回复缓存"""
+        keys = [user_id, summary_key(user_id), ctx_key(user_id), profile_key(user_id)]
+        return await redis_memory.redis.exists(*keys) > 0
+
+    @staticmethod
+    async def is_current(user_id: str, snapshot: SessionSnapshot) -> bool:
+        """
+        预读的快照是否仍是最新的: 每次提交都会追加消息并更新历史列表的版本，
+        版本变化说明期间有其他请求提交过，快照中的历史和state都已过期
+        """
+        return await redis_memory.redis.get(version_key(user_id)) == snapshot.version
+
+    async def bootstrap(self, user_id: str) -> SessionSnapshot:
+        return (await self.bootstrap_many([user_id]))[user_id]
+
+    async def bootstrap_many(self, user_ids: Iterable[str]) -> Dict[str, SessionSnapshot]:
+        """在一个pipeline中读取多个用户的会话数据"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        cached = {
+            user_id: history_cache.get(user_id) if settings.HISTORY_CACHE_ENABLED else None for user_id in user_ids
+        }
+        with span("session.bootstrap", users=len(user_ids)) as current:
+            async with redis_memory.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    self._queue_bootstrap(pipe, user_id, cached[user_id])
+                results = iter(await pipe.execute())
+            snapshots = {user_id: self._parse_bootstrap(results, cached[user_id]) for user_id in user_ids}
+
+            stale = [user_id for user_id, snapshot in snapshots.items() if snapshot.history is None]
+            if stale:
+                await self._refetch_history(stale, snapshots)
+            if settings.HISTORY_CACHE_ENABLED:
+                for user_id, entry in cached.items():
+                    result = "miss" if entry is None else "stale" if user_id in stale else "hit"
+                    history_cache.record(result == "hit")
+                    cache_requests_total.inc(cache="history", result=result)
+            if current:
+                current.set(stale=len(stale))
+        return snapshots
+
+    @staticmethod
+    async def _refetch_history(user_ids: List[str], snapshots: Dict[str, SessionSnapshot]):
+        """缓存已过期的用户重新读取版本和历史"""
+        async with redis_memory.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.get(version_key(user_id))
+                MemoryManager.queue_prefetch(pipe, user_id)
+            results = iter(await pipe.execute())
+        for user_id in user_ids:
+            snapshots[user_id].version = next(results)
+            snapshots[user_id].history = (next(results), next(results))
+
+    async def commit(
+            self,
+            memory_manager: MemoryManager,
+            messages: List[ChatMessage],
+            agent: Optional[str] = None,
+            state: Optional[Dict[str, Any]] = None,
+            loaded_state: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        在一个事务中保存本轮对话，agent/state为None时不修改对应的key
+        MemoryManager设置了batcher时与其他用户的提交合并到同一个事务
+        出错时写入结果未知（可能已经部分或全部写入），不要重试
+        """
+        user_id = memory_manager.user_id
+        encoded_messages = memory_manager.encode(messages)
+
+        def build(pipe):
+            memory_manager.queue_append(pipe, encoded_messages)
+            if agent is not None and settings.SESSION_RESUME_ENABLED:
+                agent_session_store.queue_save(pipe, user_id, agent)
+            if state is not None and settings.CTX_STATE_ENABLED:
+                ctx_state_store.queue_save(pipe, user_id, state, loaded_state)
+
+        with span("session.commit", messages=len(messages)):
+            try:
+                if memory_manager.batcher is not None:
+                    results = await memory_manager.batcher.execute(build)
+                else:
+                    async with redis_memory.redis.pipeline(transaction=True) as pipe:
+                        build(pipe)
+                        results = await pipe.execute()
+            except BaseException:
+                memory_manager.write_failed()
+                raise
+        memory_manager.appended(messages, encoded_messages, results)
+
+
+# 单例，全局共享
+session_store = SessionStore()
@@ -0,0 +1,88 @@
+import copy
+import zlib
+from typing import Any, Dict, Optional
+
+import orjson
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import ctx_key
+
+logger = get_logger("agent_state")
+
+# 格式: 1字节版本 + 1字节标志 + orjson(可选zlib压缩)
+# state的结构变化且不兼容时递增版本，旧版本的数据直接丢弃
+STATE_VERSION = 1
+FLAG_ZLIB = 0x01
+
+
+def default_state() -> Dict[str, Any]:
+    return {"workout_plan_params": {}, "basic_info_params": {}}
+
+
+def encode_state(state: Dict[str, Any], compress_min_bytes: int = settings.CTX_STATE_COMPRESS_MIN_BYTES) -> bytes:
+    data = orjson.dumps(state)
+    flags = 0
+    if len(data) >= compress_min_bytes:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            data, flags = compressed, FLAG_ZLIB
+    return bytes((STATE_VERSION, flags)) + data
+
+
+def decode_state(raw: bytes) -> Optional[Dict[str, Any]]:
+    """版本不匹配或数据损坏时返回None"""
+    if len(raw) < 2 or raw[0] != STATE_VERSION:
+        return None
+    data = raw[2:]
+    if raw[1] & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    state = orjson.loads(data)
+    return state if isinstance(state, dict) else None
+
+
+class CtxStateStore:
+    """
+    持久化工作流Context中的state（工具通过update_ctx_data收集的workout_plan_params、basic_info_params），
+    保存在 `{user_id}:ctx`，TTL与短期记忆相同
+    只保存state而不是整个Context: 对话历史已经由Memory保存，Context中的其他内容只在单次运行中有效
+    """
+
+    def __init__(self, ttl: int = settings.REDIS_MEMORY_TTL):
+        self.ttl = ttl
+
+    @staticmethod
+    def parse(raw: Optional[bytes]) -> Dict[str, Any]:
+        """解析 `{user_id}:ctx` 的值，数据损坏时返回初始state"""
+        state = default_state()
+        try:
+            loaded = decode_state(raw) if raw else None
+        except Exception as e:
+            logger.warning("解析工作流state失败: {}", e)
+            loaded = None
+        if loaded:
+            state.update(loaded)
+        return state
+
+    def queue_save(self, pipe, user_id: str, state: Dict[str, Any], loaded: Optional[Dict[str, Any]]):
+        """
+        state没有变化时不重新写入，但与历史一样每轮刷新TTL，否则对话进行中state会先于历史过期；
+        恢复为初始state时删除
+        """
+        key = ctx_key(user_id)
+        if state == default_state():
+            if state != loaded:
+                pipe.delete(key)
+        elif state != loaded:
+            pipe.set(key, encode_state(state), ex=self.ttl or None)
+        elif self.ttl:
+            pipe.expire(key, self.ttl)
+
+    @staticmethod
+    def snapshot(state: Dict[str, Any]) -> Dict[str, Any]:
+        """工具会修改ctx中的state，保存一份副本用于比较是否变化"""
+        return copy.deepcopy(state)
+
+
+# 单例，全局共享
+ctx_state_store = CtxStateStore()
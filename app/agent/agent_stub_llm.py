@@ -0,0 +1,204 @@
+import asyncio
+import time
+import zlib
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Sequence, Tuple
+
+from llama_index.core.base.llms.types import (
+    ChatMessage, ChatResponse, ChatResponseAsyncGen, ChatResponseGen, CompletionResponse, CompletionResponseAsyncGen,
+    CompletionResponseGen, LLMMetadata, MessageRole,
+)
+from llama_index.core.llms.function_calling import FunctionCallingLLM
+from llama_index.core.llms.llm import ToolSelection
+from llama_index.core.tools import BaseTool
+from pydantic import Field
+
+from app.config import settings
+from app.agent.agent_prerouter import KeywordRouter, REFIT_AGENT, ROUTER_AGENT, SPECIALIST_AGENTS
+
+# AgentWorkflow会把state拼接到用户消息前，路由时只看用户的原始问题
+CURRENT_MESSAGE_MARKER = "Current message:"
+
+ADJUST_PLAN_TOOL = "adjust_workout_plan_tool"
+
+_keyword_router = KeywordRouter()
+
+
+class StubLLM(FunctionCallingLLM):
+    """
+    用于压测的确定性LLM，不访问网络，行为只取决于输入:
+        - 有handoff工具（路由智能体）时，按关键词规则或问题的哈希转发到专业智能体
+        - 作为入口的专业智能体遇到关键词属于其他分类的问题时，转交回路由智能体
+        - 个人定制类问题第一次调用adjust_workout_plan_tool工具，拿到工具结果后给出最终回复
+        - 其他情况按 STUB_LLM_TTFT_MS / STUB_LLM_TOKEN_MS 的延迟逐个token流式输出回复
+    """
+
+    ttft_ms: float = Field(default=settings.STUB_LLM_TTFT_MS, description="首个token的延迟")
+    token_ms: float = Field(default=settings.STUB_LLM_TOKEN_MS, description="每个token的延迟")
+    response_tokens: int = Field(default=settings.STUB_LLM_RESPONSE_TOKENS, description="回复的token数")
+    tool_calls: bool = Field(default=settings.STUB_LLM_TOOL_CALLS, description="是否模拟工具调用")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="stub", is_chat_model=True, is_function_calling_model=True)
+
+    def _prepare_chat_with_tools(
+            self,
+            tools: Sequence[BaseTool],
+            user_msg: Optional[Any] = None,
+            chat_history: Optional[List[ChatMessage]] = None,
+            verbose: bool = False,
+            allow_parallel_tool_calls: bool = False,
+            **kwargs: Any,
+    ) -> Dict[str, Any]:
+        messages = list(chat_history or [])
+        if user_msg is not None:
+            messages.append(user_msg if isinstance(user_msg, ChatMessage) else ChatMessage(content=str(user_msg)))
+        return {"messages": messages, "tools": tools}
+
+    def get_tool_calls_from_response(
+            self, response: ChatResponse, error_on_no_tool_call: bool = True, **kwargs: Any
+    ) -> List[ToolSelection]:
+        tool_calls = response.message.additional_kwargs.get("tool_calls", [])
+        if not tool_calls and error_on_no_tool_call:
+            raise ValueError("Expected at least one tool call, but got 0 tool calls.")
+        return tool_calls
+
+    def _decide(self, messages: Sequence[ChatMessage], tools: Optional[Sequence[BaseTool]]) -> Tuple[
+        str, List[ToolSelection]]:
+        """根据对话和可用工具决定回复内容或工具调用"""
+        tools_by_name = {tool.metadata.name: tool for tool in tools or []}
+        # 用户最后一个问题之后已经调用过的工具（每个工具每轮只调用一次）和转交的目标智能体
+        query, called, handoffs = "", set(), []
+        for message in reversed(messages):
+            if message.role == MessageRole.USER:
+                query = (message.content or "").rsplit(CURRENT_MESSAGE_MARKER, 1)[-1].strip()
+                break
+            for tool_call in reversed(message.additional_kwargs.get("tool_calls") or []):
+                if isinstance(tool_call, ToolSelection):
+                    tool_name, tool_kwargs = tool_call.tool_name, tool_call.tool_kwargs
+                else:
+                    tool_name, tool_kwargs = tool_call.get("tool_name"), tool_call.get("tool_kwargs") or {}
+                called.add(tool_name)
+                if tool_name == "handoff":
+                    handoffs.insert(0, tool_kwargs.get("to_agent"))
+        seed = zlib.crc32(f"{query}:{len(messages)}".encode("utf-8"))
+        system = (messages[0].content or "") if messages and messages[0].role == MessageRole.SYSTEM else ""
+
+        handoff_tool = tools_by_name.get("handoff")
+        if handoff_tool is not None:
+            agent = _keyword_router.route(query).agent
+            if any(name in handoff_tool.metadata.description for name in SPECIALIST_AGENTS):
+                # 路由智能体: 本轮还没有转交给专业智能体时转交
+                if not handoffs or handoffs[-1] == ROUTER_AGENT:
+                    return "", [self._handoff(seed, agent or SPECIALIST_AGENTS[seed % len(SPECIALIST_AGENTS)])]
+            elif not handoffs and agent and agent not in system:
+                # 入口的专业智能体（系统提示词中带有自己的名字）: 问题属于其他分类时转交回路由智能体
+                return "", [self._handoff(seed, ROUTER_AGENT)]
+
+        if self.tool_calls and ADJUST_PLAN_TOOL in tools_by_name and ADJUST_PLAN_TOOL not in called:
+            if _keyword_router.route(query).agent == REFIT_AGENT:
+                return "", [ToolSelection(
+                    tool_id=f"call_{seed:x}", tool_name=ADJUST_PLAN_TOOL,
+                    tool_kwargs={"args": {"workout_duration": "15-20"}},
+                )]
+
+        words = [f"w{(seed + i) % 997}" for i in range(self.response_tokens)]
+        return " ".join(words), []
+
+    @staticmethod
+    def _handoff(seed: int, agent: str) -> ToolSelection:
+        return ToolSelection(
+            tool_id=f"call_{seed:x}", tool_name="handoff", tool_kwargs={"to_agent": agent, "reason": "stub"},
+        )
+
+    @staticmethod
+    def _usage(messages: Sequence[ChatMessage], text: str) -> Dict[str, Any]:
+        # 按4个字符一个token粗略估算，供token用量指标使用
+        prompt_tokens = sum(len(message.content or "") for message in messages) // 4
+        # 模拟隐式缓存: 系统提示词中与语言无关的前缀视为命中缓存
+        system = (messages[0].content or "") if messages and messages[0].role == MessageRole.SYSTEM else ""
+        cached_tokens = len(system.split("输出语言:", 1)[0]) // 4
+        completion_tokens = len(text.split())
+        return {"usage_metadata": {
+            "prompt_token_count": prompt_tokens,
+            "cached_content_token_count": cached_tokens,
+            "candidates_token_count": completion_tokens,
+            "total_token_count": prompt_tokens + completion_tokens,
+        }}
+
+    def _chunks(self, messages: Sequence[ChatMessage], tools: Optional[Sequence[BaseTool]]) -> List[
+        Tuple[float, ChatResponse]]:
+        """返回 [(输出前的延迟秒数, 累计的ChatResponse)]"""
+        text, tool_calls = self._decide(messages, tools)
+        raw = self._usage(messages, text)
+        if tool_calls:
+            message = ChatMessage(role=MessageRole.ASSISTANT, content="", additional_kwargs={"tool_calls": tool_calls})
+            return [(self.ttft_ms / 1000, ChatResponse(message=message, delta="", raw=raw))]
+
+        chunks = []
+        content = ""
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            content += delta
+            delay = (self.ttft_ms if i == 0 else self.token_ms) / 1000
+            chunks.append((delay, ChatResponse(
+                message=ChatMessage(role=MessageRole.ASSISTANT, content=content),
+                delta=delta,
+                raw=raw if i == len(words) - 1 else {},
+            )))
+        return chunks
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = None
+        for delay, response in self._chunks(messages, kwargs.get("tools")):
+            time.sleep(delay)
+        return response
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        def gen() -> Generator[ChatResponse, None, None]:
+            for delay, response in self._chunks(messages, kwargs.get("tools")):
+                time.sleep(delay)
+                yield response
+
+        return gen()
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = None
+        for delay, response in self._chunks(messages, kwargs.get("tools")):
+            await asyncio.sleep(delay)
+        return response
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        async def gen() -> AsyncGenerator[ChatResponse, None]:
+            for delay, response in self._chunks(messages, kwargs.get("tools")):
+                await asyncio.sleep(delay)
+                yield response
+
+        return gen()
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        response = self.chat([ChatMessage(role=MessageRole.USER, content=prompt)])
+        return CompletionResponse(text=response.message.content or "", raw=response.raw)
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen() -> Generator[CompletionResponse, None, None]:
+            for response in self.stream_chat([ChatMessage(role=MessageRole.USER, content=prompt)]):
+                yield CompletionResponse(text=response.message.content or "", delta=response.delta)
+
+        return gen()
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        response = await self.achat([ChatMessage(role=MessageRole.USER, content=prompt)])
+        return CompletionResponse(text=response.message.content or "", raw=response.raw)
+
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        async def gen() -> AsyncGenerator[CompletionResponse, None]:
+            async for response in await self.astream_chat([ChatMessage(role=MessageRole.USER, content=prompt)]):
+                yield CompletionResponse(text=response.message.content or "", delta=response.delta)
+
+        return gen()
@@ -0,0 +1,115 @@
+import asyncio
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+from llama_index.core.llms import ChatMessage, MessageRole, LLM
+
+from app.logger import get_logger
+from app.config import settings
+from app.db.redis.codec import decode_message
+from app.db.redis.session import RELEASE_SCRIPT, redis_memory, summary_key
+
+logger = get_logger("memory_summary")
+
+SUMMARY_PROMPT = """
+你负责为AI Coach的对话历史生成摘要。
+请将已有摘要和新增对话合并为一份新的摘要，要求:
+1. 保留用户的健身计划偏好、基础信息、身体状况、未解决的问题等后续对话需要的信息
+2. 删除寒暄和重复内容
+3. 使用第三人称描述，不超过300字
+4. 只输出摘要内容
+"""
+
+
+class ConversationSummarizer:
+    """
+    滚动摘要: 历史消息超过阈值后，在后台把较早的对话折叠进摘要，
+    摘要和已折叠的消息数量保存在 `{user_id}:summary` 中，原始消息列表保持不变
+    """
+
+    def __init__(self, llm: Optional[LLM] = None):
+        self._llm = llm
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Set[str] = set()
+
+    @property
+    def llm(self) -> LLM:
+        if self._llm is None:
+            from app.agent import agent_llms
+            self._llm = agent_llms.get_llm()
+        return self._llm
+
+    async def load(self, user_id: str) -> Tuple[str, int]:
+        """返回 (摘要内容, 已折叠进摘要的消息数量)"""
+        return self.parse(await redis_memory.redis.hgetall(summary_key(user_id)))
+
+    @staticmethod
+    def parse(data: Dict[bytes, bytes]) -> Tuple[str, int]:
+        """解析 `{user_id}:summary` 的HGETALL结果"""
+        if not data:
+            return "", 0
+        return data[b"text"].decode("utf-8"), int(data[b"upto"])
+
+    @staticmethod
+    def to_message(summary: str) -> ChatMessage:
+        return ChatMessage(role=MessageRole.SYSTEM, content=f"以下是与该用户较早对话的摘要:\n{summary}")
+
+    def schedule(self, user_id: str):
+        """在后台生成摘要，同一用户同时只运行一个任务"""
+        if user_id in self._running:
+            return
+        self._running.add(user_id)
+        task = asyncio.create_task(self._run(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, user_id: str):
+        try:
+            await self.summarize(user_id)
+        except Exception as e:
+            logger.error("生成对话摘要失败: user_id={}, error={}", user_id, e)
+        finally:
+            self._running.discard(user_id)
+
+    async def summarize(self, user_id: str) -> bool:
+        """把最近 MEMORY_SUMMARY_RECENT_MESSAGES 条之前的未摘要消息折叠进摘要"""
+        lock_key = f"{summary_key(user_id)}:lock"
+        token = uuid.uuid4().hex
+        # 多进程部署时避免重复摘要
+        if not await redis_memory.redis.set(lock_key, token, nx=True, ex=settings.MEMORY_SUMMARY_LOCK_TTL):
+            return False
+        try:
+            summary, upto = await self.load(user_id)
+            end = await redis_memory.redis.llen(user_id) - settings.MEMORY_SUMMARY_RECENT_MESSAGES
+            end = min(end, upto + settings.MEMORY_SUMMARY_MAX_FOLD_MESSAGES)
+            if end <= upto:
+                return False
+
+            raw_messages = await redis_memory.redis.lrange(user_id, upto, end - 1)
+            messages = [decode_message(raw) for raw in raw_messages]
+            new_summary = await self._fold(summary, messages)
+
+            pipe = redis_memory.redis.pipeline(transaction=True)
+            pipe.hset(summary_key(user_id), mapping={"text": new_summary, "upto": end})
+            if redis_memory.ttl:
+                pipe.expire(summary_key(user_id), redis_memory.ttl)
+            await pipe.execute()
+            logger.info("已更新对话摘要: user_id={}, 折叠消息 {}-{}", user_id, upto, end)
+            return True
+        finally:
+            # 摘要耗时超过锁的TTL时锁可能已被其他进程获取，比较token后再删除
+            await redis_memory.redis.eval(RELEASE_SCRIPT, 1, lock_key, token)
+
+    async def _fold(self, summary: str, messages: List[ChatMessage]) -> str:
+        transcript = "\n".join(
+            f"{message.role.value}: {message.content}" for message in messages if message.content
+        )
+        response = await self.llm.achat([
+            ChatMessage(role=MessageRole.SYSTEM, content=SUMMARY_PROMPT),
+            ChatMessage(role=MessageRole.USER, content=f"已有摘要:\n{summary or '无'}\n\n新增对话:\n{transcript}"),
+        ])
+        return (response.message.content or "").strip()
+
+
+# 单例，全局共享
+conversation_summarizer = ConversationSummarizer()
@@ -4,8 +4,13 @@ from llama_index.core.tools import FunctionTool
 from llama_index.core.workflow import Context
 from pydantic import BaseModel, Field
 
+from app import outbox
+from app.agent.agent_profile import profile_store
+from app.config import settings
 from app.logger import get_logger
-from app.tools import post_msg
+from app.resilience import get_endpoint
+from app.tools import lark_client
+from app.tracing import span
 
 logger = get_logger("agent_tools")
 
@@ -46,24 +51,46 @@ class UpdateBasicInformationArgs(BaseModel):
 
 
 async def safe_put_with_retry(
-        payload: Dict[str, Any], request_name: str, ctx: Context
+        payload: Dict[str, Any], request_name: str, ctx: Context, profile: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
-    try:
-        user_email = await ctx.get("user_id")
-        result = post_msg(user_email=user_email, msg=payload)
-        if result:
-            return {"success": True}
-        else:
-            raise Exception("调用工具失败")
-    except Exception as e:
-        logger.error(f"修改用户的 {request_name} 失败, Exception: {e}")
+    """
+    推送用户的修改
+        - 开启outbox时写入Redis stream后立即返回 {"success", "queued", "idempotency_key"}，由outbox worker异步投递
+        - 否则直接调用飞书，返回带重试、并发限制和熔断的结构化结果:
+          {"success", "attempts", "elapsed_ms", "error", "circuit_open", "rejected"}
+    profile为需要同步到长期用户档案的修改 {"values", "remove"}，只在推送成功后写入:
+    开启outbox时随消息一起写入stream，由outbox worker在投递成功后写入
+    """
+    user_email = await ctx.get("user_id")
+    if settings.OUTBOX_ENABLED:
+        try:
+            with span("outbox.enqueue", request_name=request_name):
+                idempotency_key = await outbox.enqueue(
+                    kind="lark", user_id=user_email, payload=payload, request_name=request_name, profile=profile
+                )
+            return {"success": True, "queued": True, "idempotency_key": idempotency_key}
+        except Exception as e:
+            logger.error("写入outbox失败，改为直接推送, Exception: {}", e)
+
+    with span("lark.send", request_name=request_name) as current:
+        result = await get_endpoint("lark").call(
+            lambda: lark_client.send_msg(user_email=user_email, msg=payload)
+        )
+        if current:
+            current.set(success=result.success, attempts=result.attempts)
+    if result.success:
+        await profile_store.apply(user_email, profile)
+    else:
+        logger.error("修改用户的 {} 失败, Result: {}", request_name, result)
+    return result.to_dict()
 
 
 async def update_ctx_data(
         ctx: Context, key: str, value: Any, payload: Dict[str, Any], state_key: str
 ) -> Tuple[Dict[str, Any], Context]:
-    state = await ctx.get("state") or {}
-    state.setdefault(state_key, {})
+    # 复制后再修改，避免修改到AgentWorkflow共享的initial_state
+    state = dict(await ctx.get("state") or {})
+    state[state_key] = dict(state.get(state_key) or {})
     if value:
         state[state_key][key] = value
         payload[key] = value
@@ -105,8 +132,7 @@ async def adjust_plan(
     """
     try:
         args = dict(args)
-        logger.info(f"修改用户计划, Args: {args}, Type: {type(args)}")
-        logger.info(f"Ctx: {ctx.data}")
+        logger.debug("修改用户计划, Args: {}", args)
 
         # 从args中提取参数
         workout_type = args.get("workout_type", "")
@@ -126,7 +152,7 @@ async def adjust_plan(
             {"key": "physical_limitation", "value": physical_limitation},
             {"key": "cancel_workout_type", "value": cancel_workout_type}
         ]
-        logger.info(f"调用 adjust plan tool，参数：{plan_list}")
+        logger.debug("调用 adjust plan tool，参数：{}", plan_list)
 
         # 创建有效的参数负载
         payload = {}
@@ -149,20 +175,22 @@ async def adjust_plan(
                 state_key="workout_plan_params",
             )
 
+        # 从档案的运动类型中删除取消的类型，i_want_all为全部删除
+        remove = {"workout_type": cancel_workout_type} if cancel_workout_type else None
         result = await safe_put_with_retry(
-            payload=payload, request_name="Plan", ctx=ctx
+            payload=payload, request_name="Plan", ctx=ctx, profile={"values": payload, "remove": remove}
         )
 
         # 判断哪些参数被修改了
-        if modified_params:
-            return f"成功修改了以下参数: {', '.join(modified_params)}。Result: {result}"
-        else:
+        if not modified_params:
             return "没有参数被修改，因为没有提供有效的参数值。"
+        if result["success"]:
+            return f"成功修改了以下参数: {', '.join(modified_params)}。Result: {result}"
+        return f"修改以下参数失败: {', '.join(modified_params)}，请告知用户稍后重试。Result: {result}"
 
     except Exception as e:
-        error_msg = f"修改计划时发生错误: {str(e)}"
-        logger.error(error_msg)
-        return error_msg
+        logger.error("修改计划时发生错误: {}", e)
+        return f"修改计划时发生错误: {e}"
 
 
 async def update_basic_information(
@@ -191,14 +219,14 @@ async def update_basic_information(
         ValueError: 当提供的参数值不在允许的范围内时
     """
     args = dict(args)
-    logger.info(f"修改用户信息, Args: {args}, Type: {type(args)}")
+    logger.debug("修改用户信息, Args: {}", args)
     basic_information_list = [
         {"key": "nickname", "value": args.get("nickname", "")},
         {"key": "age", "value": args.get("age", "")},
         {"key": "height", "value": args.get("height", "")},
         {"key": "weight", "value": args.get("weight", "")},
     ]
-    logger.info(f"Basic information: {basic_information_list}")
+    logger.debug("Basic information: {}", basic_information_list)
     payload = {}
     for basic_information in basic_information_list:
         key = basic_information.get("key")
@@ -210,12 +238,13 @@ async def update_basic_information(
             payload=payload,
             state_key="basic_info_params",
         )
-    logger.info(f"Payload: {payload}")
+    logger.debug("Payload: {}", payload)
     result = await safe_put_with_retry(
-        payload=payload, request_name="Basic Information", ctx=ctx
+        payload=payload, request_name="Basic Information", ctx=ctx, profile={"values": payload}
     )
-
-    return f"Basic Information已更新, Result: {result}"
+    if result["success"]:
+        return f"Basic Information已更新, Result: {result}"
+    return f"Basic Information更新失败，请告知用户稍后重试, Result: {result}"
 
 
 adjust_plan_tool = FunctionTool.from_defaults(
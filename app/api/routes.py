@@ -1,14 +1,32 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+import math
+import secrets
+from typing import Any, AsyncIterator, Dict
 
-from app.agent.agent_chat import multi_agent_chat
+import orjson
+from fastapi import APIRouter, HTTPException, Depends, Header, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+
+from app.agent.agent_batch import multi_agent_chat_batch
+from app.agent.agent_chat import multi_agent_chat, multi_agent_chat_stream
+from app.admission import AdmissionRejected, admission_controller
 from app.agent.agent_memory import MemoryManager
-from app.api.schema import ChatRequest
+from app.agent.agent_profile import profile_store
+from app.config import settings
+from app.api.schema import BatchChatRequest, ChatRequest
 from app.logger import get_logger
+from app.metrics import metrics_registry, render
 
 logger = get_logger("agent_routes")
 
 router = APIRouter()
+# 不带/api前缀，供Prometheus抓取
+metrics_router = APIRouter()
+
+
+def _rejected(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e),
+                         headers={"Retry-After": str(int(math.ceil(e.retry_after)))})
 
 
 @router.post("/chat")
@@ -16,13 +34,125 @@ async def chat(request: ChatRequest) -> JSONResponse:
     user_id = request.user_id
     query = request.query
     user_langauge = request.user_language
-    logger.info(f"收到非流式聊天请求: user_id={user_id}, query='{query}")
+    logger.info("收到非流式聊天请求: user_id={}", user_id)
+    logger.debug("query={}", query)
     memory_manager = MemoryManager(user_id=user_id)
     try:
-        response = await multi_agent_chat(user_id=user_id, query=query, memory_manager=memory_manager,
-                                          user_language=user_langauge)
-        return JSONResponse(content=response)
-    except Exception as e:
-        logger.error(f"聊天处理失败: user_id={request.user_id}, error={str(e)}")
-        # logger.exception("详细错误信息:")
-        raise HTTPException(status_code=500, detail=f"聊天处理失败: {str(e)}")
+        async with admission_controller.admit(user_id):
+            try:
+                response = await multi_agent_chat(user_id=user_id, query=query, memory_manager=memory_manager,
+                                                  user_language=user_langauge)
+                return JSONResponse(content=response)
+            except Exception as e:
+                logger.error("聊天处理失败: user_id={}, error={}", request.user_id, e)
+                # logger.exception("详细错误信息:")
+                raise HTTPException(status_code=500, detail=f"聊天处理失败: {str(e)}")
+    except AdmissionRejected as e:
+        logger.warning("请求被拒绝: user_id={}, reason={}", user_id, e)
+        raise _rejected(e)
+
+
+def _to_sse(event: Dict[str, Any]) -> bytes:
+    """将事件编码为SSE格式"""
+    return b"event: " + event["event"].encode() + b"\ndata: " + orjson.dumps(event["data"]) + b"\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest) -> StreamingResponse:
+    user_id = request.user_id
+    query = request.query
+    user_langauge = request.user_language
+    logger.info("收到流式聊天请求: user_id={}", user_id)
+    logger.debug("query={}", query)
+    memory_manager = MemoryManager(user_id=user_id)
+    # 在返回响应前完成准入，被拒绝时直接返回429/503而不是在流中报错
+    ticket = None
+    if settings.ADMISSION_ENABLED:
+        try:
+            ticket = await admission_controller.acquire(user_id)
+        except AdmissionRejected as e:
+            logger.warning("请求被拒绝: user_id={}, reason={}", user_id, e)
+            raise _rejected(e)
+
+    async def event_stream() -> AsyncIterator[bytes]:
+        try:
+            async for event in multi_agent_chat_stream(user_id=user_id, query=query, memory_manager=memory_manager,
+                                                       user_language=user_langauge):
+                yield _to_sse(event)
+        finally:
+            if ticket is not None:
+                await ticket.release()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 客户端在输出开始前断开时生成器不会执行，由后台任务兜底释放
+        background=BackgroundTask(ticket.release) if ticket is not None else None,
+    )
+
+
+@router.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest) -> StreamingResponse:
+    """批量聊天，每条消息完成后输出一行JSON(NDJSON)，通过index对应请求中的位置"""
+    if len(request.items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"单次最多提交 {settings.BATCH_MAX_ITEMS} 条消息")
+    logger.info("收到批量聊天请求: items={}", len(request.items))
+    items = [(item.user_id, item.query, item.user_language) for item in request.items]
+    release = None
+    if settings.ADMISSION_ENABLED:
+        try:
+            release = admission_controller.acquire_batch_request()
+        except AdmissionRejected as e:
+            logger.warning("批量请求被拒绝: {}", e)
+            raise _rejected(e)
+
+    async def result_stream() -> AsyncIterator[bytes]:
+        try:
+            async for result in multi_agent_chat_batch(items, concurrency=request.concurrency):
+                yield orjson.dumps(result) + b"\n"
+        finally:
+            if release is not None:
+                await release()
+
+    return StreamingResponse(
+        result_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 客户端在输出开始前断开时生成器不会执行，由后台任务兜底释放
+        background=BackgroundTask(release) if release is not None else None,
+    )
+
+
+def require_admin(x_admin_token: str = Header(default="")):
+    """档案包含用户的个人信息，只对携带 PROFILE_ADMIN_TOKEN 的内部调用开放，未配置时接口不存在"""
+    if not settings.PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(x_admin_token.encode(), settings.PROFILE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="无效的管理员token")
+
+
+@router.get("/profiles/cohort", dependencies=[Depends(require_admin)])
+async def profile_cohort(request: Request, limit: int = settings.PROFILE_COHORT_LIMIT) -> JSONResponse:
+    """
+    按档案字段查询用户，例如 /profiles/cohort?physical_limitation=knee，
+    多个条件时返回同时满足的用户；total为总数，user_ids为随机抽取的最多 PROFILE_COHORT_LIMIT 个用户
+    """
+    criteria = {key: value for key, value in request.query_params.items() if key != "limit"}
+    try:
+        profile_store.validate_criteria(criteria)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    total, user_ids = await profile_store.cohort(criteria, min(max(limit, 0), settings.PROFILE_COHORT_LIMIT))
+    return JSONResponse(content={"total": total, "user_ids": user_ids})
+
+
+@router.get("/profiles/{user_id}", dependencies=[Depends(require_admin)])
+async def profile(user_id: str) -> JSONResponse:
+    return JSONResponse(content={"user_id": user_id, "profile": await profile_store.load(user_id)})
+
+
+@metrics_router.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    snapshot = await metrics_registry.collect()
+    return PlainTextResponse(render(snapshot), media_type="text/plain; version=0.0.4")
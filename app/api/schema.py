@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from pydantic import BaseModel
 
 
@@ -6,3 +8,9 @@ class ChatRequest(BaseModel):
     user_id: str
     query: str
     user_language: str
+
+
+class BatchChatRequest(BaseModel):
+    """批量聊天请求模型"""
+    items: List[ChatRequest]
+    concurrency: Optional[int] = None  # 同时执行的消息数，默认 BATCH_CONCURRENCY
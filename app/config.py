@@ -16,11 +16,164 @@ class Settings(BaseSettings):
     GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY", "")
     GOOGLE_MODEL: str = os.getenv("GOOGLE_MODEL", "")
     OLLAMA_MODEL: str = os.getenv("OLLAMA_MODEL", "")
+    LLM_PROVIDER: str = os.getenv("LLM_PROVIDER", "gemini")  # 主provider: gemini、ollama 或 stub(离线压测)
+    LLM_FALLBACK_PROVIDERS: str = os.getenv("LLM_FALLBACK_PROVIDERS", "")  # 备用provider，按顺序逗号分隔，例如 ollama
+    LLM_HEDGE_AFTER_MS: float = float(os.getenv("LLM_HEDGE_AFTER_MS", 4000))  # 首个chunk超过该时间时向备用provider对冲，0为不对冲
+    LLM_FIRST_CHUNK_TIMEOUT: float = float(os.getenv("LLM_FIRST_CHUNK_TIMEOUT", 30))  # 所有provider等待首个chunk的总时间(秒)
+    LLM_PROVIDER_CONCURRENCY: str = os.getenv("LLM_PROVIDER_CONCURRENCY", "gemini=64,ollama=4")  # 每个provider的最大并发数
+    LLM_DEFAULT_CONCURRENCY: int = int(os.getenv("LLM_DEFAULT_CONCURRENCY", 64))
+    OLLAMA_BASE_URL: str = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    OLLAMA_REQUEST_TIMEOUT: float = float(os.getenv("OLLAMA_REQUEST_TIMEOUT", 60))
+
+    # 压测用的stub LLM配置
+    STUB_LLM_TTFT_MS: float = float(os.getenv("STUB_LLM_TTFT_MS", 300))
+    STUB_LLM_TOKEN_MS: float = float(os.getenv("STUB_LLM_TOKEN_MS", 10))
+    STUB_LLM_RESPONSE_TOKENS: int = int(os.getenv("STUB_LLM_RESPONSE_TOKENS", 60))
+    STUB_LLM_TOOL_CALLS: bool = os.getenv("STUB_LLM_TOOL_CALLS", "true").lower() == "true"
+
+    # 飞书配置，凭证必须通过环境变量提供，未配置时启动失败
+    LARK_APP_ID: str = os.getenv("LARK_APP_ID", "")
+    LARK_APP_SECRET: str = os.getenv("LARK_APP_SECRET", "")
+    LARK_BASE_URL: str = os.getenv("LARK_BASE_URL", "https://open.feishu.cn")
+    LARK_TIMEOUT: float = float(os.getenv("LARK_TIMEOUT", 5))
+    LARK_CONNECT_TIMEOUT: float = float(os.getenv("LARK_CONNECT_TIMEOUT", 2))
+    LARK_MAX_CONNECTIONS: int = int(os.getenv("LARK_MAX_CONNECTIONS", 20))
+    LARK_TOKEN_REFRESH_MARGIN: int = int(os.getenv("LARK_TOKEN_REFRESH_MARGIN", 300))  # 在token过期前多少秒刷新
+
+    # 工具调用容错配置
+    TOOL_RETRY_MAX_ATTEMPTS: int = int(os.getenv("TOOL_RETRY_MAX_ATTEMPTS", 3))
+    TOOL_RETRY_BASE_DELAY: float = float(os.getenv("TOOL_RETRY_BASE_DELAY", 0.2))  # 指数退避的初始间隔(秒)
+    TOOL_RETRY_MAX_DELAY: float = float(os.getenv("TOOL_RETRY_MAX_DELAY", 2))
+    TOOL_CALL_TIMEOUT: float = float(os.getenv("TOOL_CALL_TIMEOUT", 8))  # 单次尝试的超时时间(秒)
+    TOOL_MAX_CONCURRENCY: int = int(os.getenv("TOOL_MAX_CONCURRENCY", 20))  # 每个下游接口的最大并发数
+    TOOL_QUEUE_TIMEOUT: float = float(os.getenv("TOOL_QUEUE_TIMEOUT", 2))  # 并发已满时的最长排队时间(秒)
+    CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))  # 连续失败多少次后熔断
+    CIRCUIT_RECOVERY_TIMEOUT: float = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", 30))  # 熔断持续时间(秒)
+
+    # Outbox配置，工具调用的副作用写入Redis stream后由worker异步投递
+    OUTBOX_ENABLED: bool = os.getenv("OUTBOX_ENABLED", "true").lower() == "true"
+    OUTBOX_WORKERS: int = int(os.getenv("OUTBOX_WORKERS", 2))  # 每个API进程内启动的worker数，为0时需单独运行 python -m app.outbox
+    OUTBOX_STREAM: str = os.getenv("OUTBOX_STREAM", "outbox:lark")
+    OUTBOX_GROUP: str = os.getenv("OUTBOX_GROUP", "outbox-workers")
+    OUTBOX_MAXLEN: int = int(os.getenv("OUTBOX_MAXLEN", 100000))
+    OUTBOX_BATCH_SIZE: int = int(os.getenv("OUTBOX_BATCH_SIZE", 10))
+    OUTBOX_BLOCK_MS: int = int(os.getenv("OUTBOX_BLOCK_MS", 2000))  # 需小于REDIS_SOCKET_TIMEOUT
+    OUTBOX_CLAIM_IDLE_MS: int = int(os.getenv("OUTBOX_CLAIM_IDLE_MS", 30000))  # 未ack消息空闲多久后被其他worker认领重试
+    OUTBOX_MAX_DELIVERIES: int = int(os.getenv("OUTBOX_MAX_DELIVERIES", 5))
+    OUTBOX_STATUS_TTL: int = int(os.getenv("OUTBOX_STATUS_TTL", 86400))
+    OUTBOX_DEAD_LETTER_STREAM: str = os.getenv("OUTBOX_DEAD_LETTER_STREAM", "outbox:dead")  # 无法解析的消息移到这里，不再重试
+
+    # Memory配置
+    MEMORY_TOKEN_LIMIT: int = int(os.getenv("MEMORY_TOKEN_LIMIT", 40000))
+    MEMORY_LOAD_TOKEN_BUDGET: int = int(os.getenv("MEMORY_LOAD_TOKEN_BUDGET", 28000))  # 每轮从Redis加载的历史消息token上限
+    MEMORY_LOAD_PAGE_SIZE: int = int(os.getenv("MEMORY_LOAD_PAGE_SIZE", 20))  # 每次从Redis读取的消息条数
+    MEMORY_TOKEN_CACHE_SIZE: int = int(os.getenv("MEMORY_TOKEN_CACHE_SIZE", 50000))  # 缓存token数的消息条数
+    MEMORY_SUMMARY_ENABLED: bool = os.getenv("MEMORY_SUMMARY_ENABLED", "false").lower() == "true"  # 是否开启滚动摘要
+    MEMORY_SUMMARY_TRIGGER_TOKENS: int = int(os.getenv("MEMORY_SUMMARY_TRIGGER_TOKENS", 4000))  # 未摘要消息超过该token数时生成摘要
+    MEMORY_SUMMARY_WINDOW_TOKENS: int = int(os.getenv("MEMORY_SUMMARY_WINDOW_TOKENS", 6000))  # 摘要模式下加载的最近对话token上限
+    MEMORY_SUMMARY_RECENT_MESSAGES: int = int(os.getenv("MEMORY_SUMMARY_RECENT_MESSAGES", 6))  # 生成摘要时保留原文的最近消息数
+    MEMORY_SUMMARY_MAX_FOLD_MESSAGES: int = int(os.getenv("MEMORY_SUMMARY_MAX_FOLD_MESSAGES", 200))  # 单次最多折叠的消息数
+    MEMORY_SUMMARY_LOCK_TTL: int = int(os.getenv("MEMORY_SUMMARY_LOCK_TTL", 120))
+    HISTORY_CACHE_ENABLED: bool = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"  # 进程内缓存最近加载的历史对话
+    HISTORY_CACHE_MAX_BYTES: int = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 缓存占用内存上限(估算)
+    MESSAGE_CODEC: str = os.getenv("MESSAGE_CODEC", "compact")  # 消息保存格式: compact(紧凑格式)、json(旧格式)，读取时两种格式都支持
+    MESSAGE_COMPRESSION: str = os.getenv("MESSAGE_COMPRESSION", "zlib")  # 长消息的压缩方式: zlib、zstd(需安装zstandard)、none
+    MESSAGE_COMPRESS_MIN_BYTES: int = int(os.getenv("MESSAGE_COMPRESS_MIN_BYTES", 1024))  # 超过该大小的消息才压缩
+
+    # Agent配置
+    AGENT_WORKFLOW_CACHE_SIZE: int = int(os.getenv("AGENT_WORKFLOW_CACHE_SIZE", 64))  # 缓存AgentWorkflow的语言数，每种语言包含全部入口智能体，应不少于支持的语言数
+    AGENT_WORKFLOW_VERBOSE: bool = os.getenv("AGENT_WORKFLOW_VERBOSE", "true").lower() == "true"  # 打印工作流每个步骤
+
+    # 预路由配置，置信度足够高时跳过路由智能体；规则需要先用线上的路由决策日志验证，默认关闭
+    PREROUTER_ENABLED: bool = os.getenv("PREROUTER_ENABLED", "false").lower() == "true"
+    PREROUTER_CONFIDENCE_THRESHOLD: float = float(os.getenv("PREROUTER_CONFIDENCE_THRESHOLD", 0.85))
+    PREROUTER_KEYWORD_CONFIDENCE: float = float(os.getenv("PREROUTER_KEYWORD_CONFIDENCE", 0.9))  # 关键词规则唯一命中时的置信度
+    PREROUTER_MIN_TRAINING_SAMPLES: int = int(os.getenv("PREROUTER_MIN_TRAINING_SAMPLES", 200))  # 本地模型生效所需的最少样本数
+    PREROUTER_LOG_PATH: str = os.getenv("PREROUTER_LOG_PATH", "")  # 路由决策日志(JSONL)，包含用户的原始问题，同时作为本地模型的训练数据
+    PREROUTER_LOG_MAX_BYTES: int = int(os.getenv("PREROUTER_LOG_MAX_BYTES", 20 * 1024 * 1024))  # 超过后轮转为 .1，只保留一个历史文件
+
+    # 多轮追问直接由上一轮的专业智能体继续，跳过路由智能体
+    SESSION_RESUME_ENABLED: bool = os.getenv("SESSION_RESUME_ENABLED", "true").lower() == "true"
+    SESSION_RESUME_WINDOW: int = int(os.getenv("SESSION_RESUME_WINDOW", 600))  # 距上一轮回复多少秒内视为追问
+
+    # 工作流state持久化，下一轮恢复已收集的计划/基础信息参数
+    CTX_STATE_ENABLED: bool = os.getenv("CTX_STATE_ENABLED", "true").lower() == "true"
+    CTX_STATE_COMPRESS_MIN_BYTES: int = int(os.getenv("CTX_STATE_COMPRESS_MIN_BYTES", 512))  # 超过该大小时使用zlib压缩
+
+    # 长期用户档案，工具修改计划/基础信息成功后按字段保存，不过期
+    PROFILE_ENABLED: bool = os.getenv("PROFILE_ENABLED", "true").lower() == "true"
+    PROFILE_PROMPT_ENABLED: bool = os.getenv("PROFILE_PROMPT_ENABLED", "true").lower() == "true"  # 每轮把档案作为系统消息放在历史之前
+    PROFILE_COHORT_LIMIT: int = int(os.getenv("PROFILE_COHORT_LIMIT", 1000))  # 人群查询最多返回的用户数
+    PROFILE_ADMIN_TOKEN: str = os.getenv("PROFILE_ADMIN_TOKEN", "")  # 档案查询接口需要在X-Admin-Token中携带，为空时不开放这些接口
+
+    # 回复缓存配置，只缓存订阅、故障排查等模版类智能体在首轮对话（没有历史、摘要、state和档案）中的回复
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+    RESPONSE_CACHE_MAX_SIZE: int = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", 2000))
+    RESPONSE_CACHE_TTL: int = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+    RESPONSE_CACHE_MIN_QUERY_LENGTH: int = int(os.getenv("RESPONSE_CACHE_MIN_QUERY_LENGTH", 6))  # 少于该词数的问题依赖上下文，不缓存（中日韩文字每个字算一个词）
+    RESPONSE_CACHE_SIMILARITY_THRESHOLD: float = float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", 0.92))
 
     # Redis配置
     REDIS_DATABASE_URL: str = os.getenv("REDIS_DATABASE_URL", "redis://localhost:6379")
     REDIS_MEMORY_TTL: int = int(os.getenv("REDIS_MEMORY_TTL", 3600))  # 短期记忆默认保存1小时
     SHORT_MEMORY_DB_NAME: str = os.getenv("SHORT_MEMORY_DB_NAME", "")
+    REDIS_POOL_MAX_CONNECTIONS: int = int(os.getenv("REDIS_POOL_MAX_CONNECTIONS", 50))  # 每个进程的最大连接数
+    REDIS_POOL_TIMEOUT: float = float(os.getenv("REDIS_POOL_TIMEOUT", 5))  # 连接池耗尽时等待空闲连接的秒数
+    REDIS_SOCKET_TIMEOUT: float = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 2))
+    REDIS_HEALTH_CHECK_INTERVAL: int = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+    REDIS_POOL_MONITOR_INTERVAL: float = float(os.getenv("REDIS_POOL_MONITOR_INTERVAL", 10))
+    REDIS_POOL_SATURATION_THRESHOLD: float = float(os.getenv("REDIS_POOL_SATURATION_THRESHOLD", 0.9))  # 连接池使用率告警阈值
+
+    # 日志配置
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_DIR: str = os.getenv("LOG_DIR", "")  # 默认 app/logs
+    LOG_FILE_NAME: str = os.getenv("LOG_FILE_NAME", "app")
+    LOG_JSON: bool = os.getenv("LOG_JSON", "true").lower() == "true"  # 文件日志使用JSON格式
+    LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", 10000))  # 日志队列满时丢弃而不是阻塞
+    LOG_FILE_PER_PROCESS: bool = os.getenv("LOG_FILE_PER_PROCESS", "true").lower() == "true"  # 文件名带进程号，多worker时各自轮转，已退出进程的文件按 LOG_RETENTION_FILES 清理
+    LOG_ROTATION_BYTES: int = int(os.getenv("LOG_ROTATION_BYTES", 10 * 1024 * 1024))  # 小于等于0时不轮转，交给logrotate等外部工具
+    LOG_RETENTION_FILES: int = int(os.getenv("LOG_RETENTION_FILES", 7))
+    LOG_SAMPLE_RATES: str = os.getenv("LOG_SAMPLE_RATES", "")  # 按logger采样INFO/DEBUG日志，例如 agent_chat=0.1,tools=0.5
+
+    # 链路追踪配置
+    TRACING_ENABLED: bool = os.getenv("TRACING_ENABLED", "true").lower() == "true"  # 记录各阶段耗时并返回Server-Timing响应头
+    TRACE_EXPORTER: str = os.getenv("TRACE_EXPORTER", "")  # 导出方式: 空(不导出)、file、otlp
+    TRACE_FILE_PATH: str = os.getenv("TRACE_FILE_PATH", str(Path(__file__).resolve().parent / "logs" / "traces.jsonl"))
+    TRACE_OTLP_ENDPOINT: str = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    TRACE_SERVICE_NAME: str = os.getenv("TRACE_SERVICE_NAME", "ai-coach")
+    TRACE_EXPORT_QUEUE_SIZE: int = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", 1000))
+    TRACE_EXPORT_BATCH_SIZE: int = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", 50))
+    TRACE_EXPORT_TIMEOUT: float = float(os.getenv("TRACE_EXPORT_TIMEOUT", 5))
+    TRACE_MAX_SPANS: int = int(os.getenv("TRACE_MAX_SPANS", 1000))  # 每个trace最多记录的span数，超出的丢弃并计数
+
+    # 监控指标配置
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_MULTIPROCESS: bool = os.getenv("METRICS_MULTIPROCESS", "true").lower() == "true"  # 通过Redis合并多个worker的指标
+    METRICS_KEY_PREFIX: str = os.getenv("METRICS_KEY_PREFIX", "metrics:worker:")
+    METRICS_REGISTRY_KEY: str = os.getenv("METRICS_REGISTRY_KEY", "metrics:workers")  # 登记所有worker的有序集合，分数为登记过期时间
+    METRICS_RETIRED_KEY: str = os.getenv("METRICS_RETIRED_KEY", "metrics:retired")  # 已退出worker的counter和histogram合计
+    METRICS_PUBLISH_INTERVAL: float = float(os.getenv("METRICS_PUBLISH_INTERVAL", 5))  # 每个worker发布指标快照的间隔
+    METRICS_SNAPSHOT_TTL: int = int(os.getenv("METRICS_SNAPSHOT_TTL", 30))  # 多久没有发布快照视为worker已退出
+
+    # 准入控制配置
+    ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    ADMISSION_MAX_IN_FLIGHT: int = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 100))  # 每个worker同时执行的聊天请求数
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", 200))  # 排队请求数超过该值时直接返回503
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 2))  # 排队超过该秒数返回503
+    ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", 1))  # 503/429响应的Retry-After秒数
+    USER_LOCK_BACKEND: str = os.getenv("USER_LOCK_BACKEND", "redis")  # 同一用户请求串行: redis(多worker)、local(单worker)、none
+    USER_LOCK_WAIT_TIMEOUT: float = float(os.getenv("USER_LOCK_WAIT_TIMEOUT", 10))  # 等待同一用户上一条消息处理完成的秒数
+    USER_LOCK_TTL_MS: int = int(os.getenv("USER_LOCK_TTL_MS", 30000))  # 持有期间自动续期，进程崩溃后在TTL后释放
+
+    # 批量聊天接口配置
+    BATCH_MAX_ITEMS: int = int(os.getenv("BATCH_MAX_ITEMS", 10000))  # 单次批量请求的最大消息数，超过返回413
+    BATCH_CONCURRENCY: int = int(os.getenv("BATCH_CONCURRENCY", 20))  # 请求未指定时同时执行的消息数
+    BATCH_MAX_CONCURRENCY: int = int(os.getenv("BATCH_MAX_CONCURRENCY", 100))  # 请求可指定的并发上限
+    BATCH_MAX_IN_FLIGHT: int = int(os.getenv("BATCH_MAX_IN_FLIGHT", 20))  # 每个worker所有批量请求合计同时执行的消息数，独立于在线请求
+    BATCH_MAX_REQUESTS: int = int(os.getenv("BATCH_MAX_REQUESTS", 2))  # 每个worker同时执行的批量请求数，超过时返回503
+    BATCH_PREFETCH_SIZE: int = int(os.getenv("BATCH_PREFETCH_SIZE", 100))  # 每个pipeline预读历史的用户数
+    BATCH_WRITE_DELAY_MS: float = float(os.getenv("BATCH_WRITE_DELAY_MS", 5))  # 合并Memory写入时等待其他消息的毫秒数
 
 
 # 创建全局配置实例
@@ -0,0 +1,92 @@
+import zlib
+from typing import Any, List, Optional
+
+import orjson
+from llama_index.core.base.llms.types import TextBlock
+from llama_index.core.llms import ChatMessage
+
+from app.config import settings
+
+# 格式: 1字节版本 + 1字节标志 + orjson数组(可选压缩)
+#   [角色编号, 文本]                   只有一个文本块、没有additional_kwargs（绝大多数消息）
+#   [角色编号, 文本, additional_kwargs]
+#   [角色编号, [块...], additional_kwargs] 图片等非文本块，块按pydantic的JSON格式保存
+# 旧格式为 ChatMessage.model_dump_json()，以 "{" 开头，读取时自动识别
+MESSAGE_VERSION = 1
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+LEGACY_PREFIX = b"{"[0]
+
+# 只能在末尾追加，已保存的数据按编号解析
+ROLES = ("system", "developer", "user", "assistant", "function", "tool", "chatbot", "model")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("使用zstd压缩需要安装: pip install zstandard") from e
+    return zstandard
+
+
+def _compress(data: bytes, compression: str) -> Optional[bytes]:
+    if compression == "zstd":
+        return _zstd().ZstdCompressor(level=3).compress(data)
+    if compression == "zlib":
+        return zlib.compress(data, 1)
+    return None
+
+
+def encode_message(
+        message: ChatMessage,
+        compression: str = settings.MESSAGE_COMPRESSION,
+        compress_min_bytes: int = settings.MESSAGE_COMPRESS_MIN_BYTES,
+) -> bytes:
+    role = message.role.value if hasattr(message.role, "value") else message.role
+    blocks = message.blocks
+    if len(blocks) == 1 and isinstance(blocks[0], TextBlock):
+        item: List[Any] = [ROLE_CODES.get(role, role), blocks[0].text]
+    else:
+        item = [ROLE_CODES.get(role, role), [block.model_dump(mode="json") for block in blocks]]
+    if message.additional_kwargs:
+        # 工具调用等对象按pydantic的方式转换，与旧格式保存的内容一致
+        item.append(message.model_dump(mode="json", include={"additional_kwargs"})["additional_kwargs"])
+    elif not isinstance(item[1], str):
+        item.append({})
+
+    data = orjson.dumps(item)
+    flags = 0
+    if len(data) >= compress_min_bytes:
+        compressed = _compress(data, compression)
+        if compressed is not None and len(compressed) < len(data):
+            data, flags = compressed, FLAG_ZSTD if compression == "zstd" else FLAG_ZLIB
+    return bytes((MESSAGE_VERSION, flags)) + data
+
+
+def decode_message(raw: bytes) -> ChatMessage:
+    if raw[0] == LEGACY_PREFIX:
+        return ChatMessage.model_validate_json(raw)
+    if raw[0] != MESSAGE_VERSION:
+        raise ValueError(f"不支持的消息格式版本: {raw[0]}")
+
+    data = raw[2:]
+    if raw[1] & FLAG_ZSTD:
+        data = _zstd().ZstdDecompressor().decompress(data)
+    elif raw[1] & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    item = orjson.loads(data)
+
+    role = ROLES[item[0]] if isinstance(item[0], int) else item[0]
+    blocks = [{"block_type": "text", "text": item[1]}] if isinstance(item[1], str) else item[1]
+    # 直接校验dict比逐个构造TextBlock/ChatMessage更快
+    return ChatMessage.model_validate({
+        "role": role, "blocks": blocks, "additional_kwargs": item[2] if len(item) > 2 else {},
+    })
+
+
+def encode_messages(messages: List[ChatMessage]) -> List[bytes]:
+    """按 MESSAGE_CODEC 编码，json为旧格式，便于回滚到不支持新格式的版本"""
+    if settings.MESSAGE_CODEC == "json":
+        return [message.model_dump_json().encode("utf-8") for message in messages]
+    return [encode_message(message) for message in messages]
@@ -1,29 +1,227 @@
 import asyncio
-from typing import Optional, List
+import contextvars
+from functools import lru_cache
+from typing import Optional, List, Dict, Type
 
 import redis.asyncio as redis
 import orjson
 
 from app.config import settings
+from app.logger import get_logger
+
+logger = get_logger("redis_session")
+
+# 锁的值为持有者的随机token，只删除/续期自己持有的锁
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def summary_key(user_id: str) -> str:
+    """对话摘要的key"""
+    return f"{user_id}:summary"
+
+
+def session_key(user_id: str) -> str:
+    """会话状态（上一轮回复的智能体等）的key"""
+    return f"{user_id}:session"
+
+
+def ctx_key(user_id: str) -> str:
+    """工作流Context中state的key"""
+    return f"{user_id}:ctx"
+
+
+def profile_key(user_id: str) -> str:
+    """长期用户档案的key，不设置TTL"""
+    return f"{user_id}:profile"
+
+
+def profile_index_key(field: str, value: str) -> str:
+    """档案字段的二级索引，集合中保存该字段为value的用户"""
+    return f"profile:idx:{field}:{value}"
+
+
+def version_key(user_id: str) -> str:
+    """历史消息列表的版本，每次写入列表时更新为新的随机值"""
+    return f"{user_id}:ver"
+
+
+class RoundTripCounter:
+    """一轮对话中发送到Redis的请求次数，一个pipeline只算一次"""
+
+    def __init__(self):
+        self.count = 0
+
+
+_round_trips: contextvars.ContextVar[Optional[RoundTripCounter]] = contextvars.ContextVar(
+    "redis_round_trips", default=None
+)
+
+
+def track_round_trips() -> RoundTripCounter:
+    """开始统计当前上下文（包括之后创建的子任务）中的Redis往返次数"""
+    counter = RoundTripCounter()
+    _round_trips.set(counter)
+    return counter
+
+
+@lru_cache(maxsize=None)
+def _counting_connection(connection_class: Type[redis.connection.AbstractConnection]):
+    class CountingConnection(connection_class):
+        async def send_packed_command(self, command, check_health: bool = True) -> None:
+            counter = _round_trips.get()
+            if counter is not None:
+                counter.count += 1
+            await super().send_packed_command(command, check_health)
+
+    CountingConnection.__name__ = f"Counting{connection_class.__name__}"
+    return CountingConnection
+
+
+def instrument_pool(pool: redis.ConnectionPool):
+    """让连接池新建的连接统计往返次数，兼容TCP/SSL/Unix socket连接"""
+    if not pool.connection_class.__name__.startswith("Counting"):
+        pool.connection_class = _counting_connection(pool.connection_class)
 
 
 class RedisMemory:
     def __init__(self, url=settings.REDIS_DATABASE_URL, ttl=settings.REDIS_MEMORY_TTL):
-        self.redis = redis.from_url(url, encoding="utf-8", decode_responses=True)
+        self.url = url
         self.ttl = ttl
         self.memory_key = settings.SHORT_MEMORY_DB_NAME  # 总表 key
+        self.pool: Optional[redis.BlockingConnectionPool] = None
+        self._redis: Optional[redis.Redis] = None
+
+    def connect(self) -> redis.Redis:
+        """创建全局共享的连接池，连接数达到上限时等待 REDIS_POOL_TIMEOUT 秒而不是直接报错"""
+        if self._redis is None:
+            self.pool = redis.BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                # 消息以bytes读取，由调用方自行反序列化
+                decode_responses=False,
+            )
+            instrument_pool(self.pool)
+            self._redis = redis.Redis(connection_pool=self.pool)
+            logger.info("Redis连接池已创建, max_connections={}", settings.REDIS_POOL_MAX_CONNECTIONS)
+        return self._redis
+
+    async def close(self):
+        """关闭连接池，在应用退出时调用"""
+        if self._redis is not None:
+            await self._redis.aclose()
+            if self.pool is not None:
+                await self.pool.disconnect()
+            logger.info("Redis连接池已关闭")
+        self._redis = None
+        self.pool = None
 
-    async def check_filed(self, user_id: str) -> bool:
-        val = await self.redis.get(user_id)
-        return bool(val)
+    @property
+    def redis(self) -> redis.Redis:
+        return self.connect()
 
-    async def create_filed(self, user_id: str):
-        await self.redis.rpush(user_id, "__init__")
+    def pool_stats(self) -> Dict[str, int]:
+        """连接池使用情况"""
+        if self.pool is None:
+            return {"max_connections": settings.REDIS_POOL_MAX_CONNECTIONS, "in_use": 0, "idle": 0}
+        return {
+            "max_connections": self.pool.max_connections,
+            "in_use": len(self.pool._in_use_connections),
+            "idle": len(self.pool._available_connections),
+        }
+
+    async def monitor_pool(self, interval: float = settings.REDIS_POOL_MONITOR_INTERVAL):
+        """定期检查连接池，使用率超过阈值时告警"""
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.pool_stats()
+            usage = stats["in_use"] / stats["max_connections"]
+            if usage >= settings.REDIS_POOL_SATURATION_THRESHOLD:
+                logger.warning("Redis连接池接近饱和: {}", stats)
+
+
+class PipelineBatcher:
+    """
+    把多个协程的写命令合并到同一个pipeline(MULTI/EXEC)中执行，用于批量处理时减少往返:
+    第一条命令到达后最多等待 max_delay 秒，或累计 max_batch 条后立即发送。
+    MULTI/EXEC只保证命令连续执行，不会回滚: 某条命令出错时其他命令仍然生效，
+    因此只让包含出错命令的调用方失败；连接错误、超时时整个事务的结果未知，所有调用方都失败
+    """
+
+    def __init__(self, max_batch: int = 200, max_delay: float = 0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending: List = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.round_trips = 0
+
+    async def execute(self, build) -> List:
+        """
+        build(pipe) 向pipeline中添加命令，命令执行完成后返回整个事务的结果列表，出错时抛出
+        build中可以用 len(pipe) 记录自己的命令在结果中的位置
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((build, future))
+        if len(self._pending) >= self.max_batch:
+            self._schedule(0)
+        elif self._flush_handle is None:
+            self._schedule(self.max_delay)
+        return await future
+
+    def _schedule(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.create_task(self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        # 每个调用方的命令在结果中的位置
+        ranges = []
+        try:
+            async with redis_memory.redis.pipeline(transaction=True) as pipe:
+                for build, _ in pending:
+                    start = len(pipe)
+                    build(pipe)
+                    ranges.append((start, len(pipe)))
+                results = await pipe.execute(raise_on_error=False)
+            self.round_trips += 1
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), (start, end) in zip(pending, ranges):
+            if future.done():
+                continue
+            error = next((result for result in results[start:end] if isinstance(result, Exception)), None)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results)
 
 
 # 单例，全局共享连接池
 redis_memory = RedisMemory()
-
-if __name__ == '__main__':
-    data = asyncio.run(redis_memory.create_filed("123"))
-    print(data)
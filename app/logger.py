@@ -1,46 +1,284 @@
+import atexit
 import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Optional, TextIO
 
 import loguru
+import orjson
+
+from app.config import settings
 
 logger = loguru.logger
 
+_configured = False
+_configure_lock = threading.Lock()
+_sinks = []
+
+CONSOLE_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | "
+    "<cyan>{extra[logger_name]}:{line}</cyan> - <level>{message}</level>"
+)
+
+
+class RotatingFileWriter:
+    """
+    按大小轮转的日志文件，保留最近 retention 个历史文件，max_bytes<=0 时不轮转（交给logrotate等外部工具）
+    轮转时重命名文件，多个进程不能轮转同一个文件，多worker部署时每个进程使用独立的文件（见 log_file_path）
+    """
+
+    def __init__(self, path: Path, max_bytes: int, retention: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+
+    def write(self, data: bytes):
+        if 0 < self.max_bytes < self._size + len(data):
+            self._rotate()
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.retention - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        self._file = open(self.path, "ab")
+        self._size = 0
+
+
+class StreamWriter:
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def write(self, data: bytes):
+        self.stream.write(data.decode("utf-8"))
+
+    def flush(self):
+        # 解释器退出时 sys.stderr 可能已经被关闭
+        if not self.stream.closed:
+            self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+def _serialize(message) -> bytes:
+    """把日志记录序列化为一行JSON"""
+    record = message.record
+    extra = dict(record["extra"])
+    data = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "logger": extra.pop("logger_name", record["name"]),
+        "module": record["name"],
+        "line": record["line"],
+        "message": record["message"],
+        "pid": record["process"].id,
+    }
+    if extra:
+        data["extra"] = extra
+    if record["exception"] is not None:
+        data["exception"] = str(message).rstrip("\n").split("\n", 1)[-1]
+    return orjson.dumps(data, default=str) + b"\n"
+
+
+def _plain(message) -> bytes:
+    return str(message).encode("utf-8")
+
+
+def _json_notice(text: str) -> bytes:
+    return orjson.dumps({
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "level": "WARNING", "logger": "logger", "message": text,
+        "pid": os.getpid(),
+    }) + b"\n"
+
+
+def _plain_notice(text: str) -> bytes:
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S')} | WARNING | logger - {text}\n".encode("utf-8")
+
+
+def log_file_path(log_dir: Path) -> Path:
+    """LOG_FILE_PER_PROCESS 时文件名带进程号，每个worker只轮转自己的文件"""
+    if settings.LOG_FILE_PER_PROCESS:
+        return log_dir / f"{settings.LOG_FILE_NAME}.{os.getpid()}.log"
+    return log_dir / f"{settings.LOG_FILE_NAME}.log"
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cleanup_stale_logs(log_dir: Path, retention: int = settings.LOG_RETENTION_FILES):
+    """
+    LOG_FILE_PER_PROCESS 时每次重启都会产生新的 app.<pid>.log，轮转只清理当前进程自己的文件，
+    这里删除已退出进程留下的文件，只保留其中最新的 retention 个
+    """
+    pattern = re.compile(rf"^{re.escape(settings.LOG_FILE_NAME)}\.(\d+)\.log(\.\d+)?$")
+    stale = []
+    for path in log_dir.iterdir():
+        match = pattern.match(path.name)
+        if match is None:
+            continue
+        pid = int(match.group(1))
+        if pid != os.getpid() and not _process_alive(pid):
+            stale.append(path)
+    stale.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in stale[max(retention, 0):]:
+        try:
+            path.unlink()
+        except OSError as e:
+            sys.stderr.write(f"删除过期日志文件失败: {path}: {e}\n")
+
+
+class BoundedQueueSink:
+    """
+    日志写入有界队列后立即返回，由后台线程序列化并写入；
+    队列已满（磁盘或终端过慢）时丢弃日志而不是阻塞请求，并定期记录丢弃数量
+    """
+
+    def __init__(
+            self, writer, encoder: Callable, notice: Callable[[str], bytes] = _plain_notice,
+            maxsize: int = settings.LOG_QUEUE_SIZE,
+    ):
+        self.writer = writer
+        self.encoder = encoder
+        # 丢弃提示与该输出的其他日志使用相同的格式
+        self.notice = notice
+        self.queue: "queue.Queue" = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        reported = 0
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.writer.write(self.encoder(message))
+                if self.dropped != reported:
+                    self.writer.write(self.notice(f"日志队列已满，已丢弃 {self.dropped} 条日志"))
+                    reported = self.dropped
+                if self.queue.empty():
+                    self.writer.flush()
+            except Exception as e:
+                sys.stderr.write(f"写入日志失败: {e}\n")
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join(timeout=5)
+        self.writer.close()
+
+
+def _parse_sample_rates(value: str) -> Dict[str, float]:
+    """LOG_SAMPLE_RATES格式: agent_chat=0.1,agent_tools=0.5"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def _make_filter(sample_rates: Dict[str, float]):
+    def _filter(record) -> bool:
+        # WARNING及以上的日志不采样
+        if not sample_rates or record["level"].no >= 30:
+            return True
+        rate = sample_rates.get(record["extra"].get("logger_name"))
+        return rate is None or random.random() < rate
+
+    return _filter
+
+
+def setup_logging(log_dir: Optional[Path] = None):
+    """
+    进程内只配置一次日志:
+        - 控制台输出文本格式
+        - 文件输出JSON格式，按大小轮转；多worker部署时每个进程写自己的文件，避免轮转时互相覆盖，
+          启动时清理已退出进程留下的文件
+        - 两者都经过有界队列异步写入，按 LOG_SAMPLE_RATES 对低级别日志采样
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+        # 日志目录：项目根目录下 logs/
+        log_dir = log_dir or Path(settings.LOG_DIR or Path(__file__).resolve().parent / "logs")
+        log_dir.mkdir(parents=True, exist_ok=True)
+        if settings.LOG_FILE_PER_PROCESS:
+            cleanup_stale_logs(log_dir)
+
+        logger.remove()
+        logger.configure(extra={"logger_name": "root"})
+        log_filter = _make_filter(_parse_sample_rates(settings.LOG_SAMPLE_RATES))
+
+        console_sink = BoundedQueueSink(StreamWriter(sys.stderr), _plain, _plain_notice)
+        logger.add(console_sink.write, level=settings.LOG_LEVEL, format=CONSOLE_FORMAT, filter=log_filter,
+                   colorize=sys.stderr.isatty())
+
+        file_writer = RotatingFileWriter(
+            log_file_path(log_dir), settings.LOG_ROTATION_BYTES, settings.LOG_RETENTION_FILES
+        )
+        if settings.LOG_JSON:
+            file_sink = BoundedQueueSink(file_writer, _serialize, _json_notice)
+        else:
+            file_sink = BoundedQueueSink(file_writer, _plain, _plain_notice)
+        logger.add(file_sink.write, level=settings.LOG_LEVEL, format="{message}", filter=log_filter)
+
+        _sinks.extend([console_sink, file_sink])
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """写完队列中剩余的日志"""
+    while _sinks:
+        _sinks.pop().stop()
+
+
+def dropped_logs() -> int:
+    return sum(sink.dropped for sink in _sinks)
+
 
 def get_logger(log_name: Optional[str] = None):
     """
-    初始化日志配置。
-    :param log_name: 日志文件名（不带路径和扩展名），默认使用调用文件名
+    获取绑定了名称的logger，不会修改已配置的日志输出
+    :param log_name: 日志名称，默认使用调用文件名
     """
-    # 日志目录：项目根目录下 logs/
-    log_dir = Path(__file__).resolve().parent / "logs"
-    log_dir.mkdir(parents=True, exist_ok=True)
+    setup_logging()
 
     # 自动获取调用者脚本名
     if log_name is None:
-        import inspect
-        caller_frame = inspect.stack()[1]
-        caller_path = Path(caller_frame.filename)
-        log_name = caller_path.stem  # 不带后缀的脚本名
-
-    log_file_path = log_dir / f"{log_name}.log"
-
-    # 移除默认配置
-    logger.remove()
-
-    # 控制台输出
-    logger.add(sys.stderr, level="INFO",
-               format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | <cyan>{name}:{line}</cyan> - <level>{message}</level>")
-
-    # 文件输出
-    logger.add(
-        log_file_path,
-        rotation="10 MB",  # 超过大小自动轮转
-        retention="7 days",  # 保留 7 天日志
-        encoding="utf-8",
-        enqueue=True,  # 多进程安全
-        level="INFO"
-    )
-
-    return logger
+        log_name = Path(sys._getframe(1).f_code.co_filename).stem
+
+    return logger.bind(logger_name=log_name)
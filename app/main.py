@@ -1,13 +1,56 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.api.routes import router as api_router
+from app.agent.agent_prerouter import pre_router
+from app.api.routes import router as api_router, metrics_router
+from app.config import settings
+from app.metrics import MetricsMiddleware, metrics_registry
+from app.logger import setup_logging, shutdown_logging
+from app.outbox import OutboxWorkerPool
+from app.db.redis.session import redis_memory
+from app.tools import lark_client
+from app.tracing import TracingMiddleware, trace_exporter
+
+
+# 每个进程只配置一次日志输出
+setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    lark_client.check_credentials()
+    # 启动时创建全局Redis连接池，退出时关闭
+    redis_memory.connect()
+    # 用历史路由决策训练预路由模型
+    pre_router.load_training_data()
+    pool_monitor = asyncio.create_task(redis_memory.monitor_pool())
+    outbox_workers = OutboxWorkerPool(settings.OUTBOX_WORKERS)
+    outbox_workers.start()
+    trace_exporter.start()
+    metrics_publisher = None
+    if settings.METRICS_ENABLED and settings.METRICS_MULTIPROCESS:
+        metrics_publisher = asyncio.create_task(metrics_registry.run_publisher())
+    yield
+    if metrics_publisher is not None:
+        metrics_publisher.cancel()
+        await metrics_registry.unpublish()
+    await trace_exporter.stop()
+    await outbox_workers.stop()
+    pool_monitor.cancel()
+    await lark_client.aclose()
+    await redis_memory.close()
+    shutdown_logging()
+
 
 app = FastAPI(
     title="AI Coach Agent API",
     description="基于llamaindex构建的多Agent AI Coach",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -16,6 +59,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
+# 记录每个请求各阶段的耗时
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(api_router, prefix="/api")
+app.include_router(metrics_router)
@@ -0,0 +1,408 @@
+import asyncio
+import math
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import orjson
+from redis.exceptions import WatchError
+
+from app.config import settings
+from app.logger import get_logger
+from app.db.redis.session import redis_memory
+
+logger = get_logger("metrics")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+ROUND_TRIP_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30)
+# 累加退出worker的指标时，WATCH冲突的最大重试次数
+RETIRE_RETRIES = 5
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.documentation, "labelnames": list(self.labelnames),
+                "samples": samples}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """每个标签组合保存 [各桶计数(不累计)..., +Inf桶计数, sum, count]"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        data = super().snapshot()
+        data["buckets"] = list(self.buckets)
+        # 复制，避免序列化时被并发修改
+        data["samples"] = [[labels, list(values)] for labels, values in data["samples"]]
+        return data
+
+
+class MetricsRegistry:
+    """
+    进程内聚合指标，定期把快照写入Redis metrics:worker:{worker_id}（带TTL），
+    并在有序集合 metrics:workers 中登记worker_id，分数为登记的过期时间；
+    /metrics 从登记表读取未过期的worker后合并它们的快照（不需要SCAN），多个uvicorn worker时结果依然正确:
+        - counter、histogram按标签相加
+        - gauge按标签相加（进行中的请求数、连接池使用数等）
+    worker退出（或登记过期）时，把它最后的counter和histogram累加到哈希 metrics:retired 中，合并时始终加上，
+    否则重启、发布时合计值会下降，Prometheus会当作counter重置；gauge随worker一起消失
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+        # 加上随机后缀: 容器中重启后的pid经常相同，不能与已退出的worker混在一起
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{os.urandom(4).hex()}"
+
+    def _register(self, metric: Metric) -> Any:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """导出快照前调用，用于刷新连接池、缓存等状态类指标"""
+        self.collectors.append(collector)
+
+    def snapshot(self) -> Dict[str, Any]:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("采集指标失败: {}", e)
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def _redis_key(self, worker_id: str) -> str:
+        return f"{settings.METRICS_KEY_PREFIX}{worker_id}"
+
+    async def publish(self):
+        now = time.time()
+        async with redis_memory.redis.pipeline(transaction=False) as pipe:
+            # 快照比登记多保留一个TTL，登记过期后仍能读到快照并累加到metrics:retired
+            pipe.set(self._redis_key(self.worker_id), orjson.dumps(self.snapshot()),
+                     ex=settings.METRICS_SNAPSHOT_TTL * 2)
+            pipe.zadd(settings.METRICS_REGISTRY_KEY, {self.worker_id: now + settings.METRICS_SNAPSHOT_TTL})
+            pipe.zrangebyscore(settings.METRICS_REGISTRY_KEY, "-inf", now)
+            *_, expired = await pipe.execute()
+        # 顺便处理没有正常退出（登记已过期）的worker
+        for worker_id in expired:
+            await self._retire(worker_id.decode("utf-8"))
+
+    async def unpublish(self):
+        """进程退出时把自己最后的counter和histogram累加到metrics:retired，并删除登记"""
+        try:
+            await self._retire(self.worker_id, self.snapshot())
+        except Exception as e:
+            logger.warning("注销指标快照失败: {}", e)
+
+    async def _retire(self, worker_id: str, snapshot: Optional[Dict[str, Any]] = None):
+        """
+        在一个事务中累加worker的counter和histogram并删除它的登记；WATCH登记表，
+        多个worker同时清理同一个过期worker时只有一个能累加成功，不会重复计数
+        快照保留到自然过期: 刚读到登记的 /metrics 仍能读到它，合计值不会短暂下降
+        """
+        async with redis_memory.redis.pipeline(transaction=True) as pipe:
+            for _ in range(RETIRE_RETRIES):
+                try:
+                    await pipe.watch(settings.METRICS_REGISTRY_KEY)
+                    if await pipe.zscore(settings.METRICS_REGISTRY_KEY, worker_id) is None:
+                        return
+                    data = snapshot
+                    if data is None:
+                        raw = await pipe.get(self._redis_key(worker_id))
+                        data = orjson.loads(raw) if raw else {}
+                    pipe.multi()
+                    for field, amount in retired_fields(data):
+                        pipe.hincrbyfloat(settings.METRICS_RETIRED_KEY, field, amount)
+                    pipe.zrem(settings.METRICS_REGISTRY_KEY, worker_id)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+        logger.warning("累加已退出worker的指标时冲突过多: worker_id={}", worker_id)
+
+    async def run_publisher(self, interval: float = settings.METRICS_PUBLISH_INTERVAL):
+        while True:
+            try:
+                await self.publish()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("发布指标快照失败: {}", e)
+            await asyncio.sleep(interval)
+
+    async def collect(self) -> Dict[str, Any]:
+        """合并所有worker的快照，本进程使用最新数据；Redis不可用时只返回本进程的指标"""
+        local = self.snapshot()
+        if not settings.METRICS_MULTIPROCESS:
+            return local
+        snapshots = [local]
+        try:
+            # 登记表和退出worker的合计在同一个事务中读取，worker刚好退出时不会重复或遗漏
+            async with redis_memory.redis.pipeline(transaction=True) as pipe:
+                pipe.zrangebyscore(settings.METRICS_REGISTRY_KEY, time.time(), "+inf")
+                pipe.hgetall(settings.METRICS_RETIRED_KEY)
+                worker_ids, retired = await pipe.execute()
+            snapshots.append(retired_snapshot(retired, local))
+            keys = [
+                self._redis_key(worker_id.decode("utf-8")) for worker_id in worker_ids
+                if worker_id.decode("utf-8") != self.worker_id
+            ]
+            if keys:
+                snapshots.extend(orjson.loads(raw) for raw in await redis_memory.redis.mget(keys) if raw)
+        except Exception as e:
+            logger.warning("读取其他worker的指标失败: {}", e)
+        return merge_snapshots(snapshots)
+
+
+def retired_fields(snapshot: Dict[str, Any]) -> Iterable[Tuple[bytes, float]]:
+    """
+    counter和histogram的每个值对应metrics:retired中的一个字段:
+    counter为 [name, labels]，histogram的各桶、sum、count为 [name, labels, index]
+    """
+    for name, data in snapshot.items():
+        if data["type"] == "gauge":
+            continue
+        for labels, value in data["samples"]:
+            if isinstance(value, list):
+                for index, amount in enumerate(value):
+                    if amount:
+                        yield orjson.dumps([name, labels, index]), amount
+            elif value:
+                yield orjson.dumps([name, labels]), value
+
+
+def retired_snapshot(fields: Dict[bytes, bytes], local: Dict[str, Any]) -> Dict[str, Any]:
+    """把metrics:retired还原为快照，指标的类型、说明和桶使用本进程的定义，已经删除的指标忽略"""
+    samples: Dict[str, Dict[Tuple[str, ...], Any]] = {}
+    for field, amount in fields.items():
+        name, labels, *index = orjson.loads(field)
+        data = local.get(name)
+        if data is None or data["type"] == "gauge":
+            continue
+        amount = float(amount)
+        if data["type"] != "histogram":
+            samples.setdefault(name, {})[tuple(labels)] = amount
+            continue
+        values = samples.setdefault(name, {}).setdefault(tuple(labels), [0] * (len(data["buckets"]) + 3))
+        if index and index[0] < len(values):
+            values[index[0]] = amount
+    return {
+        name: {**local[name], "samples": [[list(labels), value] for labels, value in metric_samples.items()]}
+        for name, metric_samples in samples.items()
+    }
+
+
+def merge_snapshots(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    merged: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            target = merged.setdefault(name, {**data, "samples": {}})
+            for labels, value in data["samples"]:
+                key = tuple(labels)
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["samples"][key] = current + value
+    for data in merged.values():
+        data["samples"] = [[list(key), value] for key, value in data["samples"].items()]
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render(snapshot: Dict[str, Any]) -> str:
+    """Prometheus文本格式(0.0.4)"""
+    lines = []
+    for name, data in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {data['help']}")
+        lines.append(f"# TYPE {name} {data['type']}")
+        labelnames = data["labelnames"]
+        for labels, value in data["samples"]:
+            if data["type"] != "histogram":
+                lines.append(f"{name}{_labels(labelnames, labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*data["buckets"], math.inf], value[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labelnames, labels, ('le', _number(bound)))} {_number(cumulative)}")
+            lines.append(f"{name}_sum{_labels(labelnames, labels)} {_number(value[-2])}")
+            lines.append(f"{name}_count{_labels(labelnames, labels)} {_number(value[-1])}")
+    return "\n".join(lines) + "\n"
+
+
+# 单例，全局共享
+metrics_registry = MetricsRegistry()
+
+http_requests_total = metrics_registry.counter(
+    "http_requests_total", "HTTP请求数", ["method", "route", "status"])
+http_request_duration_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "HTTP请求耗时（流式请求为整个响应的耗时）", ["method", "route"])
+http_requests_in_flight = metrics_registry.gauge(
+    "http_requests_in_flight", "正在处理的HTTP请求数")
+agent_responses_total = metrics_registry.counter(
+    "agent_responses_total", "各智能体给出的最终回复数", ["agent", "source"])
+workflow_entries_total = metrics_registry.counter(
+    "workflow_entries_total", "工作流的入口来源(router/keyword/model/session)", ["source"])
+tool_calls_total = metrics_registry.counter(
+    "tool_calls_total", "工具调用次数", ["tool", "status"])
+tool_call_duration_seconds = metrics_registry.histogram(
+    "tool_call_duration_seconds", "工具调用耗时", ["tool"])
+llm_tokens_per_turn = metrics_registry.histogram(
+    "llm_tokens_per_turn", "每轮对话的LLM token数", ["kind"], buckets=TOKEN_BUCKETS)
+llm_tokens_total = metrics_registry.counter(
+    "llm_tokens_total", "LLM token用量，kind=cached为prompt中命中上下文缓存的部分", ["agent", "kind"])
+redis_pool_connections = metrics_registry.gauge(
+    "redis_pool_connections", "Redis连接池连接数", ["state"])
+cache_requests_total = metrics_registry.counter(
+    "cache_requests_total", "缓存查询次数", ["cache", "result"])
+cache_entries = metrics_registry.gauge(
+    "cache_entries", "缓存条目数", ["cache"])
+cache_bytes = metrics_registry.gauge(
+    "cache_bytes", "缓存占用的内存（估算）", ["cache"])
+admission_rejected_total = metrics_registry.counter(
+    "admission_rejected_total", "被准入控制拒绝的请求数", ["reason"])
+admission_queue_wait_seconds = metrics_registry.histogram(
+    "admission_queue_wait_seconds", "请求等待执行名额的时间")
+admission_queue_length = metrics_registry.gauge(
+    "admission_queue_length", "等待执行名额的请求数")
+llm_provider_calls_total = metrics_registry.counter(
+    "llm_provider_calls_total", "各LLM provider的调用结果(ok/error/timeout/cancelled)", ["provider", "result"])
+llm_first_chunk_seconds = metrics_registry.histogram(
+    "llm_first_chunk_seconds", "LLM首个chunk的等待时间（含排队）", ["provider"])
+llm_hedges_total = metrics_registry.counter(
+    "llm_hedges_total", "首个chunk过慢时发起的对冲请求数", ["provider"])
+llm_provider_up = metrics_registry.gauge(
+    "llm_provider_up", "LLM provider是否可用（熔断时为0）", ["provider"])
+redis_round_trips_per_turn = metrics_registry.histogram(
+    "redis_round_trips_per_turn", "每轮对话的Redis往返次数（一个pipeline算一次）", ["path"],
+    buckets=ROUND_TRIP_BUCKETS)
+batch_items_total = metrics_registry.counter(
+    "batch_items_total", "批量聊天接口处理的消息数", ["status"])
+
+
+def _collect_redis_pool():
+    stats = redis_memory.pool_stats()
+    redis_pool_connections.set(stats["in_use"], state="in_use")
+    redis_pool_connections.set(stats["idle"], state="idle")
+    redis_pool_connections.set(stats["max_connections"], state="max")
+
+
+metrics_registry.add_collector(_collect_redis_pool)
+
+
+class MetricsMiddleware:
+    """按路由模板统计请求数、耗时和进行中的请求数，未匹配的路径统一记为unmatched"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_requests_total.inc(method=scope["method"], route=route, status=status["code"])
+            http_request_duration_seconds.observe(time.perf_counter() - start, method=scope["method"], route=route)
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import orjson
+from redis.exceptions import ResponseError
+
+from app.config import settings
+from app.logger import get_logger
+from app.agent.agent_profile import profile_store
+from app.db.redis.session import redis_memory
+from app.resilience import get_endpoint
+from app.tools import lark_client
+
+logger = get_logger("outbox")
+
+
+def status_key(idempotency_key: str) -> str:
+    return f"outbox:status:{idempotency_key}"
+
+
+async def _deliver_lark_msg(user_id: str, payload: Dict[str, Any], idempotency_key: str):
+    # 飞书按uuid对消息去重，重复投递不会重复发送
+    await lark_client.send_msg(user_email=user_id, msg=payload, uuid=idempotency_key)
+
+
+# 按消息类型分发到具体的投递函数
+HANDLERS: Dict[str, Callable[[str, Dict[str, Any], str], Awaitable[Any]]] = {
+    "lark": _deliver_lark_msg,
+}
+
+
+async def enqueue(
+        kind: str, user_id: str, payload: Dict[str, Any], request_name: str,
+        profile: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    写入outbox stream并立即返回幂等键，实际投递由OutboxWorker完成
+    profile为投递成功后才同步到长期用户档案的修改 {"values", "remove"}，投递最终失败时不写入
+    """
+    idempotency_key = uuid.uuid4().hex
+    fields = {
+        "key": idempotency_key,
+        "kind": kind,
+        "user_id": user_id,
+        "request_name": request_name,
+        "payload": orjson.dumps(payload),
+        "created_at": str(time.time()),
+    }
+    if profile:
+        fields["profile"] = orjson.dumps(profile)
+    pipe = redis_memory.redis.pipeline(transaction=True)
+    pipe.xadd(settings.OUTBOX_STREAM, fields, maxlen=settings.OUTBOX_MAXLEN, approximate=True)
+    pipe.hset(status_key(idempotency_key), mapping={"status": "pending", "attempts": 0})
+    pipe.expire(status_key(idempotency_key), settings.OUTBOX_STATUS_TTL)
+    await pipe.execute()
+    logger.debug("已写入outbox: key={}, request_name={}", idempotency_key, request_name)
+    return idempotency_key
+
+
+async def get_status(idempotency_key: str) -> Dict[str, str]:
+    data = await redis_memory.redis.hgetall(status_key(idempotency_key))
+    return {k.decode("utf-8"): v.decode("utf-8") for k, v in data.items()}
+
+
+class OutboxWorker:
+    """
+    消费outbox stream的worker，多个worker组成一个consumer group:
+        - 投递失败的消息不ack，空闲超过 OUTBOX_CLAIM_IDLE_MS 后被其他worker认领重试
+        - 超过 OUTBOX_MAX_DELIVERIES 次仍失败的消息标记为failed并ack；
+          熔断或排队超时时没有发出请求，不计入投递次数
+        - 无法解析的消息移到 OUTBOX_DEAD_LETTER_STREAM 并ack，不会被反复认领
+        - 投递成功后才把消息附带的修改写入长期用户档案
+        - 投递状态记录在 outbox:status:{key}
+    """
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.stream = settings.OUTBOX_STREAM
+        self.group = settings.OUTBOX_GROUP
+        self._stopped = False
+
+    async def ensure_group(self):
+        try:
+            await redis_memory.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def stop(self):
+        self._stopped = True
+
+    async def run(self):
+        await self.ensure_group()
+        logger.info("Outbox worker已启动: {}", self.name)
+        while not self._stopped:
+            try:
+                entries = await self._claim_stale()
+                if not entries:
+                    response = await redis_memory.redis.xreadgroup(
+                        self.group, self.name, {self.stream: ">"},
+                        count=settings.OUTBOX_BATCH_SIZE, block=settings.OUTBOX_BLOCK_MS,
+                    )
+                    entries = response[0][1] if response else []
+                for entry_id, fields in entries:
+                    await self.process(entry_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Outbox worker出错: {}", e)
+                await asyncio.sleep(1)
+
+    async def _claim_stale(self) -> List:
+        """认领其他worker投递失败或崩溃遗留的消息"""
+        response = await redis_memory.redis.xautoclaim(
+            self.stream, self.group, self.name,
+            min_idle_time=settings.OUTBOX_CLAIM_IDLE_MS, start_id="0-0", count=settings.OUTBOX_BATCH_SIZE,
+        )
+        return [entry for entry in response[1] if entry[1]]
+
+    @staticmethod
+    def _decode(fields: Dict[bytes, bytes]) -> Tuple[str, str, str, Dict[str, Any], Optional[Dict[str, Any]]]:
+        """解析消息，返回 (幂等键, 类型, user_id, payload, 档案修改)"""
+        kind = fields[b"kind"].decode("utf-8")
+        if kind not in HANDLERS:
+            raise ValueError(f"未知的消息类型: {kind}")
+        profile = orjson.loads(fields[b"profile"]) if b"profile" in fields else None
+        return (
+            fields[b"key"].decode("utf-8"), kind, fields[b"user_id"].decode("utf-8"), orjson.loads(fields[b"payload"]),
+            profile,
+        )
+
+    async def _dead_letter(self, entry_id: bytes, fields: Dict[bytes, bytes], error: str):
+        pipe = redis_memory.redis.pipeline(transaction=True)
+        pipe.xadd(
+            settings.OUTBOX_DEAD_LETTER_STREAM, {**fields, b"entry_id": entry_id, b"error": error},
+            maxlen=settings.OUTBOX_MAXLEN, approximate=True,
+        )
+        pipe.xack(self.stream, self.group, entry_id)
+        await pipe.execute()
+        logger.error("Outbox消息无法解析，已移到死信队列: entry_id={}, error={}", entry_id, error)
+
+    async def process(self, entry_id: bytes, fields: Dict[bytes, bytes]):
+        try:
+            key, kind, user_id, payload, profile = self._decode(fields)
+        except Exception as e:
+            await self._dead_letter(entry_id, fields, repr(e))
+            return
+
+        status = await redis_memory.redis.hget(status_key(key), "status")
+        if status == b"delivered":
+            # 已投递成功（例如ack前进程退出），直接ack
+            await redis_memory.redis.xack(self.stream, self.group, entry_id)
+            return
+
+        # 先计数: 投递过程中进程崩溃的消息也算一次，不会无限重试
+        attempts = await redis_memory.redis.hincrby(status_key(key), "attempts", 1)
+        result = await get_endpoint(kind).call(lambda: HANDLERS[kind](user_id, payload, key))
+        if result.success and profile:
+            # 在标记delivered之前写入: 之后进程退出时消息会被重新投递（飞书按uuid去重），档案修改可以重复执行
+            await profile_store.apply(user_id, profile)
+
+        pipe = redis_memory.redis.pipeline(transaction=True)
+        if result.success:
+            pipe.hset(status_key(key), mapping={"status": "delivered", "delivered_at": str(time.time())})
+            pipe.xack(self.stream, self.group, entry_id)
+        elif result.attempts == 0:
+            # 熔断或排队超时，没有发出请求，不计入投递次数
+            pipe.hincrby(status_key(key), "attempts", -1)
+            pipe.hset(status_key(key), mapping={"status": "retrying", "error": result.error or ""})
+        elif attempts >= settings.OUTBOX_MAX_DELIVERIES:
+            pipe.hset(status_key(key), mapping={"status": "failed", "error": result.error or ""})
+            pipe.xack(self.stream, self.group, entry_id)
+            logger.error("Outbox消息投递失败且不再重试: key={}, error={}", key, result.error)
+        else:
+            pipe.hset(status_key(key), mapping={"status": "retrying", "error": result.error or ""})
+        pipe.expire(status_key(key), settings.OUTBOX_STATUS_TTL)
+        await pipe.execute()
+
+
+class OutboxWorkerPool:
+    def __init__(self, size: int = settings.OUTBOX_WORKERS):
+        self.workers = [OutboxWorker() for _ in range(size)]
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(worker.run()) for worker in self.workers]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def main():
+    """单独部署outbox worker: python -m app.outbox"""
+    pool = OutboxWorkerPool()
+    pool.start()
+    try:
+        await asyncio.gather(*pool.tasks)
+    finally:
+        await lark_client.aclose()
+        await redis_memory.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,195 @@
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from app.config import settings
+from app.logger import get_logger
+
+logger = get_logger("resilience")
+
+
+class RetryableError(Exception):
+    """下游暂时不可用，可以重试的错误"""
+
+
+@dataclass
+class CallResult:
+    """对外部副作用调用的结构化结果，智能体可以据此区分失败原因"""
+    success: bool
+    attempts: int
+    elapsed_ms: float
+    error: Optional[str] = None
+    circuit_open: bool = False
+    rejected: bool = False  # 并发已满，排队超时
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后熔断，recovery_timeout 秒内直接失败；
+    之后放行一个探测请求(半开)，成功则恢复，失败则继续熔断。
+    探测请求没有得到结果（排队超时、被取消）时调用 release_probe 交还探测名额，
+    超过 probe_timeout 仍没有结果时也允许下一个请求重新探测，熔断器不会一直停在半开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float, probe_timeout: Optional[float] = None):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.probe_timeout = recovery_timeout if probe_timeout is None else probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+
+    def available(self) -> bool:
+        """当前是否可以发起请求，不改变状态（不占用探测名额）"""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.recovery_timeout
+        return now - self.probe_started_at >= self.probe_timeout
+
+    def allow(self) -> bool:
+        """是否放行本次请求，熔断中且可以探测时本次请求成为探测请求"""
+        if self.state == self.CLOSED:
+            return True
+        if not self.available():
+            return False
+        self.state = self.HALF_OPEN
+        self.probe_started_at = time.monotonic()
+        return True
+
+    def release_probe(self):
+        """探测请求没有记录结果就结束时重新打开，下一个请求可以立即探测"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("熔断器打开, 连续失败 {} 次", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """网络错误、超时、5xx和显式标记为可重试的错误才重试"""
+    if isinstance(error, (RetryableError, asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
+
+
+class ResilientEndpoint:
+    """
+    针对单个下游接口的容错调用:
+        - 每次尝试有独立超时，可重试错误按带抖动的指数退避重试
+        - 并发数受限，排队超过 queue_timeout 直接拒绝
+        - 熔断期间快速失败
+    """
+
+    def __init__(
+            self,
+            name: str,
+            max_attempts: int = settings.TOOL_RETRY_MAX_ATTEMPTS,
+            base_delay: float = settings.TOOL_RETRY_BASE_DELAY,
+            max_delay: float = settings.TOOL_RETRY_MAX_DELAY,
+            timeout: float = settings.TOOL_CALL_TIMEOUT,
+            max_concurrency: int = settings.TOOL_MAX_CONCURRENCY,
+            queue_timeout: float = settings.TOOL_QUEUE_TIMEOUT,
+            failure_threshold: int = settings.CIRCUIT_FAILURE_THRESHOLD,
+            recovery_timeout: float = settings.CIRCUIT_RECOVERY_TIMEOUT,
+    ):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, fn: Callable[[], Awaitable[Any]]) -> CallResult:
+        start = time.perf_counter()
+
+        def result(success: bool, attempts: int, **kwargs) -> CallResult:
+            return CallResult(
+                success=success, attempts=attempts, elapsed_ms=(time.perf_counter() - start) * 1000, **kwargs
+            )
+
+        # 熔断期间快速失败，不需要排队
+        if not self.breaker.available():
+            return result(False, 0, error=f"{self.name} 暂时不可用", circuit_open=True)
+
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            return result(False, 0, error=f"{self.name} 繁忙，请稍后重试", rejected=True)
+
+        probe = False
+        try:
+            # 拿到并发名额后再检查熔断器: 排队期间熔断器可能已经打开，也避免探测请求排队超时后停在半开
+            if not self.breaker.allow():
+                return result(False, 0, error=f"{self.name} 暂时不可用", circuit_open=True)
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    await asyncio.wait_for(fn(), timeout=self.timeout)
+                    self.breaker.record_success()
+                    return result(True, attempt)
+                except Exception as e:
+                    retryable = is_retryable(e)
+                    # 不可重试的业务错误说明下游可以正常响应，不计入熔断
+                    if retryable:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    error = f"{type(e).__name__}: {e}"
+                    if not retryable or attempt >= self.max_attempts:
+                        logger.error("调用 {} 失败, attempts={}, error={}", self.name, attempt, error)
+                        return result(False, attempt, error=error)
+                    if not self.breaker.allow():
+                        return result(False, attempt, error=error, circuit_open=True)
+                    await asyncio.sleep(self._backoff(attempt))
+        finally:
+            # 探测请求被取消时没有记录结果，交还探测名额；已经记录结果时不生效
+            if probe:
+                self.breaker.release_probe()
+            self.semaphore.release()
+
+
+_endpoints: Dict[str, ResilientEndpoint] = {}
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoint(name: str) -> ResilientEndpoint:
+    """按下游接口名称获取共享的ResilientEndpoint"""
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = ResilientEndpoint(name)
+        return _endpoints[name]
@@ -1,42 +1,165 @@
+import asyncio
 import json
+import time
+from typing import Optional
 
-import requests
+import httpx
 
+from app.config import settings
 from app.logger import get_logger
+from app.resilience import RetryableError
 
 logger = get_logger("tools")
 
+# tenant_access_token 无效或过期时飞书返回的错误码
+INVALID_TOKEN_CODES = {99991661, 99991663, 99991668}
+# 请求频率超限，可以稍后重试
+RATE_LIMIT_CODES = {99991400}
 
-def get_lark_token():
-    app_id = "cli_a50254e4e43bd013"
-    app_secret = "0PStyxmXLUnUKq5KvS5iCbmg8z4z6nkJ"
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
-    payload = {"app_id": app_id, "app_secret": app_secret}
-    response = requests.post(url, json=payload)
-    return response.json()["tenant_access_token"]
-
-
-def post_msg(user_email, msg):
-    logger.info(f"发送飞书消息：{msg}")
-    token = get_lark_token()
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    url = "https://open.feishu.cn/open-apis/im/v1/messages"
-    text = f"已调用修改工具，修改内容为：{msg}"
-    params = {"receive_id_type": "email"}
-    payload = {
-        "receive_id": user_email,
-        "content": json.dumps({"text": text}),
-        "msg_type": "text",
-    }
-    try:
-        response = requests.post(url, params=params, headers=headers, json=payload)
-        response.raise_for_status()
-        response_code = response.json()["code"]
+
+class LarkAPIError(Exception):
+    def __init__(self, code: int, msg: str = ""):
+        super().__init__(f"飞书接口错误，错误代码：{code} {msg}".strip())
+        self.code = code
+
+
+class LarkRateLimitError(LarkAPIError, RetryableError):
+    pass
+
+
+class LarkClient:
+    """
+    异步飞书客户端
+        - 所有请求共享一个HTTP连接池
+        - tenant_access_token 缓存到过期前 LARK_TOKEN_REFRESH_MARGIN 秒，
+          并发请求同时需要刷新时只请求一次
+    """
+
+    def __init__(
+            self,
+            app_id: str = settings.LARK_APP_ID,
+            app_secret: str = settings.LARK_APP_SECRET,
+            base_url: str = settings.LARK_BASE_URL,
+    ):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.base_url = base_url
+        self._client: Optional[httpx.AsyncClient] = None
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(settings.LARK_TIMEOUT, connect=settings.LARK_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.LARK_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.LARK_MAX_CONNECTIONS,
+                ),
+            )
+        return self._client
+
+    def check_credentials(self):
+        """启动时检查凭证，未配置时直接失败，而不是在第一次推送时才报错"""
+        if not self.app_id or not self.app_secret:
+            raise RuntimeError("未配置飞书凭证，请设置环境变量 LARK_APP_ID 和 LARK_APP_SECRET")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _token_valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._token_expires_at
+
+    async def get_tenant_token(self) -> str:
+        if self._token_valid():
+            return self._token
+        async with self._token_lock:
+            # 等待锁期间其他请求可能已经刷新
+            if self._token_valid():
+                return self._token
+            response = await self.client.post(
+                "/open-apis/auth/v3/tenant_access_token/internal",
+                json={"app_id": self.app_id, "app_secret": self.app_secret},
+            )
+            response.raise_for_status()
+            data = response.json()
+            if data.get("code", 0) != 0:
+                raise RuntimeError(f"获取飞书token失败，错误代码：{data.get('code')}")
+            self._token = data["tenant_access_token"]
+            self._token_expires_at = time.monotonic() + data.get("expire", 7200) - settings.LARK_TOKEN_REFRESH_MARGIN
+            return self._token
+
+    def invalidate_token(self):
+        self._token = None
+        self._token_expires_at = 0.0
+
+    async def send_msg(self, user_email: str, msg, uuid: Optional[str] = None):
+        """
+        发送飞书消息，失败时抛出异常，由调用方决定是否重试
+        uuid相同的消息飞书在1小时内只发送一次，用于重试时去重
+        """
+        logger.debug("发送飞书消息：{}", msg)
+        text = f"已调用修改工具，修改内容为：{msg}"
+        payload = {
+            "receive_id": user_email,
+            "content": json.dumps({"text": text}),
+            "msg_type": "text",
+        }
+        if uuid:
+            payload["uuid"] = uuid
+        response_json = await self._send_message(payload)
+        # token在缓存期间被飞书判定失效时，刷新后重试一次
+        if response_json.get("code") in INVALID_TOKEN_CODES:
+            self.invalidate_token()
+            response_json = await self._send_message(payload)
+
+        response_code = response_json.get("code")
+        if response_code in RATE_LIMIT_CODES:
+            raise LarkRateLimitError(response_code, response_json.get("msg", ""))
         if response_code != 0:
-            logger.error(f"飞书消息推送失败，错误代码：{response_code}")
+            raise LarkAPIError(response_code, response_json.get("msg", ""))
+        logger.info("飞书消息推送成功, message_id={}", (response_json.get("data") or {}).get("message_id"))
+        return response_json
+
+    async def post_msg(self, user_email: str, msg) -> bool:
+        try:
+            await self.send_msg(user_email=user_email, msg=msg)
+            return True
+        except Exception as e:
+            logger.error("飞书消息推送失败，错误信息：{}", e)
             return False
-        logger.info(f"飞书消息推送成功, Response: {response.json()}")
-        return True
-    except Exception as e:
-        logger.error(f"飞书消息推送失败，错误信息：{e}")
-        return False
+
+    async def _send_message(self, payload: dict) -> dict:
+        token = await self.get_tenant_token()
+        response = await self.client.post(
+            "/open-apis/im/v1/messages",
+            params={"receive_id_type": "email"},
+            headers={"Authorization": f"Bearer {token}"},
+            json=payload,
+        )
+        # 飞书的业务错误（包括token失效）以非2xx状态码和错误码一起返回
+        try:
+            data = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+        if response.is_error and not data.get("code"):
+            response.raise_for_status()
+        return data
+
+
+# 单例，全局共享连接池
+lark_client = LarkClient()
+
+
+async def get_lark_token() -> str:
+    return await lark_client.get_tenant_token()
+
+
+async def post_msg(user_email, msg) -> bool:
+    return await lark_client.post_msg(user_email=user_email, msg=msg)
@@ -0,0 +1,335 @@
+import asyncio
+import contextvars
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+import orjson
+
+from app.config import settings
+from app.logger import get_logger
+
+logger = get_logger("tracing")
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[str] = None):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.error = error
+
+
+@dataclass
+class Trace:
+    """一次请求的所有span，trace_id即请求ID；超过 TRACE_MAX_SPANS 的span不记录，只计数"""
+    trace_id: str
+    spans: List[Span] = field(default_factory=list)
+    dropped_spans: int = 0
+
+    def server_timing(self) -> str:
+        """
+        按span名称汇总耗时，生成Server-Timing响应头
+        例如: memory.load;dur=3.2, llm.router;dur=812.4, tool;dur=40.1, total;dur=901.7
+        """
+        durations: Dict[str, float] = {}
+        for span in self.spans:
+            if span.end_ns is not None:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        return ", ".join(
+            f"{_timing_token(name)};dur={duration:.1f}" for name, duration in durations.items()
+        )
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _timing_token(name: str) -> str:
+    # Server-Timing的名称只能是ASCII token
+    return re.sub(r"[^A-Za-z0-9_.\-]", "_", name)
+
+
+def new_id(length: int = 16) -> str:
+    return uuid.uuid4().hex[:length]
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """
+    开始一个span但不设为当前span，用于跨多个事件手动结束的场景；
+    当前没有trace或未启用追踪时返回None
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    if len(trace.spans) >= settings.TRACE_MAX_SPANS:
+        trace.dropped_spans += 1
+        return None
+    parent = _current_span.get()
+    span = Span(
+        name=name,
+        trace_id=trace.trace_id,
+        span_id=new_id(),
+        parent_id=parent.span_id if parent else None,
+        start_ns=time.time_ns(),
+        attributes=attributes,
+    )
+    trace.spans.append(span)
+    return span
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """在当前trace中记录一个span，期间创建的span以它为父span"""
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+
+@contextmanager
+def start_trace(name: str, request_id: Optional[str] = None, **attributes) -> Iterator[Trace]:
+    """
+    开始一个新的trace，结束时交给exporter异步导出
+    在已有的trace中调用时（例如批量请求中的每条消息）开始独立的根span，不追加到外层的trace
+    """
+    trace = Trace(trace_id=request_id or new_id(32))
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        if trace.dropped_spans and trace.spans:
+            trace.spans[0].set(dropped_spans=trace.dropped_spans)
+        trace_exporter.export(trace)
+
+
+class TraceExporter:
+    """
+    在后台批量导出trace，不占用请求路径:
+        - file: 每个trace一行JSON，写入 TRACE_FILE_PATH
+        - otlp: 以OTLP/HTTP JSON格式发送到 TRACE_OTLP_ENDPOINT
+    队列满时丢弃
+    """
+
+    def __init__(self, exporter: str = settings.TRACE_EXPORTER):
+        self.exporter = exporter
+        self.queue: Optional[asyncio.Queue] = None
+        self.dropped = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.exporter not in ("file", "otlp") or self._task is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=settings.TRACE_EXPORT_QUEUE_SIZE)
+        if self.exporter == "otlp":
+            self._client = httpx.AsyncClient(timeout=settings.TRACE_EXPORT_TIMEOUT)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # 导出剩余的trace
+        await self._flush(self._drain())
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def export(self, trace: Trace):
+        if self.queue is None:
+            return
+        try:
+            self.queue.put_nowait(trace)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _drain(self) -> List[Trace]:
+        traces = []
+        while not self.queue.empty() and len(traces) < settings.TRACE_EXPORT_BATCH_SIZE:
+            traces.append(self.queue.get_nowait())
+        return traces
+
+    async def _run(self):
+        while True:
+            traces = [await self.queue.get()]
+            traces.extend(self._drain())
+            try:
+                await self._flush(traces)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("导出trace失败: {}", e)
+
+    async def _flush(self, traces: List[Trace]):
+        if not traces:
+            return
+        if self.exporter == "file":
+            lines = b"".join(orjson.dumps(_to_dict(trace)) + b"\n" for trace in traces)
+            await asyncio.to_thread(_append, settings.TRACE_FILE_PATH, lines)
+        elif self.exporter == "otlp":
+            response = await self._client.post(
+                settings.TRACE_OTLP_ENDPOINT,
+                content=orjson.dumps(_to_otlp(traces)),
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+
+
+def _append(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def _to_dict(trace: Trace) -> Dict[str, Any]:
+    return {
+        "trace_id": trace.trace_id,
+        "pid": os.getpid(),
+        "dropped_spans": trace.dropped_spans,
+        "spans": [
+            {
+                "name": span.name,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start_ns": span.start_ns,
+                "duration_ms": round(span.duration_ms, 3),
+                "attributes": span.attributes,
+                "error": span.error,
+            }
+            for span in trace.spans
+        ],
+    }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _to_otlp(traces: List[Trace]) -> Dict[str, Any]:
+    """OTLP/HTTP JSON格式，trace_id需要32位、span_id需要16位十六进制"""
+    spans = []
+    for trace in traces:
+        trace_id = trace.trace_id if re.fullmatch(r"[0-9a-f]{32}", trace.trace_id) else uuid.uuid5(
+            uuid.NAMESPACE_OID, trace.trace_id).hex
+        for span in trace.spans:
+            attributes = {"request.id": trace.trace_id, **span.attributes}
+            item = {
+                "traceId": trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            if span.error:
+                item["status"] = {"code": 2, "message": span.error}
+            spans.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": settings.TRACE_SERVICE_NAME}},
+            ]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class TracingMiddleware:
+    """
+    为每个HTTP请求创建trace:
+        - 请求ID取自 X-Request-ID 请求头，没有则生成，并在响应头中返回
+        - 响应头 Server-Timing 包含响应开始前已完成的各阶段耗时
+          （流式响应的响应头在输出第一个事件前发送，各阶段耗时只能从导出的trace中查看）
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+
+        with start_trace("http.request", request_id=request_id, path=scope["path"],
+                         method=scope["method"]) as trace:
+            root = trace.spans[0]
+
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    root.set(status_code=message["status"])
+                    timing = trace.server_timing()
+                    total = f"total;dur={root.duration_ms:.1f}"
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-request-id", trace.trace_id.encode("latin-1")))
+                    server_timing = f"{timing}, {total}" if timing else total
+                    headers.append((b"server-timing", server_timing.encode("latin-1")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
+
+
+# 单例，全局共享
+trace_exporter = TraceExporter()
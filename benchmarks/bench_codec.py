@@ -0,0 +1,92 @@
+"""
+Redis中聊天消息的编码格式对比: 每条消息的字节数和编码/解码吞吐
+    - json: 旧格式 ChatMessage.model_dump_json()
+    - compact: 紧凑格式，不压缩
+    - compact+zlib / compact+zstd: 超过 MESSAGE_COMPRESS_MIN_BYTES 的消息压缩（zstd需要安装zstandard）
+
+运行: python -m benchmarks.bench_codec
+"""
+import json
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.llms.llm import ToolSelection
+
+from app.config import settings
+from app.db.redis.codec import decode_message, encode_message
+
+ROUNDS = 2000
+LONG_REPLY_SENTENCES = [
+    "坐在椅子上做10分钟的上肢拉伸，动作保持缓慢，感觉到轻微牵拉即可。",
+    "进行15分钟的坐姿踏步，配合深呼吸，心率控制在每分钟100次以内。",
+    "如果膝盖出现刺痛，请立即停止并冰敷，必要时咨询医生。",
+    "Warm up for five minutes with gentle ankle circles and shoulder rolls before each session.",
+    "饮食上注意补充优质蛋白，例如鸡蛋、豆制品和鱼肉，同时保证每天饮水1500毫升以上。",
+    "睡前可以做5分钟的腹式呼吸放松，有助于改善睡眠质量。",
+    "每周安排两天休息日，让肌肉和关节充分恢复，避免连续高强度训练。",
+    "Track how you feel after each workout so the coach can adjust the intensity next week.",
+]
+MESSAGES = {
+    "user": ChatMessage(role=MessageRole.USER, content="我最近膝盖有点疼，能不能把训练计划改成坐姿的，时长15到20分钟"),
+    "assistant": ChatMessage(role=MessageRole.ASSISTANT, content="好的，已经为您调整为坐姿训练。" * 12),
+    "tool_call": ChatMessage(role=MessageRole.ASSISTANT, content="", additional_kwargs={"tool_calls": [ToolSelection(
+        tool_id="call_1", tool_name="adjust_workout_plan_tool",
+        tool_kwargs={"args": {"workout_duration": "15-20", "position": "seated_on_chair"}},
+    )]}),
+    "tool_result": ChatMessage(role=MessageRole.TOOL, content="修改成功",
+                               additional_kwargs={"tool_call_id": "call_1", "name": "adjust_workout_plan_tool"}),
+    "long_assistant": ChatMessage(role=MessageRole.ASSISTANT, content="".join(
+        f"第{i + 1}天: {sentence}" for i, sentence in enumerate(LONG_REPLY_SENTENCES * 4)
+    )),
+}
+
+
+def encoders() -> Dict[str, Callable[[ChatMessage], bytes]]:
+    result = {
+        "json": lambda message: message.model_dump_json().encode("utf-8"),
+        "compact": lambda message: encode_message(message, compression="none"),
+        "compact+zlib": lambda message: encode_message(message, compression="zlib"),
+    }
+    try:
+        import zstandard  # noqa: F401
+        result["compact+zstd"] = lambda message: encode_message(message, compression="zstd")
+    except ImportError:
+        pass
+    return result
+
+
+def bench(fn, rounds: int = ROUNDS) -> float:
+    """返回每秒调用次数（5次测量取中位数）"""
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        samples.append(rounds / (time.perf_counter() - start))
+    return statistics.median(samples)
+
+
+def main():
+    report: Dict[str, Dict] = {"compress_min_bytes": settings.MESSAGE_COMPRESS_MIN_BYTES}
+    for codec, encode in encoders().items():
+        sizes: Dict[str, int] = {}
+        encode_rate: List[float] = []
+        decode_rate: List[float] = []
+        for name, message in MESSAGES.items():
+            raw = encode(message)
+            sizes[name] = len(raw)
+            encode_rate.append(bench(lambda: encode(message)))
+            decode_rate.append(bench(lambda: decode_message(raw)))
+        report[codec] = {
+            "bytes": sizes,
+            "bytes_per_message": round(statistics.mean(sizes.values()), 1),
+            "encode_msgs_per_s": round(statistics.mean(encode_rate)),
+            "decode_msgs_per_s": round(statistics.mean(decode_rate)),
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+工作流state持久化的开销: 编码/解码耗时和大小，可选地测量对真实Redis的读写耗时
+    - typical: 一轮修改计划后的state
+    - large: 收集了大量参数的state，超过 CTX_STATE_COMPRESS_MIN_BYTES 时会压缩
+
+运行: python -m benchmarks.bench_ctx_state [--redis redis://localhost:6379/15]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from app.agent.agent_state import decode_state, encode_state
+
+ROUNDS = 20000
+STATES = {
+    "typical": {
+        "workout_plan_params": {"workout_duration": "15-20", "equipment": "dumbbell", "coach": "female"},
+        "basic_info_params": {},
+    },
+    "large": {
+        "workout_plan_params": {f"param_{i}": "seated_on_chair" * 4 for i in range(40)},
+        "basic_info_params": {"nickname": "用户昵称" * 10, "age": "68", "height": "165", "weight": "60"},
+    },
+}
+
+
+def bench(fn, rounds: int = ROUNDS) -> float:
+    """返回每次调用的中位耗时(微秒)"""
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        samples.append((time.perf_counter() - start) / rounds * 1e6)
+    return statistics.median(samples)
+
+
+async def bench_redis(url: str, state: dict) -> dict:
+    import redis.asyncio as redis
+
+    client = redis.from_url(url)
+    data = encode_state(state)
+    timings = {"set": [], "get": []}
+    for _ in range(200):
+        start = time.perf_counter()
+        await client.set("bench:ctx", data, ex=60)
+        timings["set"].append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        decode_state(await client.get("bench:ctx"))
+        timings["get"].append((time.perf_counter() - start) * 1000)
+    await client.delete("bench:ctx")
+    await client.aclose()
+    return {name: round(statistics.median(values), 3) for name, values in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", default="", help="测量Redis读写耗时的URL，为空时只测编解码")
+    args = parser.parse_args()
+
+    report = {}
+    for name, state in STATES.items():
+        data = encode_state(state)
+        report[name] = {
+            "json_bytes": len(json.dumps(state, ensure_ascii=False).encode("utf-8")),
+            "encoded_bytes": len(data),
+            "compressed": bool(data[1]),
+            "encode_us": round(bench(lambda: encode_state(state)), 2),
+            "decode_us": round(bench(lambda: decode_state(data)), 2),
+        }
+        if args.redis:
+            report[name]["redis_ms"] = asyncio.run(bench_redis(args.redis, state))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
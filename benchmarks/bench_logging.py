@@ -0,0 +1,84 @@
+"""
+对比改造前后一次请求的日志开销（只统计调用方线程的耗时，不含后台写盘）:
+    - before: 每个模块get_logger时重新配置sink，INFO级别用f-string打印完整的query、响应和ctx
+    - after: 启动时配置一次，热路径日志改为DEBUG并延迟格式化，经有界队列异步写入
+
+运行: python -m benchmarks.bench_logging
+"""
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import loguru
+
+ROUNDS = 2000
+QUERY = "我最近膝盖有点疼，能不能把计划里的有氧运动换成椅子瑜伽，时长改成20分钟？" * 3
+RESPONSE = "好的，已经为您把有氧运动换成椅子瑜伽，每次20分钟。如果膝盖持续疼痛，建议咨询医生。" * 5
+CTX = {"state": {"workout_plan_params": {f"key_{i}": "value" * 10 for i in range(30)}}, "memory": ["msg" * 50] * 20}
+EVENTS = [("AgentOutput", RESPONSE), ("ToolCall", CTX), ("ToolCallResult", RESPONSE)] * 3
+
+
+def request_before(logger):
+    logger.info(f"收到非流式聊天请求: user_id=user@example.com, query='{QUERY}")
+    logger.info(f"开始非流式对话 user_id=user@example.com, query={QUERY}, user_language=zh")
+    logger.info(f"Ctx: {CTX}")
+    for name, value in EVENTS:
+        logger.debug(f"{name}: {value}")
+    logger.info(f"Response content: {RESPONSE}")
+
+
+def request_after(logger):
+    logger.info("收到非流式聊天请求: user_id={}", "user@example.com")
+    logger.debug("开始非流式对话 user_id={}, query={}, user_language={}", "user@example.com", QUERY, "zh")
+    for name, value in EVENTS:
+        logger.debug("{}: {}", name, value)
+    logger.debug("Response content: {}", RESPONSE)
+
+
+def bench(fn, logger) -> list:
+    costs = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn(logger)
+        costs.append((time.perf_counter() - start) * 1000)
+    return costs
+
+
+def report(name: str, costs: list):
+    costs = sorted(costs)
+    p99 = costs[int(len(costs) * 0.99) - 1]
+    print(f"{name:<10} mean={statistics.mean(costs):.3f}ms p50={statistics.median(costs):.3f}ms p99={p99:.3f}ms",
+          file=sys.stderr)
+
+
+def main():
+    log_dir = Path(tempfile.mkdtemp())
+
+    # 改造前的配置: 控制台 + enqueue文件sink，INFO级别
+    before = loguru.logger
+    before.remove()
+    console = open(log_dir / "console_before.log", "w")
+    before.add(console, level="INFO")
+    before.add(log_dir / "before.log", rotation="10 MB", enqueue=True, level="INFO")
+    report("before", bench(request_before, before))
+    before.remove()
+    console.close()
+
+    from app.config import settings
+    settings.LOG_DIR = str(log_dir)
+    from app import logger as app_logger
+
+    # 控制台输出重定向到文件，避免终端速度影响结果
+    stderr, sys.stderr = sys.stderr, open(log_dir / "console_after.log", "w")
+    app_logger.setup_logging()
+    sys.stderr = stderr
+    report("after", bench(request_after, app_logger.get_logger("agent_chat")))
+    dropped = app_logger.dropped_logs()
+    app_logger.shutdown_logging()
+    print(f"dropped={dropped} log_dir={log_dir}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+对比每次请求新建AgentWorkflow与从workflow_registry复用的耗时
+
+运行: python -m benchmarks.bench_workflow_init
+"""
+import time
+import statistics
+
+from llama_index.core.llms import MockLLM
+
+from app.agent import agent_llms
+
+# 基准测试只关心Prompt渲染和Agent构建，不需要真实的LLM
+agent_llms.gemini_llm = lambda: MockLLM()
+
+from app.agent.agent_init import AgentInit, AgentWorkflowRegistry  # noqa: E402
+
+LANGUAGES = ["zh", "en", "ja", "ko", "fr", "de", "es"]
+ROUNDS = 500
+
+
+def bench(fn) -> list:
+    costs = []
+    for i in range(ROUNDS):
+        language = LANGUAGES[i % len(LANGUAGES)]
+        start = time.perf_counter()
+        fn(language)
+        costs.append((time.perf_counter() - start) * 1000)
+    return costs
+
+
+def report(name: str, costs: list):
+    costs = sorted(costs)
+    p99 = costs[int(len(costs) * 0.99) - 1]
+    print(f"{name:<10} mean={statistics.mean(costs):.3f}ms p50={statistics.median(costs):.3f}ms p99={p99:.3f}ms")
+
+
+def main():
+    registry = AgentWorkflowRegistry()
+    report("before", bench(lambda lang: AgentInit(user_language=lang).create_multi_agent_system()))
+    report("after", bench(registry.get))
+
+
+if __name__ == "__main__":
+    main()
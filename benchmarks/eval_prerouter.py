@@ -0,0 +1,51 @@
+"""
+用回放集评估预路由的覆盖率、准确率和耗时
+
+回放集为JSONL，每行 {"query": ..., "agent": ...}，agent为路由智能体实际选择的专业智能体，
+无法分类的问题记为 "路由智能体"，预路由应当回退
+
+运行: python -m benchmarks.eval_prerouter [--replay PATH] [--train PATH]
+"""
+import argparse
+import time
+
+from app.agent.agent_prerouter import PreRouter, NaiveBayesRouter, load_routing_samples, ROUTER_AGENT
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", default="benchmarks/data/routing_replay.jsonl")
+    parser.add_argument("--train", default="", help="用于训练本地模型的路由决策日志")
+    args = parser.parse_args()
+
+    router = PreRouter()
+    if args.train:
+        router.model_router = NaiveBayesRouter().fit(load_routing_samples(args.train))
+
+    samples = load_routing_samples(args.replay)
+    routed = correct = false_routes = 0
+    costs = []
+    for query, expected in samples:
+        start = time.perf_counter()
+        decision = router.route(query)
+        costs.append((time.perf_counter() - start) * 1e6)
+        if decision.agent is None:
+            continue
+        routed += 1
+        if decision.agent == expected:
+            correct += 1
+        elif expected == ROUTER_AGENT:
+            false_routes += 1
+        else:
+            print(f"误路由: {query!r} -> {decision.agent} (期望 {expected})")
+
+    costs.sort()
+    print(f"样本数: {len(samples)}")
+    print(f"覆盖率(跳过路由LLM): {routed / len(samples):.1%}")
+    print(f"准确率(已预路由部分): {correct / routed if routed else 0:.1%}")
+    print(f"应回退却被预路由: {false_routes}")
+    print(f"耗时: p50={costs[len(costs) // 2]:.1f}us p99={costs[int(len(costs) * 0.99) - 1]:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""
+离线压测: 用确定性的stub LLM代替Gemini，回放多轮对话，统计吞吐、延迟分位数和每个worker的内存
+
+两种运行方式:
+    - asgi: 在当前进程内通过ASGITransport调用FastAPI应用，可以使用进程内的fakeredis
+    - uvicorn: 启动 `uvicorn app.main:app --workers N`，通过HTTP压测，需要真实的Redis
+
+飞书接口由本地的stub替代，不会发送真实消息
+asgi模式下ASGITransport会缓冲完整的响应体，流式接口的首个delta耗时只在uvicorn模式下有意义
+
+运行:
+    python -m benchmarks.loadtest --conversations 50 --turns 3 --concurrency 10
+    python -m benchmarks.loadtest --mode uvicorn --workers 4 --redis redis://localhost:6379/15 --stream
+    python -m benchmarks.loadtest --data conversations.jsonl  # 每行 {"user_language": "zh", "turns": ["...", ...]}
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import orjson
+
+REPLAY_PATH = Path(__file__).resolve().parent / "data" / "routing_replay.jsonl"
+
+
+@dataclass
+class Conversation:
+    user_id: str
+    user_language: str
+    turns: List[str]
+
+
+@dataclass
+class Stats:
+    latencies: List[float] = field(default_factory=list)
+    first_event: List[float] = field(default_factory=list)
+    errors: int = 0
+    agents: Dict[str, int] = field(default_factory=dict)
+
+
+def load_conversations(path: Optional[str], count: int, turns: int, language: str, seed: int) -> List[Conversation]:
+    """读取录制的对话；没有指定时用回放集中的问题随机组成多轮对话"""
+    if path:
+        conversations = []
+        with open(path, "rb") as f:
+            for i, line in enumerate(line for line in f if line.strip()):
+                item = orjson.loads(line)
+                conversations.append(Conversation(
+                    user_id=item.get("user_id") or f"loadtest-{i}@example.com",
+                    user_language=item.get("user_language", language),
+                    turns=item["turns"],
+                ))
+        return conversations[:count] if count else conversations
+
+    rng = random.Random(seed)
+    with open(REPLAY_PATH, "rb") as f:
+        queries = [orjson.loads(line)["query"] for line in f if line.strip()]
+    return [
+        Conversation(user_id=f"loadtest-{seed}-{i}@example.com", user_language=language,
+                     turns=[rng.choice(queries) for _ in range(turns)])
+        for i in range(count)
+    ]
+
+
+def stub_lark_app():
+    """
+    模拟飞书的token和发消息接口
+    app.state.hits 记录每个接口的请求次数，加入 app.state.revoked 的token会被判定为失效
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI()
+    app.state.hits = Counter()
+    app.state.revoked = set()
+
+    @app.post("/open-apis/auth/v3/tenant_access_token/internal")
+    async def token():
+        app.state.hits["token"] += 1
+        return {"code": 0, "tenant_access_token": f"stub-token-{app.state.hits['token']}", "expire": 7200}
+
+    @app.post("/open-apis/im/v1/messages")
+    async def messages(request: Request):
+        app.state.hits["messages"] += 1
+        if request.headers.get("Authorization", "").removeprefix("Bearer ") in app.state.revoked:
+            return JSONResponse({"code": 99991663, "msg": "Invalid access token"}, status_code=400)
+        return {"code": 0, "data": {"message_id": "stub"}}
+
+    return app
+
+
+def rss_mb(pid: int) -> Dict[str, float]:
+    """从/proc读取进程的当前和峰值RSS（仅Linux）"""
+    result = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    result["rss_mb" if key == "VmRSS" else "peak_rss_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return result
+
+
+def child_pids(pid: int) -> List[int]:
+    children = []
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                stat = (entry / "stat").read_text()
+            except OSError:
+                continue
+            # 第4个字段是父进程ID，进程名可能包含空格，从最后一个')'之后解析
+            if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+                children.append(int(entry.name))
+    return children
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_turn(client: httpx.AsyncClient, conversation: Conversation, query: str, stream: bool, stats: Stats):
+    payload = {"user_id": conversation.user_id, "query": query, "user_language": conversation.user_language}
+    start = time.perf_counter()
+    try:
+        if stream:
+            event, agent, first_event = "", "", None
+            async with client.stream("POST", "/api/chat/stream", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[7:]
+                        if first_event is None and event == "delta":
+                            first_event = time.perf_counter() - start
+                    elif line.startswith("data: ") and event in ("done", "error"):
+                        agent = orjson.loads(line[6:]).get("agent", "")
+            if event != "done":
+                raise RuntimeError(f"流式响应以 {event} 结束")
+            if first_event is not None:
+                stats.first_event.append(first_event)
+        else:
+            response = await client.post("/api/chat", json=payload)
+            response.raise_for_status()
+            data = response.json()
+            if data.get("status") != "success":
+                raise RuntimeError(data.get("response"))
+            agent = data.get("agent", "")
+        stats.latencies.append(time.perf_counter() - start)
+        stats.agents[agent] = stats.agents.get(agent, 0) + 1
+    except Exception as e:
+        stats.errors += 1
+        print(f"请求失败: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+async def replay(client: httpx.AsyncClient, conversations: List[Conversation], concurrency: int,
+                 stream: bool) -> Stats:
+    """同一个对话的多轮按顺序发送，不同对话之间最多concurrency个并发"""
+    stats = Stats()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_conversation(conversation: Conversation):
+        async with semaphore:
+            for query in conversation.turns:
+                await run_turn(client, conversation, query, stream, stats)
+
+    await asyncio.gather(*(run_conversation(conversation) for conversation in conversations))
+    return stats
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+async def redis_round_trips(client: httpx.AsyncClient) -> Dict[str, float]:
+    """从/metrics读取每轮对话的平均Redis往返次数（多worker时取决于指标的发布间隔）"""
+    totals: Dict[str, Dict[str, float]] = {}
+    for line in (await client.get("/metrics")).text.splitlines():
+        for suffix in ("_sum", "_count"):
+            prefix = f"redis_round_trips_per_turn{suffix}{{"
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].rsplit("} ", 1)
+                path = labels.split('path="', 1)[1].split('"', 1)[0]
+                totals.setdefault(path, {})[suffix] = float(value)
+    return {path: round(t.get("_sum", 0) / t["_count"], 2) for path, t in totals.items() if t.get("_count")}
+
+
+async def history_cache_stats(client: httpx.AsyncClient) -> Dict[str, float]:
+    """从/metrics读取进程内历史缓存的命中情况（hit/miss/stale）"""
+    prefix = 'cache_requests_total{cache="history",result="'
+    counts: Dict[str, float] = {}
+    for line in (await client.get("/metrics")).text.splitlines():
+        if line.startswith(prefix):
+            result, value = line[len(prefix):].split('"} ', 1)
+            counts[result] = counts.get(result, 0) + float(value)
+    total = sum(counts.values())
+    return {**counts, "hit_ratio": round(counts.get("hit", 0) / total, 3)} if total else {}
+
+
+def report(stats: Stats, elapsed: float, memory: Dict[str, Dict[str, float]],
+           round_trips: Optional[Dict[str, float]] = None,
+           history_cache: Optional[Dict[str, float]] = None) -> Dict:
+    total = len(stats.latencies) + stats.errors
+    result = {
+        "requests": total,
+        "errors": stats.errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(stats.latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.mean(stats.latencies) * 1000, 1) if stats.latencies else 0.0,
+            "p50": round(percentile(stats.latencies, 0.50) * 1000, 1),
+            "p95": round(percentile(stats.latencies, 0.95) * 1000, 1),
+            "p99": round(percentile(stats.latencies, 0.99) * 1000, 1),
+        },
+        "agents": stats.agents,
+        "memory": memory,
+        "redis_round_trips_per_turn": round_trips or {},
+        "history_cache": history_cache or {},
+    }
+    if stats.first_event:
+        result["first_delta_ms"] = {
+            "p50": round(percentile(stats.first_event, 0.50) * 1000, 1),
+            "p95": round(percentile(stats.first_event, 0.95) * 1000, 1),
+            "p99": round(percentile(stats.first_event, 0.99) * 1000, 1),
+        }
+    return result
+
+
+def configure_env(args):
+    """必须在导入app之前设置，配置在导入时读取"""
+    os.environ["LLM_PROVIDER"] = "stub"
+    os.environ["STUB_LLM_TTFT_MS"] = str(args.ttft_ms)
+    os.environ["STUB_LLM_TOKEN_MS"] = str(args.token_ms)
+    os.environ["STUB_LLM_RESPONSE_TOKENS"] = str(args.tokens)
+    os.environ["LOG_LEVEL"] = args.log_level
+    os.environ["AGENT_WORKFLOW_VERBOSE"] = "false"
+    os.environ.setdefault("PREROUTER_LOG_PATH", "")
+    # 飞书接口为本地stub，不需要真实凭证
+    os.environ.setdefault("LARK_APP_ID", "loadtest")
+    os.environ.setdefault("LARK_APP_SECRET", "loadtest")
+    if args.redis == "fake":
+        # fakeredis的阻塞读取会阻塞事件循环，改为直接调用（stub）飞书接口
+        os.environ["OUTBOX_ENABLED"] = "false"
+        os.environ["OUTBOX_WORKERS"] = "0"
+        os.environ["METRICS_MULTIPROCESS"] = "false"
+        os.environ["USER_LOCK_BACKEND"] = "local"
+    else:
+        os.environ["REDIS_DATABASE_URL"] = args.redis
+
+
+async def run_asgi(args, conversations: List[Conversation]) -> Dict:
+    from app.main import app
+    from app.db.redis.session import instrument_pool, redis_memory
+    from app.tools import lark_client
+
+    if args.redis == "fake":
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("--redis fake 需要安装fakeredis: pip install fakeredis")
+        redis_memory._redis = fakeredis.FakeAsyncRedis()
+        instrument_pool(redis_memory._redis.connection_pool)
+    lark_client._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=stub_lark_app()), base_url="http://lark.stub"
+    )
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+            start = time.perf_counter()
+            stats = await replay(client, conversations, args.concurrency, args.stream)
+            elapsed = time.perf_counter() - start
+            round_trips = await redis_round_trips(client)
+            history_cache = await history_cache_stats(client)
+    return report(stats, elapsed, {"worker": rss_mb(os.getpid())}, round_trips, history_cache)
+
+
+async def run_uvicorn(args, conversations: List[Conversation]) -> Dict:
+    import uvicorn
+
+    # 飞书stub在当前进程的后台线程中运行
+    lark_port = free_port()
+    lark_server = uvicorn.Server(uvicorn.Config(stub_lark_app(), host="127.0.0.1", port=lark_port, log_level="error"))
+    threading.Thread(target=lark_server.run, daemon=True).start()
+
+    port = free_port()
+    env = {**os.environ, "LARK_BASE_URL": f"http://127.0.0.1:{lark_port}"}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None,
+                                     limits=httpx.Limits(max_connections=args.concurrency * 2)) as client:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    await client.get("/metrics")
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline or process.poll() is not None:
+                        raise RuntimeError("uvicorn启动失败")
+                    await asyncio.sleep(0.5)
+
+            start = time.perf_counter()
+            stats = await replay(client, conversations, args.concurrency, args.stream)
+            elapsed = time.perf_counter() - start
+            round_trips = await redis_round_trips(client)
+            history_cache = await history_cache_stats(client)
+        memory = {f"worker-{pid}": rss_mb(pid) for pid in child_pids(process.pid)}
+        return report(stats, elapsed, memory, round_trips, history_cache)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        lark_server.should_exit = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--workers", type=int, default=2, help="uvicorn worker数")
+    parser.add_argument("--redis", default="fake", help="fake(进程内fakeredis，仅asgi模式) 或 Redis URL")
+    parser.add_argument("--data", default="", help="录制的多轮对话JSONL，不指定时随机生成")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--language", default="zh")
+    parser.add_argument("--stream", action="store_true", help="压测 /api/chat/stream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=10)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default="", help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    if args.mode == "uvicorn" and args.redis == "fake":
+        parser.error("uvicorn模式的多个worker不能共享fakeredis，请通过 --redis 指定Redis URL")
+
+    configure_env(args)
+    conversations = load_conversations(args.data, args.conversations, args.turns, args.language, args.seed)
+    runner = run_asgi if args.mode == "asgi" else run_uvicorn
+    result = asyncio.run(runner(args, conversations))
+
+    output = orjson.dumps(result, option=orjson.OPT_INDENT_2).decode("utf-8")
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output, encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import os
+
+# 配置在导入app时读取，必须在导入之前设置: 使用stub LLM和fakeredis，不访问网络
+os.environ.update(
+    LLM_PROVIDER="stub",
+    STUB_LLM_TTFT_MS="1",
+    STUB_LLM_TOKEN_MS="2",
+    STUB_LLM_RESPONSE_TOKENS="40",
+    AGENT_WORKFLOW_VERBOSE="false",
+    OUTBOX_ENABLED="false",
+    OUTBOX_WORKERS="0",
+    METRICS_MULTIPROCESS="false",
+    USER_LOCK_BACKEND="local",
+    RESPONSE_CACHE_ENABLED="false",
+    PREROUTER_ENABLED="false",
+    PREROUTER_LOG_PATH="",
+    MEMORY_SUMMARY_ENABLED="false",
+    LARK_APP_ID="test-app-id",
+    LARK_APP_SECRET="test-app-secret",
+    LOG_LEVEL="WARNING",
+)
+
+import fakeredis  # noqa: E402
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+from app.db.redis.session import redis_memory  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def redis():
+    """每个测试使用独立的fakeredis（不支持Lua脚本）"""
+    client = fakeredis.FakeAsyncRedis()
+    redis_memory._redis = client
+    yield client
+    redis_memory._redis = None
+
+
+@pytest.fixture
+async def app(redis):
+    """运行应用的lifespan，飞书接口替换为本地stub"""
+    from app.main import app
+    from app.tools import lark_client
+    from benchmarks.loadtest import stub_lark_app
+
+    lark_client._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=stub_lark_app()), base_url="http://lark.stub"
+    )
+    async with app.router.lifespan_context(app):
+        # lifespan退出时会关闭连接，测试结束前保持同一个fakeredis
+        yield app
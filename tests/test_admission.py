@@ -0,0 +1,49 @@
+import anyio
+import pytest
+
+from app.admission import AdmissionController, user_lock_key
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_release_in_cancelled_scope_frees_user_lock(redis):
+    controller = AdmissionController(max_in_flight=2, max_queue=10, queue_timeout=1, user_lock_backend="redis")
+    ticket = await controller.acquire("a1")
+    assert await redis.exists(user_lock_key("a1"))
+    release_user = ticket._release_user
+
+    async def slow_release_user():
+        # 真实Redis的请求会让出事件循环，fakeredis不会，这里手动让出一次
+        await anyio.sleep(0)
+        await release_user()
+
+    ticket._release_user = slow_release_user
+
+    # 模拟客户端断开: 在已被取消的scope中释放
+    with anyio.CancelScope() as scope:
+        scope.cancel()
+        await ticket.release()
+
+    assert not await redis.exists(user_lock_key("a1"))
+    assert controller.semaphore._value == 2
+    await ticket.release()
+    assert controller.semaphore._value == 2
+
+
+async def test_failed_user_release_can_be_retried():
+    controller = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=1, user_lock_backend="none")
+    calls = []
+
+    async def release_user():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("redis down")
+
+    ticket = await controller.acquire("a2")
+    ticket._release_user = release_user
+    with pytest.raises(RuntimeError):
+        await ticket.release()
+    await ticket.release()
+    await ticket.release()
+    assert len(calls) == 2
+    assert controller.semaphore._value == 1
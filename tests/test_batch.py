@@ -0,0 +1,107 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from app.admission import admission_controller
+from app.agent import agent_batch
+from app.agent.agent_memory import MemoryManager
+from app.agent.agent_session_store import session_store
+from app.config import settings
+from app.tracing import span, start_trace, trace_exporter
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_batch_items_share_the_batch_pool(app, monkeypatch):
+    monkeypatch.setattr(admission_controller, "batch_semaphore", asyncio.Semaphore(2))
+    running, peak = 0, 0
+
+    async def fake_chat(**kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {"response": "ok", "agent": "stub", "status": "success"}
+
+    monkeypatch.setattr(agent_batch, "multi_agent_chat", fake_chat)
+    items = [(f"b{i}", "你好", "zh") for i in range(8)]
+
+    async def run():
+        return [result async for result in agent_batch.multi_agent_chat_batch(items, concurrency=8)]
+
+    # 两个批量任务各自的并发为8，合计仍不超过批量并发池的大小
+    results = await asyncio.gather(run(), run())
+    assert all(result["status"] == "success" for batch in results for result in batch)
+    assert peak == 2
+    assert admission_controller.batch_semaphore._value == 2
+
+
+async def test_concurrent_batch_requests_are_limited(app, monkeypatch):
+    monkeypatch.setattr(admission_controller, "batch_max_requests", 1)
+    body = {"items": [{"user_id": "b9", "query": "你好", "user_language": "zh"}]}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        release = admission_controller.acquire_batch_request()
+        response = await client.post("/api/chat/batch", json=body)
+        assert response.status_code == 503 and "Retry-After" in response.headers
+        await release()
+
+        response = await client.post("/api/chat/batch", json=body)
+        assert response.status_code == 200
+        assert orjson.loads(response.text.splitlines()[0])["index"] == 0
+    assert admission_controller.batch_requests == 0
+
+
+async def test_stale_snapshot_is_reloaded_under_user_lock(app, monkeypatch):
+    snapshots = []
+
+    async def fake_chat(**kwargs):
+        snapshots.append(kwargs["snapshot"])
+        return {"response": "ok", "agent": "stub", "status": "success"}
+
+    monkeypatch.setattr(agent_batch, "multi_agent_chat", fake_chat)
+    snapshot = await session_store.bootstrap("b20")
+    await agent_batch._run_item("b20", "你好", "zh", MemoryManager("b20"), snapshot)
+    assert snapshots[-1] is snapshot
+
+    # 预读之后同一用户的其他请求提交过，不能再使用预读的快照
+    await session_store.commit(MemoryManager("b20"), [ChatMessage(role=MessageRole.USER, content="改成太极")])
+    await agent_batch._run_item("b20", "你好", "zh", MemoryManager("b20"), snapshot)
+    assert snapshots[-1] is None
+
+
+async def test_each_item_gets_its_own_trace(app, monkeypatch):
+    exported = []
+    monkeypatch.setattr(trace_exporter, "export", exported.append)
+
+    async def fake_chat(**kwargs):
+        with span("llm.router"):
+            return {"response": "ok", "agent": "stub", "status": "success"}
+
+    monkeypatch.setattr(agent_batch, "multi_agent_chat", fake_chat)
+    items = [(f"b3{i}", "你好", "zh") for i in range(3)]
+    with start_trace("http.request") as request_trace:
+        results = [result async for result in agent_batch.multi_agent_chat_batch(items, concurrency=2)]
+    assert len(results) == 3
+    # 批量请求的trace中只有预读等批次级别的span
+    assert [s.name for s in request_trace.spans] == ["http.request", "session.bootstrap"]
+    item_traces = [trace for trace in exported if trace.spans[0].name == "batch.item"]
+    assert len(item_traces) == 3
+    for trace in item_traces:
+        assert trace.spans[0].parent_id is None
+        assert trace.spans[0].attributes["batch.request_id"] == request_trace.trace_id
+        assert [s.name for s in trace.spans] == ["batch.item", "llm.router"]
+
+
+def test_spans_per_trace_are_capped(monkeypatch):
+    monkeypatch.setattr(settings, "TRACE_MAX_SPANS", 3)
+    monkeypatch.setattr(trace_exporter, "export", lambda trace: None)
+    with start_trace("http.request") as trace:
+        for _ in range(5):
+            with span("tool"):
+                pass
+    assert len(trace.spans) == 3 and trace.dropped_spans == 3
+    assert trace.spans[0].attributes["dropped_spans"] == 3
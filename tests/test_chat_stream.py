@@ -0,0 +1,61 @@
+import anyio
+import orjson
+import pytest
+
+from app.db.redis.codec import decode_message
+
+pytestmark = pytest.mark.anyio
+
+
+async def _stream(app, user_id: str, query: str, disconnect_after_first_chunk: bool) -> int:
+    """直接调用ASGI应用，可以在收到第一个chunk后模拟客户端断开，返回收到的chunk数"""
+    body = orjson.dumps({"user_id": user_id, "query": query, "user_language": "zh"})
+    first_chunk = anyio.Event()
+    finished = anyio.Event()
+    chunks = 0
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        if disconnect_after_first_chunk:
+            await first_chunk.wait()
+        else:
+            await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal chunks
+        if message["type"] == "http.response.body":
+            if message.get("body"):
+                chunks += 1
+                first_chunk.set()
+            if not message.get("more_body"):
+                finished.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/api/chat/stream", "raw_path": b"/api/chat/stream", "root_path": "",
+        "query_string": b"", "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1), "server": ("test", 80),
+    }
+    with anyio.fail_after(30):
+        await app(scope, receive, send)
+    return chunks
+
+
+async def test_stream_saves_history(app, redis):
+    await _stream(app, "s1", "App闪退怎么办", disconnect_after_first_chunk=False)
+    messages = [decode_message(raw) for raw in await redis.lrange("s1", 0, -1)]
+    assert messages[0].role.value == "user" and messages[-1].role.value == "assistant"
+
+
+async def test_stream_saves_history_when_client_disconnects(app, redis):
+    chunks = await _stream(app, "s2", "App闪退怎么办", disconnect_after_first_chunk=True)
+    assert chunks >= 1
+    messages = [decode_message(raw) for raw in await redis.lrange("s2", 0, -1)]
+    # 断开时工作流被取消，至少保存了用户的问题，下一轮可以接着对话
+    assert messages and messages[0].role.value == "user"
+    assert messages[0].content == "App闪退怎么办"
@@ -0,0 +1,33 @@
+import pytest
+from llama_index.core.llms import ChatMessage
+
+from app.agent.agent_llm_pool import LLMProvider, PooledLLM
+from app.agent.agent_stub_llm import StubLLM
+from app.resilience import CircuitBreaker
+
+pytestmark = pytest.mark.anyio
+
+
+def _pool() -> PooledLLM:
+    providers = [LLMProvider(name, StubLLM(ttft_ms=1, token_ms=0, response_tokens=3), 4) for name in ("primary", "fallback")]
+    for provider in providers:
+        provider.breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0, probe_timeout=60)
+        provider.breaker.record_failure()
+    # 对冲时间足够长，只会请求第一个provider
+    return PooledLLM(providers, hedge_after=10, first_chunk_timeout=5)
+
+
+async def test_unused_fallback_stays_open():
+    pool = _pool()
+    await pool.achat([ChatMessage(role="user", content="你好")])
+    primary, fallback = pool.providers
+    assert primary.breaker.state == CircuitBreaker.CLOSED
+    assert fallback.breaker.state == CircuitBreaker.OPEN
+
+
+def test_sync_call_only_probes_used_provider():
+    pool = _pool()
+    pool.chat([ChatMessage(role="user", content="你好")])
+    primary, fallback = pool.providers
+    assert primary.breaker.state == CircuitBreaker.CLOSED
+    assert fallback.breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+
+from app.config import settings
+from app.logger import BoundedQueueSink, RotatingFileWriter, _plain_notice, cleanup_stale_logs, log_file_path
+
+
+class _Writer:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data: bytes):
+        self.lines.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_per_process_file_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "LOG_FILE_PER_PROCESS", True)
+    assert log_file_path(tmp_path).name == f"{settings.LOG_FILE_NAME}.{os.getpid()}.log"
+    monkeypatch.setattr(settings, "LOG_FILE_PER_PROCESS", False)
+    assert log_file_path(tmp_path).name == f"{settings.LOG_FILE_NAME}.log"
+
+
+def test_cleanup_stale_logs_keeps_live_and_recent_files(tmp_path):
+    name = settings.LOG_FILE_NAME
+    # 一个不存在的进程号留下的文件，以及当前进程的文件
+    dead_pid = 2 ** 22 + 1
+    now = time.time()
+    for index, file_name in enumerate([f"{name}.{dead_pid}.log", f"{name}.{dead_pid}.log.1", f"{name}.{dead_pid}.log.2"]):
+        path = tmp_path / file_name
+        path.write_bytes(b"x")
+        os.utime(path, (now - index, now - index))
+    live = tmp_path / f"{name}.{os.getpid()}.log"
+    other = tmp_path / "other.log"
+    live.write_bytes(b"x")
+    other.write_bytes(b"x")
+
+    cleanup_stale_logs(tmp_path, retention=1)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([
+        f"{name}.{dead_pid}.log", live.name, other.name,
+    ])
+
+
+def test_rotation_can_be_disabled(tmp_path):
+    writer = RotatingFileWriter(tmp_path / "a.log", max_bytes=0, retention=3)
+    for _ in range(10):
+        writer.write(b"x" * 100)
+    writer.close()
+    assert [path.name for path in tmp_path.iterdir()] == ["a.log"]
+
+
+def test_console_drop_notice_is_plain_text():
+    writer = _Writer()
+    blocked = threading.Event()
+
+    def encoder(message):
+        blocked.wait(5)
+        return message
+
+    sink = BoundedQueueSink(writer, encoder, _plain_notice, maxsize=1)
+    for _ in range(5):
+        sink.write(b"line\n")
+    blocked.set()
+    time.sleep(0.05)
+    sink.write(b"line\n")
+    sink.stop()
+
+    notices = [line.decode("utf-8") for line in writer.lines if b"line" not in line]
+    assert sink.dropped and notices
+    # 控制台的丢弃提示与其他日志一样是文本格式，不是JSON
+    assert " | WARNING | " in notices[0] and not notices[0].startswith("{")
@@ -0,0 +1,61 @@
+import pytest
+
+from app.config import settings
+from app.metrics import MetricsRegistry, render
+
+pytestmark = pytest.mark.anyio
+
+
+def _worker(worker_id: str, value: int) -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.worker_id = worker_id
+    registry.counter("jobs_total", "任务数").inc(value)
+    registry.gauge("jobs_in_flight", "进行中的任务数").set(value)
+    registry.histogram("job_seconds", "任务耗时", buckets=(1, 10)).observe(value)
+    return registry
+
+
+def _total(snapshot, name: str = "jobs_total") -> int:
+    return sum(value for _, value in snapshot[name]["samples"])
+
+
+async def test_collect_merges_registered_workers(redis, monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_MULTIPROCESS", True)
+    first, second, third = _worker("w1", 1), _worker("w2", 2), _worker("w3", 4)
+    for registry in (first, second, third):
+        await registry.publish()
+    assert _total(await first.collect()) == 7
+
+    # 退出的worker删除登记，快照过期的worker不再参与合并
+    await second.unpublish()
+    await redis.zadd(settings.METRICS_REGISTRY_KEY, {"w3": 1})
+    snapshot = await first.collect()
+    assert _total(snapshot, "jobs_in_flight") == 1
+    assert set(await redis.zrange(settings.METRICS_REGISTRY_KEY, 0, -1)) == {b"w1", b"w3"}
+    await first.publish()
+    assert await redis.zrange(settings.METRICS_REGISTRY_KEY, 0, -1) == [b"w1"]
+
+
+async def test_retired_workers_keep_counter_totals(redis, monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_MULTIPROCESS", True)
+    first, second, third = _worker("w1", 1), _worker("w2", 2), _worker("w3", 20)
+    for registry in (first, second, third):
+        await registry.publish()
+    before = await first.collect()
+
+    # 正常退出和登记过期（崩溃）的worker: counter和histogram保持不变，gauge随worker消失
+    await second.unpublish()
+    await second.unpublish()
+    await redis.zadd(settings.METRICS_REGISTRY_KEY, {"w3": 1})
+    await first.publish()
+    await first.publish()
+    after = await first.collect()
+    assert _total(after) == _total(before) == 23
+    assert after["job_seconds"]["samples"] == before["job_seconds"]["samples"] == [[[], [1, 1, 1, 23.0, 3]]]
+    assert _total(after, "jobs_in_flight") == 1
+    assert 'job_seconds_bucket{le="10"} 2\n' in render(after)
+
+    # 新的worker从0开始计数，合计值继续增加
+    fourth = _worker("w4", 5)
+    await fourth.publish()
+    assert _total(await first.collect()) == 28
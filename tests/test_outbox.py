@@ -0,0 +1,83 @@
+import pytest
+
+from app import outbox
+from app.agent.agent_profile import profile_store
+from app.config import settings
+from app.resilience import ResilientEndpoint, RetryableError
+
+pytestmark = pytest.mark.anyio
+
+PROFILE = {"values": {"workout_duration": "15-20"}, "remove": None}
+
+
+@pytest.fixture
+def worker(redis, monkeypatch):
+    endpoint = ResilientEndpoint(
+        "lark-test", max_attempts=1, base_delay=0, max_delay=0, timeout=1, queue_timeout=0.05,
+        failure_threshold=1, recovery_timeout=60,
+    )
+    monkeypatch.setattr(outbox, "get_endpoint", lambda kind: endpoint)
+    worker = outbox.OutboxWorker(name="test")
+    worker.endpoint = endpoint
+    return worker
+
+
+async def _enqueue_and_read(worker, redis):
+    await worker.ensure_group()
+    key = await outbox.enqueue("lark", "o1", {"workout_duration": "15-20"}, "Plan", profile=PROFILE)
+    response = await redis.xreadgroup(worker.group, worker.name, {worker.stream: ">"}, count=1)
+    entry_id, fields = response[0][1][0]
+    return key, entry_id, fields
+
+
+async def _pending(worker, redis) -> int:
+    return (await redis.xpending(worker.stream, worker.group))["pending"]
+
+
+async def test_profile_is_saved_only_after_delivery(worker, redis, monkeypatch):
+    async def fail(user_id, payload, idempotency_key):
+        raise RetryableError("down")
+
+    monkeypatch.setitem(outbox.HANDLERS, "lark", fail)
+    monkeypatch.setattr(settings, "OUTBOX_MAX_DELIVERIES", 1)
+    key, entry_id, fields = await _enqueue_and_read(worker, redis)
+    await worker.process(entry_id, fields)
+    assert (await outbox.get_status(key))["status"] == "failed"
+    assert await profile_store.load("o1") == {}
+
+    async def deliver(user_id, payload, idempotency_key):
+        pass
+
+    monkeypatch.setitem(outbox.HANDLERS, "lark", deliver)
+    worker.endpoint.breaker.record_success()
+    key, entry_id, fields = await _enqueue_and_read(worker, redis)
+    await worker.process(entry_id, fields)
+    assert (await outbox.get_status(key))["status"] == "delivered"
+    assert (await profile_store.load("o1"))["workout_duration"] == "15-20"
+
+
+async def test_circuit_open_does_not_count_as_attempt(worker, redis, monkeypatch):
+    monkeypatch.setattr(settings, "OUTBOX_MAX_DELIVERIES", 1)
+    worker.endpoint.breaker.record_failure()
+    key, entry_id, fields = await _enqueue_and_read(worker, redis)
+    for _ in range(3):
+        await worker.process(entry_id, fields)
+    status = await outbox.get_status(key)
+    assert status["status"] == "retrying" and status["attempts"] == "0"
+    assert await _pending(worker, redis) == 1
+
+
+@pytest.mark.parametrize("fields", [
+    {b"key": b"k1", b"kind": b"unknown", b"user_id": b"o1", b"payload": b"{}"},
+    {b"key": b"k2", b"kind": b"lark", b"user_id": b"o1"},
+    {b"key": b"k3", b"kind": b"lark", b"user_id": b"o1", b"payload": b"not json"},
+])
+async def test_malformed_entry_is_dead_lettered(worker, redis, fields):
+    await worker.ensure_group()
+    await redis.xadd(worker.stream, fields)
+    response = await redis.xreadgroup(worker.group, worker.name, {worker.stream: ">"}, count=1)
+    entry_id, fields = response[0][1][0]
+    await worker.process(entry_id, fields)
+    assert await _pending(worker, redis) == 0
+    dead = await redis.xrange(settings.OUTBOX_DEAD_LETTER_STREAM)
+    assert len(dead) == 1 and dead[0][1][b"entry_id"] == entry_id
@@ -0,0 +1,80 @@
+import orjson
+import pytest
+
+from app.agent.agent_chat import _select_root_agent, multi_agent_chat
+from app.agent.agent_memory import MemoryManager
+from app.agent.agent_prerouter import HEALTH_AGENT, REFIT_AGENT, ROUTER_AGENT, SUBSCRIPTION_AGENT, PreRouter
+from app.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def router():
+    return PreRouter(threshold=0.85)
+
+
+def test_keyword_route_without_history(router):
+    assert router.route("膝盖痛怎么办").agent == HEALTH_AGENT
+    assert router.route("怎么申请退款").agent == SUBSCRIPTION_AGENT
+
+
+@pytest.mark.parametrize("query", ["是的，膝盖痛，帮我改一下", "还是膝盖痛", "ok, my knee pain is back"])
+def test_follow_up_is_left_to_router_with_history(router, query):
+    decision = router.route(query, has_history=True)
+    assert decision.agent is None and decision.source == "follow_up"
+
+
+def test_explicit_request_is_routed_with_history(router):
+    assert router.route("把运动时长改成15-20分钟", has_history=True).agent == REFIT_AGENT
+
+
+async def test_record_appends_jsonl(router, tmp_path):
+    path = str(tmp_path / "routing.jsonl")
+    await router.record("怎么申请退款", SUBSCRIPTION_AGENT, path=path)
+    await router.record("你好", "路由智能体", path=path)
+    with open(path, "rb") as f:
+        lines = f.read().splitlines()
+    assert [orjson.loads(line) for line in lines] == [{"query": "怎么申请退款", "agent": SUBSCRIPTION_AGENT}]
+
+
+def test_record_log_is_rotated(router, tmp_path):
+    path = str(tmp_path / "routing.jsonl")
+    line = orjson.dumps({"query": "怎么申请退款", "agent": SUBSCRIPTION_AGENT}) + b"\n"
+    for _ in range(10):
+        router._append(path, line, max_bytes=len(line) * 3)
+    # 当前文件和一个历史文件都不超过上限
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["routing.jsonl", "routing.jsonl.1"]
+    assert all(file.stat().st_size <= len(line) * 3 for file in tmp_path.iterdir())
+
+    router.load_training_data(path)
+    assert router.model_router.class_counts[SUBSCRIPTION_AGENT] == 4
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("改成瑜伽吧，我腰疼", REFIT_AGENT),
+    ("是的，膝盖痛，帮我改一下", REFIT_AGENT),
+    ("另外，怎么申请退款", ROUTER_AGENT),
+    ("by the way, my app keeps crashing", ROUTER_AGENT),
+])
+def test_select_root_agent_prefers_continuation(monkeypatch, query, expected):
+    monkeypatch.setattr(settings, "PREROUTER_ENABLED", True)
+    assert _select_root_agent(query, last_agent=REFIT_AGENT, has_history=True) == expected
+
+
+def test_select_root_agent_pre_routes_without_recent_agent(monkeypatch):
+    monkeypatch.setattr(settings, "PREROUTER_ENABLED", True)
+    assert _select_root_agent("我腰疼", last_agent=None, has_history=False) == HEALTH_AGENT
+
+
+async def test_resumed_specialist_hands_off_cross_category_question(app, redis):
+    first = await multi_agent_chat("r1", "怎么申请退款", MemoryManager("r1"), "zh")
+    assert first["agent"] == SUBSCRIPTION_AGENT
+
+    # 窗口内从上一轮的智能体开始，问题属于其他分类时转交回路由智能体，而不是被拒绝
+    assert _select_root_agent("我膝盖疼怎么办", last_agent=SUBSCRIPTION_AGENT) == SUBSCRIPTION_AGENT
+    second = await multi_agent_chat("r1", "我膝盖疼怎么办", MemoryManager("r1"), "zh")
+    assert second["status"] == "success" and second["agent"] == HEALTH_AGENT
+
+    third = await multi_agent_chat("r1", "退款多久到账", MemoryManager("r1"), "zh")
+    assert third["agent"] == SUBSCRIPTION_AGENT
@@ -0,0 +1,80 @@
+import httpx
+import pytest
+
+from app.agent.agent_profile import profile_store
+from app.config import settings
+from app.db.redis.session import profile_index_key
+
+pytestmark = pytest.mark.anyio
+
+
+async def _members(redis, field: str, value: str):
+    return {member.decode("utf-8") for member in await redis.smembers(profile_index_key(field, value))}
+
+
+async def test_multi_valued_fields_are_indexed_per_value(redis):
+    await profile_store.update("p1", {"physical_limitation": "knee"})
+    await profile_store.update("p1", {"physical_limitation": "back", "workout_duration": "15-20"})
+    assert (await profile_store.load("p1"))["physical_limitation"] == "back,knee"
+    assert await _members(redis, "physical_limitation", "knee") == {"p1"}
+    assert await _members(redis, "physical_limitation", "back") == {"p1"}
+
+    # 单值字段覆盖旧值
+    await profile_store.update("p1", {"workout_duration": "5-10"})
+    assert await _members(redis, "workout_duration", "15-20") == set()
+    assert await profile_store.cohort({"physical_limitation": "knee", "workout_duration": "5-10"}) == (1, ["p1"])
+
+
+async def test_cancel_removes_only_that_value(redis):
+    await profile_store.update("p2", {"workout_type": "tai_chi,chair_yoga"})
+    await profile_store.update("p2", {}, remove={"workout_type": "tai_chi"})
+    assert (await profile_store.load("p2"))["workout_type"] == "chair_yoga"
+    assert await _members(redis, "workout_type", "tai_chi") == set()
+
+    await profile_store.update("p2", {}, remove={"workout_type": None})
+    assert "workout_type" not in await profile_store.load("p2")
+    assert await _members(redis, "workout_type", "chair_yoga") == set()
+
+
+async def test_exclusive_value_replaces_others(redis):
+    await profile_store.update("p3", {"physical_limitation": "knee,hip"})
+    await profile_store.update("p3", {"physical_limitation": "i'm_all_good"})
+    assert (await profile_store.load("p3"))["physical_limitation"] == "i'm_all_good"
+    assert await _members(redis, "physical_limitation", "knee") == set()
+
+
+async def test_invalid_values_are_not_indexed(redis):
+    await profile_store.update("p4", {"physical_limitation": "knee,elbow", "coach": "robot", "nickname": "小王"})
+    assert await profile_store.load("p4") == {"physical_limitation": "knee", "nickname": "小王"}
+    assert not await redis.exists(profile_index_key("physical_limitation", "elbow"))
+    assert not await redis.exists(profile_index_key("coach", "robot"))
+
+
+def test_cohort_criteria_must_use_options():
+    with pytest.raises(ValueError):
+        profile_store.validate_criteria({"physical_limitation": "elbow"})
+    with pytest.raises(ValueError):
+        profile_store.validate_criteria({"age": "70"})
+    profile_store.validate_criteria({"physical_limitation": "knee"})
+
+
+async def test_multi_criteria_cohort_is_limited_like_single(redis):
+    for index in range(5):
+        await profile_store.update(f"c{index}", {"physical_limitation": "knee", "workout_duration": "5-10"})
+    for criteria in ({"physical_limitation": "knee"}, {"physical_limitation": "knee", "workout_duration": "5-10"}):
+        total, user_ids = await profile_store.cohort(criteria, limit=2)
+        assert total == 5 and len(user_ids) == 2 and user_ids == sorted(user_ids)
+
+
+async def test_profile_routes_require_admin_token(app, monkeypatch):
+    await profile_store.update("a1", {"nickname": "小王"})
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        # 未配置token时接口不开放
+        assert (await client.get("/api/profiles/a1")).status_code == 404
+
+        monkeypatch.setattr(settings, "PROFILE_ADMIN_TOKEN", "secret")
+        assert (await client.get("/api/profiles/a1")).status_code == 401
+        assert (await client.get("/api/profiles/cohort?coach=male", headers={"X-Admin-Token": "wrong"})).status_code == 401
+
+        response = await client.get("/api/profiles/a1", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200 and response.json()["profile"] == {"nickname": "小王"}
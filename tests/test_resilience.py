@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from app.resilience import CircuitBreaker, ResilientEndpoint, RetryableError
+
+pytestmark = pytest.mark.anyio
+
+
+def _endpoint(**kwargs) -> ResilientEndpoint:
+    options = dict(
+        max_attempts=1, base_delay=0, max_delay=0, timeout=1, max_concurrency=1, queue_timeout=0.05,
+        failure_threshold=1, recovery_timeout=0.05,
+    )
+    options.update(kwargs)
+    return ResilientEndpoint("test", **options)
+
+
+async def _fail():
+    raise RetryableError("down")
+
+
+async def _ok():
+    pass
+
+
+async def _open(endpoint: ResilientEndpoint):
+    assert not (await endpoint.call(_fail)).success
+    assert endpoint.breaker.state == CircuitBreaker.OPEN
+    await asyncio.sleep(endpoint.breaker.recovery_timeout)
+
+
+def test_available_has_no_side_effects():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0, probe_timeout=10)
+    breaker.record_failure()
+    assert breaker.available()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.available() and not breaker.allow()
+
+
+async def test_probe_rejected_by_queue_does_not_stick_half_open():
+    endpoint = _endpoint()
+    await _open(endpoint)
+
+    # 并发名额被占用，排队超时的请求不会占用探测名额
+    await endpoint.semaphore.acquire()
+    result = await endpoint.call(_ok)
+    endpoint.semaphore.release()
+    assert result.rejected
+    assert endpoint.breaker.state == CircuitBreaker.OPEN
+
+    assert (await endpoint.call(_ok)).success
+    assert endpoint.breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_cancelled_probe_releases_half_open():
+    endpoint = _endpoint()
+    await _open(endpoint)
+
+    task = asyncio.create_task(endpoint.call(lambda: asyncio.sleep(10)))
+    await asyncio.sleep(0.01)
+    assert endpoint.breaker.state == CircuitBreaker.HALF_OPEN
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert endpoint.breaker.state == CircuitBreaker.OPEN
+
+    assert (await endpoint.call(_ok)).success
+    assert endpoint.breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_stuck_probe_times_out():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0, probe_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    await asyncio.sleep(0.05)
+    assert breaker.allow()
@@ -0,0 +1,52 @@
+import pytest
+
+from app.agent.agent_cache import query_length, response_cache
+from app.agent.agent_chat import multi_agent_chat
+from app.agent.agent_memory import MemoryManager
+from app.config import settings
+
+pytestmark = pytest.mark.anyio
+
+QUERY = "订阅怎么取消自动续费"
+
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", True)
+    response_cache.clear()
+    yield
+    response_cache.clear()
+
+
+def test_query_length_counts_cjk_characters_as_words():
+    assert query_length("还是不行") == 4
+    assert query_length("App闪退怎么办") == 6
+    assert query_length("how do I cancel my subscription?") == 6
+    assert not response_cache.cacheable("还是不行")
+    assert response_cache.cacheable(QUERY)
+
+
+async def _chat(user_id: str, query: str):
+    return await multi_agent_chat(user_id, query, MemoryManager(user_id), "zh")
+
+
+async def test_first_turn_reply_is_shared(app, redis, cache_enabled):
+    first = await _chat("c1", QUERY)
+    assert first["agent"] == "订阅与付费智能体"
+    assert response_cache.stats()["size"] == 1
+
+    second = await _chat("c2", QUERY)
+    assert second["response"] == first["response"]
+    assert response_cache.stats()["hits"] == 1
+
+
+async def test_cache_is_not_used_with_context(app, redis, cache_enabled):
+    await _chat("c3", "你好")
+    size = response_cache.stats()["size"]
+    # 已有历史的用户既不读取也不写入缓存
+    await _chat("c3", QUERY)
+    assert response_cache.stats()["size"] == size
+
+    await response_cache.put("zh", QUERY, "缓存的回复", "订阅与付费智能体")
+    reply = await _chat("c3", QUERY)
+    assert reply["response"] != "缓存的回复"
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+from redis.exceptions import ResponseError
+
+from app.agent import agent_chat
+from app.agent.agent_memory import MemoryManager
+from app.agent.agent_session_store import session_store
+from app.agent.agent_state import default_state
+from app.db.redis.session import PipelineBatcher, ctx_key
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_batcher_fails_only_the_caller_with_the_error(redis):
+    await redis.set("not-a-list", "x")
+    batcher = PipelineBatcher(max_delay=0.01)
+    ok, failed = await asyncio.gather(
+        batcher.execute(lambda pipe: pipe.rpush("list", "a")),
+        batcher.execute(lambda pipe: pipe.rpush("not-a-list", "b")),
+        return_exceptions=True,
+    )
+    assert batcher.round_trips == 1
+    assert isinstance(failed, ResponseError)
+    assert not isinstance(ok, Exception)
+    # MULTI/EXEC不会回滚，其他调用方的命令已经生效
+    assert await redis.lrange("list", 0, -1) == [b"a"]
+
+
+async def test_commit_with_unknown_outcome_is_not_retried(app, redis, monkeypatch):
+    calls = []
+    commit = agent_chat.session_store.commit
+
+    async def failing_commit(*args, **kwargs):
+        calls.append(1)
+        await commit(*args, **kwargs)
+        raise TimeoutError("EXEC超时，结果未知")
+
+    monkeypatch.setattr(agent_chat.session_store, "commit", failing_commit)
+    result = await agent_chat.multi_agent_chat("d1", "你好", MemoryManager("d1"), "zh")
+    assert result["status"] == "error"
+    assert len(calls) == 1
+    messages = await redis.lrange("d1", 0, -1)
+    assert messages and len(messages) == len(set(messages))
+
+
+async def test_unchanged_state_ttl_is_refreshed_with_history(redis):
+    state = {"workout_plan_params": {"workout_duration": "15-20"}, "basic_info_params": {}}
+    await session_store.commit(MemoryManager("d2"), [ChatMessage(role=MessageRole.USER, content="改成15-20分钟")],
+                               state=state, loaded_state=default_state())
+    await redis.expire(ctx_key("d2"), 10)
+
+    # state没有变化时不重新写入，但TTL与历史一起刷新
+    snapshot = await session_store.bootstrap("d2")
+    await session_store.commit(MemoryManager("d2"), [ChatMessage(role=MessageRole.USER, content="好的")],
+                               state=snapshot.state, loaded_state=snapshot.state)
+    assert await redis.ttl(ctx_key("d2")) > 10
+    assert await redis.ttl(ctx_key("d2")) == await redis.ttl("d2")
+    assert (await session_store.bootstrap("d2")).state == state
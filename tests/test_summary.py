@@ -0,0 +1,109 @@
+from typing import List
+
+import pytest
+from llama_index.core.llms import ChatMessage, ChatResponse, MessageRole
+
+from app.agent.agent_memory import MemoryManager
+from app.agent.agent_summary import ConversationSummarizer
+from app.config import settings
+from app.db.redis.session import summary_key
+
+pytestmark = pytest.mark.anyio
+
+LOCK_KEY = f"{summary_key('u')}:lock"
+
+
+class StubSummaryLLM:
+    """记录收到的请求，按调用次数返回固定摘要"""
+
+    def __init__(self, on_call=None):
+        self.calls: List[List[ChatMessage]] = []
+        self.on_call = on_call
+
+    async def achat(self, messages, **kwargs) -> ChatResponse:
+        self.calls.append(messages)
+        if self.on_call is not None:
+            await self.on_call()
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=f" 摘要{len(self.calls)} "))
+
+
+def _messages(start: int, count: int) -> List[ChatMessage]:
+    return [
+        ChatMessage(role=MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT, content=f"消息{i}")
+        for i in range(start, start + count)
+    ]
+
+
+@pytest.fixture(autouse=True)
+def summary_settings(monkeypatch):
+    monkeypatch.setattr(settings, "MEMORY_SUMMARY_RECENT_MESSAGES", 6)
+    monkeypatch.setattr(settings, "MEMORY_SUMMARY_MAX_FOLD_MESSAGES", 200)
+
+
+async def test_summarize_folds_messages_before_recent_window(redis):
+    await MemoryManager("u").append_messages(_messages(0, 10))
+    llm = StubSummaryLLM()
+
+    assert await ConversationSummarizer(llm=llm).summarize("u")
+
+    assert await redis.hgetall(summary_key("u")) == {b"text": "摘要1".encode(), b"upto": b"4"}
+    assert not await redis.exists(LOCK_KEY)
+    transcript = llm.calls[0][1].content
+    assert "消息3" in transcript and "消息4" not in transcript
+    assert "已有摘要:\n无" in transcript
+
+
+async def test_summarize_continues_from_upto(redis):
+    await MemoryManager("u").append_messages(_messages(0, 10))
+    llm = StubSummaryLLM()
+    summarizer = ConversationSummarizer(llm=llm)
+    await summarizer.summarize("u")
+    # 最近的消息不足以折叠时不调用LLM
+    assert not await summarizer.summarize("u")
+    assert len(llm.calls) == 1
+
+    await MemoryManager("u").append_messages(_messages(10, 4))
+    assert await summarizer.summarize("u")
+
+    assert await summarizer.load("u") == ("摘要2", 8)
+    transcript = llm.calls[1][1].content
+    assert "已有摘要:\n摘要1" in transcript
+    assert "消息4" in transcript and "消息7" in transcript
+    assert "消息3" not in transcript and "消息8" not in transcript
+
+
+async def test_summarize_skips_when_locked(redis):
+    await MemoryManager("u").append_messages(_messages(0, 10))
+    await redis.set(LOCK_KEY, b"other")
+    llm = StubSummaryLLM()
+
+    assert not await ConversationSummarizer(llm=llm).summarize("u")
+
+    assert not llm.calls
+    assert await redis.get(LOCK_KEY) == b"other"
+
+
+async def test_summarize_keeps_lock_taken_over_by_another_holder(redis):
+    await MemoryManager("u").append_messages(_messages(0, 10))
+
+    async def lock_expired_and_taken():
+        await redis.set(LOCK_KEY, b"other")
+
+    await ConversationSummarizer(llm=StubSummaryLLM(on_call=lock_expired_and_taken)).summarize("u")
+
+    assert await redis.get(LOCK_KEY) == b"other"
+
+
+async def test_memory_reloads_summary_and_messages_after_upto(redis, monkeypatch):
+    monkeypatch.setattr(settings, "MEMORY_SUMMARY_ENABLED", True)
+    await MemoryManager("u").append_messages(_messages(0, 10))
+    await ConversationSummarizer(llm=StubSummaryLLM()).summarize("u")
+
+    manager = MemoryManager("u")
+    memory = await manager.init_memory()
+    messages = await memory.aget_all()
+
+    assert messages[0].role == MessageRole.SYSTEM and messages[0].content.endswith("摘要1")
+    assert [message.content for message in messages[1:]] == [f"消息{i}" for i in range(4, 10)]
+    # 摘要消息不会再次保存
+    assert await manager.new_messages(memory) == []
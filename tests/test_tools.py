@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.tools import LarkClient
+from benchmarks.loadtest import stub_lark_app
+
+
+@pytest.fixture
+def lark():
+    """连接本地stub的飞书客户端，stub.state.hits 记录各接口的请求次数"""
+    stub = stub_lark_app()
+    client = LarkClient(app_id="cli_test", app_secret="secret")
+    client._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub), base_url="http://lark.stub")
+    return client, stub
+
+
+@pytest.mark.parametrize("app_id, app_secret", [("", ""), ("cli_test", ""), ("", "secret")])
+def test_missing_credentials_fail_fast(app_id, app_secret):
+    with pytest.raises(RuntimeError):
+        LarkClient(app_id=app_id, app_secret=app_secret).check_credentials()
+
+
+def test_credentials_from_env_pass():
+    LarkClient(app_id="cli_test", app_secret="secret").check_credentials()
+
+
+@pytest.mark.anyio
+async def test_cached_token_is_reused(lark):
+    client, stub = lark
+    for _ in range(3):
+        await client.send_msg("a@example.com", "msg")
+    assert stub.state.hits == {"token": 1, "messages": 3}
+
+
+@pytest.mark.anyio
+async def test_concurrent_callers_refresh_token_once(lark):
+    client, stub = lark
+    tokens = await asyncio.gather(*(client.get_tenant_token() for _ in range(10)))
+    assert set(tokens) == {"stub-token-1"}
+    assert stub.state.hits["token"] == 1
+
+
+@pytest.mark.anyio
+async def test_invalid_token_is_refreshed_and_retried_once(lark):
+    client, stub = lark
+    await client.send_msg("a@example.com", "msg")
+    # 缓存的token在过期前被飞书判定失效
+    stub.state.revoked.add("stub-token-1")
+    await client.send_msg("a@example.com", "msg")
+    assert stub.state.hits == {"token": 2, "messages": 3}
+    assert await client.get_tenant_token() == "stub-token-2"
@@ -0,0 +1,18 @@
+from app.agent.agent_init import AgentWorkflowRegistry
+from app.agent.agent_prerouter import ROUTER_AGENT, SPECIALIST_AGENTS
+
+
+def test_entry_agents_do_not_evict_other_languages():
+    registry = AgentWorkflowRegistry(max_size=2)
+    workflows = {}
+    for language in ("zh", "en"):
+        for root_agent in [ROUTER_AGENT, *SPECIALIST_AGENTS]:
+            workflows[language, root_agent] = registry.get(language, root_agent)
+    assert len(registry) == 10
+    # 同一语言的全部入口智能体不会挤出其他语言
+    assert all(registry.get(*key) is workflow for key, workflow in workflows.items())
+
+    registry.get("ja")
+    assert len(registry) == 6
+    assert registry.get("en", ROUTER_AGENT) is workflows["en", ROUTER_AGENT]
+    assert registry.get("zh", ROUTER_AGENT) is not workflows["zh", ROUTER_AGENT]